@@ -0,0 +1,249 @@
+"""
+Benchmark harness for the FFmpeg/HandBrake video processing tool
+
+Builds a synthetic tree of leaf directories filled with lavfi test clips,
+runs the tool's discovery, probing and processing pipeline over it and
+reports how long each phase took:
+
+- discovery:     dir_no_subs over the tree
+- probing:       probing every clip with the probe cache disabled
+- concatenation: ffmpeg stream copy inside the concat stage
+- verification:  output checks and duration verification
+- relocation:    moving (or with -d deleting) the concatenated clips
+
+Results are written as JSON. When a baseline results file is given, any
+phase that got slower by more than the threshold fails the run, so
+orchestration changes can be judged on numbers.
+
+Usage:
+    python benchmark.py --dirs 8 --clips 20 --duration 2 --output bench.json
+    python benchmark.py --baseline bench.json --threshold 0.2
+"""
+
+import argparse
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import main
+
+# Phases reported by the benchmark, in pipeline order
+PHASES = ["discovery", "probing", "concatenation", "verification", "relocation"]
+
+# Trace spans whose durations make up each pipeline phase
+PHASE_SPANS = {
+    "concatenation": ("ffmpeg_stream_copy",),
+    "verification": ("verify",),
+    "relocation": ("move", "unlink"),
+}
+
+# Phases faster than this (in seconds) are too noisy to flag as regressions
+DEFAULT_NOISE_FLOOR = 0.05
+
+
+def build_tree(root: Path, dirs: int, clips: int, duration: float, resolution: str,
+               fps: int, codec: str) -> int:
+    """Create dirs leaf directories holding clips lavfi test clips each
+
+    A single clip is encoded once and copied, so building large trees stays
+    cheap; the tool only stream-copies, so identical clips measure the same.
+
+    Args:
+        root: Directory to build the tree in
+        dirs: Number of leaf directories
+        clips: Number of clips per directory
+        duration: Length of each clip in seconds
+        resolution: Frame size as WIDTHxHEIGHT
+        fps: Frame rate of the clips
+        codec: ffmpeg video encoder used for the clips
+
+    Returns:
+        Total size of all clips in bytes
+    """
+    template = root / "template.mp4"
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size={resolution}:rate={fps}:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+        "-c:v", codec, "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest",
+        str(template)
+    ], check=True)
+
+    total = 0
+    tree = root / "tree"
+    for d in range(dirs):
+        leaf = tree / f"camera{d:03d}"
+        leaf.mkdir(parents=True)
+        for c in range(clips):
+            shutil.copyfile(template, leaf / f"clip{c:04d}.mp4")
+            total += template.stat().st_size
+    template.unlink()
+    return total
+
+
+def phase_totals(tracer: main.Tracer) -> dict[str, float]:
+    """Sum recorded span durations into pipeline phases
+
+    Args:
+        tracer: Tracer that recorded a processing run
+
+    Returns:
+        Seconds spent in each phase of PHASE_SPANS
+    """
+    totals = {phase: 0.0 for phase in PHASE_SPANS}
+    for event in tracer.events:
+        for phase, names in PHASE_SPANS.items():
+            if event["name"] in names:
+                totals[phase] += event["dur"] / 1e6
+    return totals
+
+
+def run_once(pristine: Path, work: Path, options: list[str]) -> dict[str, float]:
+    """Copy the pristine tree and time one full run over the copy
+
+    Args:
+        pristine: Tree built by build_tree
+        work: Scratch location for this run's copy
+        options: Extra command line options passed to the tool
+
+    Returns:
+        Seconds spent in each phase, plus the total wall time
+    """
+    if work.exists():
+        shutil.rmtree(work)
+    shutil.copytree(pristine, work)
+    # every clip is a copy of the same template, so duplicate detection must stay off
+    args = main.build_parser().parse_args(["-y", "--no-cache", "--keep-duplicates", *options])
+
+    start = time.perf_counter()
+    directories = main.dir_no_subs(work)
+    discovery = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for directory in directories:
+        main.probe_files(main.scan_clips(directory), args.probe_workers)
+    probing = time.perf_counter() - start
+
+    tracer = main.Tracer()
+    main.set_tracer(tracer)
+    try:
+        start = time.perf_counter()
+        results = main.process_directories(work, directories, args)
+        pipeline = time.perf_counter() - start
+    finally:
+        main.set_tracer(None)
+
+    failed = [result for result in results if not result.ok]
+    if failed:
+        raise RuntimeError(f"Benchmark run failed in {failed[0].directory}: {failed[0].error}")
+
+    timings = {"discovery": discovery, "probing": probing}
+    timings.update(phase_totals(tracer))
+    timings["pipeline_wall"] = pipeline
+    return timings
+
+
+def compare_to_baseline(current: dict[str, float], baseline: dict[str, float], threshold: float,
+                        noise_floor: float = DEFAULT_NOISE_FLOOR) -> list[str]:
+    """Find phases that regressed against a baseline
+
+    Args:
+        current: Seconds per phase for this run
+        baseline: Seconds per phase from the stored baseline
+        threshold: Allowed relative slowdown (0.2 means 20%)
+        noise_floor: Ignore phases whose slowdown is below this many seconds
+
+    Returns:
+        One human readable line per regressed phase
+    """
+    regressions = []
+    for phase, seconds in current.items():
+        before = baseline.get(phase)
+        if before is None:
+            continue
+        if seconds - before > noise_floor and seconds > before * (1 + threshold):
+            change = (seconds / before - 1) * 100 if before else float("inf")
+            regressions.append(f"{phase}: {before:.3f}s -> {seconds:.3f}s (+{change:.0f}%)")
+    return regressions
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build the benchmark's command line argument parser
+
+    Returns:
+        Configured ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the processing pipeline on a synthetic tree")
+    parser.add_argument('--dirs', type=int, default=4, help='Number of leaf directories (default: 4)')
+    parser.add_argument('--clips', type=int, default=10, help='Clips per directory (default: 10)')
+    parser.add_argument('--duration', type=float, default=2.0, help='Seconds per clip (default: 2)')
+    parser.add_argument('--resolution', default='640x360', help='Clip frame size (default: 640x360)')
+    parser.add_argument('--fps', type=int, default=30, help='Clip frame rate (default: 30)')
+    parser.add_argument('--codec', default='libx264', help='Encoder for the test clips (default: libx264)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs to take the median of (default: 3)')
+    parser.add_argument('--workdir', help='Where to build the tree (default: a temporary directory)')
+    parser.add_argument('--output', help='Write results JSON to this file')
+    parser.add_argument('--baseline', help='Results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed slowdown per phase before failing (default: 0.2 = 20%%)')
+    parser.add_argument('--noise-floor', type=float, default=DEFAULT_NOISE_FLOOR,
+                        help=f'Ignore slowdowns below this many seconds (default: {DEFAULT_NOISE_FLOOR})')
+    parser.add_argument('tool_options', nargs=argparse.REMAINDER,
+                        help='Options passed to the tool after "--", e.g. -- --jobs 4 -d')
+    return parser
+
+
+def main_benchmark() -> int:
+    """Entry point for the benchmark harness
+
+    Returns:
+        Process exit status: 1 if a phase regressed against the baseline
+    """
+    args = build_parser().parse_args()
+    options = [option for option in args.tool_options if option != "--"]
+    main.validate_tools(main.build_parser().parse_args(["-y", *options]))
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as tmp:
+        tmp_path = Path(tmp)
+        total_bytes = build_tree(tmp_path, args.dirs, args.clips, args.duration,
+                                 args.resolution, args.fps, args.codec)
+        runs = [run_once(tmp_path / "tree", tmp_path / "run", options) for _ in range(max(1, args.repeat))]
+
+    phases = {phase: statistics.median(run[phase] for run in runs) for phase in [*PHASES, "pipeline_wall"]}
+    results = {
+        "config": {
+            "dirs": args.dirs, "clips": args.clips, "duration": args.duration,
+            "resolution": args.resolution, "fps": args.fps, "codec": args.codec,
+            "repeat": args.repeat, "tool_options": options, "total_bytes": total_bytes,
+        },
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "phases": phases,
+        "runs": runs,
+    }
+
+    for phase, seconds in phases.items():
+        print(f"{phase:>14}: {seconds:8.3f}s")
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2), encoding="utf8")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf8"))
+        if baseline.get("config", {}).get("tool_options") != options:
+            print("warning: baseline was recorded with different tool options", file=sys.stderr)
+        regressions = compare_to_baseline(phases, baseline["phases"], args.threshold, args.noise_floor)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            return 1
+        print("No regressions against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_benchmark())
@@ -1,10 +1,35 @@
 """System module"""
+import os
+import sys
+import time
 import shutil
+import json
+import errno
+import ctypes
+import select
+import signal
+import struct
+import re
+import hashlib
+import random
+import fnmatch
+import queue
+import sqlite3
 import argparse
+import asyncio
+import concurrent.futures
+import shlex
 import platform
+import threading
 import subprocess
+import tempfile
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field, replace
 from pathlib import Path
+from typing import Callable, Iterable, Iterator
 from natsort import natsorted
 
 # Configure logging
@@ -18,261 +43,4648 @@ logger = logging.getLogger(__name__)
 # Default file size limit in bytes (4.2 GB)
 DEFAULT_SIZE_LIMIT = 4200000000
 
-def run_command(cmd_list: list[str], error_message: str) -> None:
+# Bytes hashed at each end of same-size clips to find duplicate copies
+DEDUP_EDGE_BYTES = 4 * 1024 * 1024
+
+# Seconds between progress log lines when not running on a terminal
+DEFAULT_PROGRESS_INTERVAL = 60.0
+
+# Rough stream-copy throughput in bytes per second, for predictions before it was measured
+DEFAULT_COPY_BYTES_PER_SECOND = 150e6
+
+# Rough encode speed in seconds of video per second, for predictions before it was measured
+DEFAULT_ENCODE_SPEED = 2.0
+
+# --verify deep: number and length (seconds) of the windows of each output that get decoded
+DEEP_VERIFY_WINDOWS = 4
+DEEP_VERIFY_SECONDS = 2.0
+
+# Lines of a failed command's output quoted in its error message
+COMMAND_TAIL_LINES = 10
+
+# Default number of ffprobe processes run at once during verification
+DEFAULT_PROBE_WORKERS = min(8, os.cpu_count() or 1)
+
+# Maximum number of files remembered by the persistent probe cache
+PROBE_CACHE_MAX_ENTRIES = 100000
+
+# Name of the folder under the root that collects archived split files
+ARCHIVE_DIR_NAME = "files to delete"
+
+# Name of the run journal kept in the root directory
+JOURNAL_NAME = ".ffmpeg_concat_journal.jsonl"
+
+# Name of the folder under the root that collects the per-directory command logs
+LOG_DIR_NAME = ".ffmpeg_concat_logs"
+
+# Sentinel that tells a pipeline stage worker to exit
+_STOP = object()
+
+# Expected size of HandBrake's output relative to its input, for disk space planning
+COMPRESSED_SIZE_RATIO = 0.5
+
+# Free space (in GB) always left on the disk by default
+DEFAULT_MIN_FREE_GB = 1.0
+
+# Seconds a directory has to stay quiet in --watch mode before it is processed
+DEFAULT_SETTLE_SECONDS = 30.0
+
+# ffmpeg video encoders usable instead of HandBrakeCLI, with their codec options
+FFMPEG_VIDEO_ENCODERS = {
+    "x265": ["-c:v", "libx265", "-tag:v", "hvc1"],
+    "x264": ["-c:v", "libx264"],
+}
+
+# Shortest segment, in seconds, that --chunks splits a file into
+MIN_CHUNK_SECONDS = 300
+
+# Serializes access to the shared archive folder when directories run in parallel
+ARCHIVE_LOCK = threading.Lock()
+
+
+@dataclass
+class DirectoryResult:
+    """Outcome of processing a single leaf directory"""
+    directory: Path
+    ok: bool
+    seconds: float
+    clip_bytes: int = 0
+    error: str = ""
+    relocation: "RelocationStats | None" = None
+    verify_seconds: float = 0.0
+
+
+@dataclass
+class Clip:
+    """A candidate input file, with the stat data captured while listing its directory"""
+    name: str
+    path: Path
+    size: int
+    mtime_ns: int
+
+
+class Tracer:
+    """Records timed spans and writes them in Chrome trace-event format
+
+    The resulting JSON file can be opened in Perfetto (ui.perfetto.dev) or
+    chrome://tracing. Spans are "complete" events on the thread that ran
+    them, so work done by parallel workers shows up on separate tracks.
+    """
+
+    def __init__(self):
+        self.events: list[dict] = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+        self._threads: dict[int, str] = {}
+
+    @contextmanager
+    def span(self, name: str, cat: str, span_args: dict) -> Iterator[dict]:
+        """Time the enclosed block as one trace event
+
+        Args:
+            name: Event name
+            cat: Event category
+            span_args: Values attached to the event; the caller may add to it inside the block
+
+        Yields:
+            span_args
+        """
+        thread = threading.current_thread()
+        start = time.perf_counter()
+        try:
+            yield span_args
+        finally:
+            end = time.perf_counter()
+            event = {
+                "name": name, "cat": cat, "ph": "X",
+                "ts": (start - self._origin) * 1e6, "dur": (end - start) * 1e6,
+                "pid": self._pid, "tid": thread.ident,
+                "args": {key: value for key, value in span_args.items() if value is not None},
+            }
+            with self._lock:
+                self._threads.setdefault(thread.ident, thread.name)
+                self.events.append(event)
+
+    def write(self, path: Path) -> None:
+        """Write all recorded spans to a trace-event JSON file
+
+        Args:
+            path: Output file
+        """
+        with self._lock:
+            metadata = [
+                {"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": name}}
+                for tid, name in self._threads.items()
+            ]
+            events = metadata + list(self.events)
+        with open(path, "w", encoding="utf8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+# Tracer receiving spans, configured by main() when --trace is given
+_tracer: Tracer | None = None
+
+
+def set_tracer(tracer: Tracer | None) -> None:
+    """Set the tracer that trace_span records into (None disables tracing)
+
+    Args:
+        tracer: Tracer to use, or None
+    """
+    global _tracer
+    _tracer = tracer
+
+
+@contextmanager
+def trace_span(name: str, cat: str = "stage", **span_args) -> Iterator[dict]:
+    """Record the enclosed block as a span when tracing is enabled
+
+    Args:
+        name: Span name
+        cat: Span category (stage, probe, command, io, discovery)
+        **span_args: Values attached to the span, such as directory or bytes
+
+    Yields:
+        Dict of span arguments that the block may add to
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield span_args
+        return
+    with tracer.span(name, cat, span_args) as values:
+        yield values
+
+
+class FFmpegProgress:
+    """Collects the key=value stream ffmpeg writes with -progress
+
+    ffmpeg prints a block of keys (frame, fps, total_size, out_time_us,
+    speed, ...) ending in "progress=continue", and "progress=end" once the
+    output is finalized. The last out_time_us is the output timestamp.
+    """
+
+    def __init__(self):
+        self.values: dict[str, str] = {}
+        self.out_time: float | None = None
+        self.finished = False
+
+    def feed(self, line: str) -> None:
+        """Consume one line of ffmpeg progress output
+
+        Args:
+            line: A "key=value" line
+        """
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            return
+        self.values[key] = value
+        # out_time_ms is also in microseconds, despite its name
+        if key in ("out_time_us", "out_time_ms"):
+            microseconds = _optional_int(value)
+            if microseconds is not None and microseconds >= 0:
+                self.out_time = microseconds / 1_000_000
+        elif key == "progress" and value == "end":
+            self.finished = True
+
+    @property
+    def duration(self) -> float | None:
+        """Output duration in seconds, once ffmpeg has reported the end of the output"""
+        return self.out_time if self.finished else None
+
+
+class HandBrakeProgress:
+    """Collects the JSON blocks HandBrakeCLI writes with --json
+
+    HandBrake prints labelled JSON objects such as "JSON Title Set: {...}"
+    (the scanned source) and "Progress: {...}" (encode state), each spread
+    over several lines.
+    """
+
+    def __init__(self):
+        self.state: str | None = None
+        self.fraction = 0.0
+        self.rate: float | None = None
+        self.error: int | None = None
+        self.source_duration: float | None = None
+        self._label: str | None = None
+        self._lines: list[str] = []
+        self._depth = 0
+
+    def feed(self, line: str) -> None:
+        """Consume one line of HandBrake output
+
+        Args:
+            line: A line of HandBrake's stdout
+        """
+        if self._label is None:
+            label, sep, rest = line.partition(": {")
+            if not sep or label not in ("Progress", "JSON Title Set"):
+                return
+            self._label = label
+            line = "{" + rest
+        self._lines.append(line)
+        self._depth += line.count("{") - line.count("}")
+        if self._depth > 0:
+            return
+
+        label, text = self._label, "".join(self._lines)
+        self._label, self._lines, self._depth = None, [], 0
+        try:
+            block = json.loads(text)
+        except ValueError:
+            return
+        if label == "Progress":
+            self._update_progress(block)
+        else:
+            self._update_title_set(block)
+
+    def _update_progress(self, block: dict) -> None:
+        """Record the state from a "Progress" block"""
+        self.state = block.get("State")
+        working = block.get("Working") or {}
+        if "Progress" in working:
+            self.fraction = float(working["Progress"])
+            self.rate = _optional_float(working.get("Rate"))
+        if self.state == "WORKDONE":
+            self.fraction = 1.0
+            self.error = (block.get("WorkDone") or {}).get("Error")
+
+    def _update_title_set(self, block: dict) -> None:
+        """Record the source duration from a "JSON Title Set" block"""
+        titles = block.get("TitleList") or []
+        if titles:
+            duration = titles[0].get("Duration") or {}
+            if "Ticks" in duration:
+                # HandBrake durations are in 90kHz ticks
+                self.source_duration = duration["Ticks"] / 90000
+            elif duration:
+                self.source_duration = (duration.get("Hours", 0) * 3600
+                                        + duration.get("Minutes", 0) * 60
+                                        + duration.get("Seconds", 0))
+
+
+def format_eta(seconds: float) -> str:
+    """Format a duration for progress output (1h02m, 5m30s or 45s)"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+@dataclass
+class ProgressTask:
+    """One running ffmpeg/HandBrake command as seen by the progress reporter"""
+    directory: str
+    stage: str
+    progress: FFmpegProgress | HandBrakeProgress
+    input_bytes: int
+    duration: float | None
+    started: float = field(default_factory=time.monotonic)
+
+    @property
+    def fraction(self) -> float:
+        """Part of the input processed so far, from 0 to 1"""
+        progress = self.progress
+        if isinstance(progress, HandBrakeProgress):
+            return progress.fraction
+        if progress.finished:
+            return 1.0
+        if progress.out_time is None or not self.duration:
+            return 0.0
+        return min(1.0, progress.out_time / self.duration)
+
+    @property
+    def fps(self) -> float | None:
+        """Frames per second the tool reports"""
+        if isinstance(self.progress, HandBrakeProgress):
+            return self.progress.rate
+        return _optional_float(self.progress.values.get("fps"))
+
+    @property
+    def bytes_per_second(self) -> float:
+        """Input bytes processed per second"""
+        elapsed = time.monotonic() - self.started
+        return self.fraction * self.input_bytes / elapsed if elapsed > 0 else 0.0
+
+    def describe(self) -> str:
+        """Short status: directory, stage, percent done, fps and MB/s"""
+        fps = self.fps
+        return (f"{self.directory} {self.stage} {self.fraction:.0%}"
+                f"{f' {fps:.1f} fps' if fps else ''} {self.bytes_per_second / 1e6:.1f} MB/s")
+
+
+class ProgressReporter:
+    """Shows what every running command is doing and when the batch will finish
+
+    Every directory found adds its work to the batch: its clip bytes once
+    for concatenation and once more for compression with -c. The sizes come
+    from a quick scan while the tree is still being walked (see
+    discover_directories) and are replaced by the exact ones when the
+    directory is admitted to the pipeline. Running commands count with the
+    fraction their progress output reports (ffmpeg's -progress stream or
+    HandBrake's JSON), and the ETA divides the remaining work by the
+    throughput so far. Until the first command has reported progress the
+    ETA comes from the throughput model's predictions instead (see
+    predict_seconds). While the walk is still going the line says the total
+    is not complete yet.
+
+    On a terminal a status line is redrawn every second at the bottom of the
+    log; otherwise (cron, pipes) a progress line is logged every `interval`
+    seconds.
+    """
+
+    def __init__(self, interactive: bool = False, interval: float = DEFAULT_PROGRESS_INTERVAL,
+                 stream=None):
+        self.interactive = interactive
+        self.interval = 1.0 if interactive else interval
+        self.stream = stream if stream is not None else sys.stderr
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._tasks: list[ProgressTask] = []
+        self._work: dict[Path, int] = {}
+        self._done: dict[Path, int] = {}
+        self._predicted: dict[Path, float | None] = {}
+        self._finished = 0
+        self._discovering = False
+        self._status_shown = False
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def discover(self, directory: Path, clip_bytes: int, args: argparse.Namespace) -> None:
+        """Add a directory found by the walk to the batch, before it is admitted
+
+        Args:
+            directory: Leaf directory
+            clip_bytes: Combined size of its clips
+            args: Command line arguments namespace
+        """
+        passes = 2 if args.c and not single_pass_encode(args) else 1
+        predicted = predict_seconds(args, clip_bytes)
+        with self._lock:
+            self._discovering = True
+            if directory not in self._work:
+                self._work[directory] = clip_bytes * passes
+                self._done[directory] = 0
+                self._predicted[directory] = predicted
+
+    def end_discovery(self) -> None:
+        """Mark the batch as complete: the walk has found every directory"""
+        with self._lock:
+            self._discovering = False
+
+    def skip(self, directory: Path) -> None:
+        """Take a directory that will not be processed back out of the batch
+
+        Args:
+            directory: Leaf directory that had nothing to do or could not be admitted
+        """
+        with self._lock:
+            self._work.pop(directory, None)
+            self._done.pop(directory, None)
+            self._predicted.pop(directory, None)
+
+    def add_job(self, job: "DirectoryJob") -> None:
+        """Add a directory's work to the batch, or replace the estimate made when it was found
+
+        Args:
+            job: Directory job entering the pipeline
+        """
+        passes = 2 if job.args.c and not job.single_pass else 1
+        predicted = predict_seconds(job.args, job.clip_bytes, job.clip_infos, job.append)
+        with self._lock:
+            self._work[job.directory] = job.clip_bytes * passes
+            self._done[job.directory] = 0
+            self._predicted[job.directory] = predicted
+
+    def finish_job(self, job: "DirectoryJob") -> None:
+        """Count all of a directory's work as done (or dropped, if it failed)
+
+        Args:
+            job: Directory job leaving the pipeline
+        """
+        with self._lock:
+            if job.directory in self._work:
+                self._done[job.directory] = self._work[job.directory]
+                self._finished += 1
+
+    @contextmanager
+    def task(self, job: "DirectoryJob", stage: str, progress: FFmpegProgress | HandBrakeProgress,
+             input_bytes: int, duration: float | None) -> Iterator[ProgressTask]:
+        """Follow a command's progress while the enclosed block runs it
+
+        Args:
+            job: Directory job the command works for
+            stage: What the command does, like "concat" or "compress"
+            progress: Parser the command's output is fed into
+            input_bytes: Size of the command's input
+            duration: Expected output duration, to turn ffmpeg timestamps into a fraction
+
+        Yields:
+            The ProgressTask being shown
+        """
+        task = ProgressTask(job.title, stage, progress, input_bytes, duration)
+        with self._lock:
+            self._tasks.append(task)
+        try:
+            yield task
+        finally:
+            with self._lock:
+                self._tasks.remove(task)
+                if job.directory in self._done:
+                    self._done[job.directory] = min(self._work[job.directory],
+                                                    self._done[job.directory] + int(task.fraction * input_bytes))
+
+    def summary(self) -> str:
+        """One line with the batch's progress, throughput and ETA"""
+        with self._lock:
+            tasks = list(self._tasks)
+            total = sum(self._work.values())
+            done = sum(self._done.values())
+            finished, directories = self._finished, len(self._work)
+            discovering = self._discovering
+            predicted = [self._predicted.get(d) for d in self._work if self._done[d] < self._work[d]]
+        # running commands add the part of their input they got through
+        done += sum(int(task.fraction * task.input_bytes) for task in tasks)
+        done = min(done, total)
+        elapsed = time.monotonic() - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        line = f"{finished}/{directories} directories"
+        if discovering:
+            line += " (still counting)"
+        line += f", {done / total if total else 0:.0%}"
+        line += f" of {total / 1e9:.1f} GB, {rate / 1e6:.1f} MB/s"
+        if rate > 0 and total > done:
+            line += f", ETA {format_eta((total - done) / rate)}"
+        elif total > done and None not in predicted:
+            line += f", ETA {format_eta(sum(predicted))} (predicted)"
+        return line
+
+    def running(self) -> list[str]:
+        """Status of every running command"""
+        with self._lock:
+            return [task.describe() for task in self._tasks]
+
+    def render(self) -> None:
+        """Redraw the status line, or log the progress when not on a terminal"""
+        if self.interactive:
+            line = " | ".join([self.summary(), *self.running()])
+            width = shutil.get_terminal_size().columns
+            with self._lock:
+                self.stream.write("\r\x1b[K" + line[:width - 1])
+                self.stream.flush()
+                self._status_shown = True
+            return
+        logger.info("Progress: %s", self.summary())
+        for status in self.running():
+            logger.info("  %s", status)
+
+    def clear(self) -> None:
+        """Remove the status line so a log line can take its place"""
+        with self._lock:
+            if self._status_shown:
+                self.stream.write("\r\x1b[K")
+                self.stream.flush()
+                self._status_shown = False
+
+    def _clear_for_log(self, record: logging.LogRecord) -> bool:
+        """Logging filter that clears the status line before a record is written"""
+        self.clear()
+        return True
+
+    def start(self) -> None:
+        """Start showing progress in the background"""
+        if self.interactive:
+            for handler in logging.getLogger().handlers:
+                handler.addFilter(self._clear_for_log)
+
+        def loop():
+            while not self._stop.wait(self.interval):
+                self.render()
+
+        self._thread = threading.Thread(target=loop, name="progress", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """Stop showing progress"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.clear()
+        for handler in logging.getLogger().handlers:
+            handler.removeFilter(self._clear_for_log)
+
+
+# Reporter that running commands show their progress in, configured by main()
+_progress: ProgressReporter | None = None
+
+
+def set_progress_reporter(reporter: ProgressReporter | None) -> None:
+    """Set the reporter commands show their progress in (None disables it)
+
+    Args:
+        reporter: ProgressReporter to use, or None
+    """
+    global _progress
+    _progress = reporter
+
+
+@contextmanager
+def track_progress(job: "DirectoryJob", stage: str, progress: FFmpegProgress | HandBrakeProgress,
+                   input_bytes: int, duration: float | None = None) -> Iterator[None]:
+    """Show a command's progress while the enclosed block runs it, if a reporter is configured
+
+    Args:
+        job: Directory job the command works for
+        stage: What the command does
+        progress: Parser the command's output is fed into
+        input_bytes: Size of the command's input
+        duration: Expected output duration in seconds, for ffmpeg
+    """
+    reporter = _progress
+    if reporter is None:
+        yield
+        return
+    with reporter.task(job, stage, progress, input_bytes, duration):
+        yield
+
+
+def directory_log(root: Path, directory: Path) -> Path:
+    """Log file that captures the output of the commands run for a directory
+
+    Logs are kept under the root rather than in the clip folder, so they are
+    neither archived nor deleted with the clips. The name is the directory's
+    path below the root, which keeps leaf folders of the same name apart.
+
+    Args:
+        root: Root directory of the run
+        directory: Leaf directory
+
+    Returns:
+        "<root>/LOG_DIR_NAME/<relative path>.log"
+    """
+    try:
+        parts = directory.relative_to(root).parts
+    except ValueError:
+        parts = ()
+    return root / LOG_DIR_NAME / f"{' - '.join(parts) or directory.name}.log"
+
+
+def _command_error(error_message: str, returncode: int, tail: Iterable[str]) -> str:
+    """Error message for a failed command, ending in the last lines it wrote"""
+    message = f"{error_message} (exit status {returncode})"
+    lines = [line for line in tail if line]
+    if lines:
+        message += ":\n" + "\n".join(f"    {line}" for line in lines)
+    return message
+
+
+class CommandRunner:
+    """Runs external commands as asyncio subprocesses on one background event loop
+
+    run() may be called from any number of worker threads at once; each call
+    blocks its thread until the command exits while the loop reads every
+    child's pipes. stdout feeds a progress parser when one is given. All other
+    output goes to the directory's log file, and the last `tail_lines` lines
+    are kept in a ring buffer for the error message if the command fails.
+    Nothing is passed through to the terminal, so concurrent commands do not
+    interleave there.
+    """
+
+    def __init__(self, timeout: float | None = None, tail_lines: int = COMMAND_TAIL_LINES):
+        self.timeout = timeout
+        self.tail_lines = tail_lines
+        self.loop = asyncio.new_event_loop()
+        self._futures: set = set()
+        # tasks of the commands on the loop, only touched from the loop thread
+        self._tasks: set[asyncio.Task] = set()
+        # running child processes, and whether a CPU lease pins them
+        self._processes: dict[int, bool] = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="command-runner", daemon=True)
+        self._thread.start()
+
+    def run(self, cmd_list: list[str], error_message: str,
+            progress: FFmpegProgress | HandBrakeProgress | None = None,
+            cores: "CoreLease | None" = None, log_file: Path | None = None) -> None:
+        """Run a command to completion, see run_command"""
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(cmd_list, error_message, progress, cores, log_file), self.loop)
+        with self._lock:
+            self._futures.add(future)
+        try:
+            future.result()
+        except concurrent.futures.CancelledError:
+            raise RuntimeError(f"{error_message}: cancelled") from None
+        finally:
+            with self._lock:
+                self._futures.discard(future)
+
+    async def _run(self, cmd_list, error_message, progress, cores, log_file) -> None:
+        """Run a command on the event loop, as a task cancel_all() can find"""
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await self._execute(cmd_list, error_message, progress, cores, log_file)
+        finally:
+            self._tasks.discard(task)
+
+    async def _execute(self, cmd_list, error_message, progress, cores, log_file) -> None:
+        """Start a command, pump its output and wait for it"""
+        tail = deque(maxlen=self.tail_lines)
+        if log_file is not None:
+            log_file.parent.mkdir(parents=True, exist_ok=True)
+        log = open(log_file, "a", encoding="utf8", buffering=1) if log_file is not None else None
+
+        def record(line):
+            tail.append(line.rstrip())
+            if log is not None:
+                log.write(line)
+
+        try:
+            if log is not None:
+                log.write(f"$ {shlex.join(cmd_list)}\n")
+            # a cancelled spawn never finishes closing its half-connected
+            # pipes, so the spawn always completes and the process is killed
+            spawn = asyncio.ensure_future(asyncio.create_subprocess_exec(
+                *cmd_list, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                preexec_fn=child_limits(_limits, cores.cpus if cores is not None else None)))
+            try:
+                process = await asyncio.shield(spawn)
+            except OSError as e:
+                raise RuntimeError(f"{error_message}: {e}") from None
+            except asyncio.CancelledError:
+                try:
+                    process = await spawn
+                except OSError:
+                    raise asyncio.CancelledError from None
+                process.kill()
+                await process.wait()
+                raise
+            if cores is not None:
+                cores.attach(process.pid)
+            with self._lock:
+                self._processes[process.pid] = cores is not None
+            # the child set its limits before exec; this only reports what the kernel refused
+            apply_process_limits(process.pid, _limits, cores is not None)
+            try:
+                await asyncio.wait_for(asyncio.gather(
+                    _pump_lines(process.stdout, progress.feed if progress is not None else record),
+                    _pump_lines(process.stderr, record),
+                    process.wait(),
+                ), self.timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise RuntimeError(_command_error(f"{error_message}: timed out after {self.timeout:g}s",
+                                                  process.returncode, tail)) from None
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                raise
+            finally:
+                with self._lock:
+                    self._processes.pop(process.pid, None)
+                if cores is not None:
+                    cores.attach(None)
+            if process.returncode != 0:
+                raise RuntimeError(_command_error(error_message, process.returncode, tail))
+        finally:
+            if log is not None:
+                log.close()
+
+    def apply_limits(self, limits: "Limits") -> None:
+        """Apply changed limits to every running command
+
+        Args:
+            limits: New limits
+        """
+        with self._lock:
+            processes = list(self._processes.items())
+        for pid, pinned in processes:
+            apply_process_limits(pid, limits, pinned)
+
+    def cancel_all(self) -> None:
+        """Kill every running command and wait until they are reaped; their run() calls raise RuntimeError"""
+        async def cancel():
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(cancel(), self.loop).result()
+
+    def close(self) -> None:
+        """Kill any running commands and stop the event loop"""
+        self.cancel_all()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+async def _pump_lines(stream: asyncio.StreamReader, on_line: Callable[[str], None]) -> None:
+    """Pass every line of a child's pipe to a callback
+
+    Lines end at "\n" or "\r" (tools redraw status lines with "\r"), and
+    any length is accepted.
+    """
+    pending = b""
+    while True:
+        chunk = await stream.read(64 * 1024)
+        if not chunk:
+            break
+        pending += chunk
+        *lines, pending = re.split(rb"(?<=[\r\n])", pending)
+        for line in lines:
+            on_line(line.decode("utf8", errors="replace"))
+    if pending:
+        on_line(pending.decode("utf8", errors="replace"))
+
+
+# Runner used by run_command, configured by main() or started on first use
+_command_runner: CommandRunner | None = None
+_command_runner_lock = threading.Lock()
+
+# Set once the run is interrupted: workers stop taking directories and no
+# new commands are started
+_stopping = threading.Event()
+
+
+def set_command_runner(runner: CommandRunner | None) -> None:
+    """Set the runner run_command uses (None starts a default one when needed)
+
+    Setting a runner also starts accepting commands again after stop_run().
+
+    Args:
+        runner: CommandRunner to use, or None
+    """
+    global _command_runner
+    with _command_runner_lock:
+        _command_runner = runner
+        if runner is not None:
+            _stopping.clear()
+
+
+def command_runner() -> CommandRunner:
+    """Get the runner run_command uses, starting a default one on first use
+
+    Raises:
+        RuntimeError: If the run is being stopped
+    """
+    global _command_runner
+    with _command_runner_lock:
+        if _stopping.is_set():
+            raise RuntimeError("not started, the run is being stopped")
+        if _command_runner is None:
+            _command_runner = CommandRunner()
+        return _command_runner
+
+
+def stop_run() -> None:
+    """Stop the run on Ctrl-C: kill the running commands and refuse new ones"""
+    with _command_runner_lock:
+        _stopping.set()
+        runner = _command_runner
+    if runner is not None:
+        runner.cancel_all()
+
+
+def run_command(cmd_list: list[str], error_message: str,
+                progress: FFmpegProgress | HandBrakeProgress | None = None,
+                cores: "CoreLease | None" = None, log_file: Path | None = None) -> None:
     """Helper function to run subprocess commands with error handling
     
     Args:
-        cmd_list: List of command arguments to execute
-        error_message: Error message to raise if command fails
+        cmd_list: List of command arguments to execute
+        error_message: Error message to raise if command fails
+        progress: Parser fed with every line the command writes to stdout
+        cores: CPU lease the process is pinned to while it runs
+        log_file: File the command line and the command's output are appended to
+
+    Raises:
+        RuntimeError: If the command fails or times out, with the last lines it wrote
+    """
+    with trace_span("run_command", "command", command=Path(cmd_list[0]).name):
+        command_runner().run(cmd_list, error_message, progress, cores, log_file)
+
+
+def _optional_int(value) -> int | None:
+    """Convert an ffprobe field to int, returning None for missing or "N/A" values"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _optional_float(value) -> float | None:
+    """Convert an ffprobe field to float, returning None for missing or "N/A" values"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class StreamInfo:
+    """Codec parameters of a single stream as reported by ffprobe"""
+    index: int
+    codec_type: str
+    codec_name: str | None = None
+    profile: str | None = None
+    width: int | None = None
+    height: int | None = None
+    pix_fmt: str | None = None
+    r_frame_rate: str | None = None
+    time_base: str | None = None
+    sample_rate: int | None = None
+    channels: int | None = None
+    channel_layout: str | None = None
+    duration: float | None = None
+
+    @classmethod
+    def from_ffprobe(cls, stream: dict) -> "StreamInfo":
+        """Build a StreamInfo from one entry of ffprobe's "streams" array"""
+        return cls(
+            index=int(stream.get("index", 0)),
+            codec_type=stream.get("codec_type", "unknown"),
+            codec_name=stream.get("codec_name"),
+            profile=stream.get("profile"),
+            width=_optional_int(stream.get("width")),
+            height=_optional_int(stream.get("height")),
+            pix_fmt=stream.get("pix_fmt"),
+            r_frame_rate=stream.get("r_frame_rate"),
+            time_base=stream.get("time_base"),
+            sample_rate=_optional_int(stream.get("sample_rate")),
+            channels=_optional_int(stream.get("channels")),
+            channel_layout=stream.get("channel_layout"),
+            duration=_optional_float(stream.get("duration")),
+        )
+
+
+@dataclass
+class MediaInfo:
+    """Everything the tool needs to know about a media file, from a single ffprobe call"""
+    path: Path
+    duration: float
+    size: int
+    format_name: str
+    bit_rate: int | None
+    streams: list[StreamInfo]
+
+    @property
+    def video_streams(self) -> list[StreamInfo]:
+        """Video streams in file order"""
+        return [stream for stream in self.streams if stream.codec_type == "video"]
+
+    @property
+    def audio_streams(self) -> list[StreamInfo]:
+        """Audio streams in file order"""
+        return [stream for stream in self.streams if stream.codec_type == "audio"]
+
+    @classmethod
+    def from_ffprobe(cls, file_path: Path, data: dict) -> "MediaInfo":
+        """Build a MediaInfo from ffprobe's JSON output
+
+        Args:
+            file_path: Path of the probed file
+            data: Parsed output of ffprobe -show_format -show_streams -of json
+
+        Returns:
+            MediaInfo for the file
+        """
+        fmt = data.get("format", {})
+        streams = [StreamInfo.from_ffprobe(stream) for stream in data.get("streams", [])]
+
+        # fall back to the longest stream when the container has no duration
+        duration = _optional_float(fmt.get("duration"))
+        if duration is None:
+            stream_durations = [s.duration for s in streams if s.duration is not None]
+            if not stream_durations:
+                raise RuntimeError(f"Failed to parse duration for {file_path}: no duration reported")
+            duration = max(stream_durations)
+
+        size = _optional_int(fmt.get("size"))
+        return cls(
+            path=file_path,
+            duration=duration,
+            size=size if size is not None else file_path.stat().st_size,
+            format_name=fmt.get("format_name", ""),
+            bit_rate=_optional_int(fmt.get("bit_rate")),
+            streams=streams,
+        )
+
+
+def stream_signature(info: MediaInfo) -> list[tuple]:
+    """Codec parameters that have to agree for files to be stream-copy concatenated
+
+    Args:
+        info: Probed file
+
+    Returns:
+        One tuple per audio/video stream, in file order
+    """
+    return [
+        (stream.codec_type, stream.codec_name, stream.profile, stream.width, stream.height,
+         stream.pix_fmt, stream.sample_rate, stream.channels, stream.channel_layout)
+        for stream in info.streams if stream.codec_type in ("video", "audio")
+    ]
+
+
+def check_append_compatible(base: MediaInfo, additions: list[MediaInfo]) -> None:
+    """Make sure files can be stream-copied onto the end of an existing output
+
+    Args:
+        base: Probed output that is being appended to
+        additions: Probed files that would be appended
+
+    Raises:
+        RuntimeError: If any file's codec parameters differ from the base
+    """
+    expected = stream_signature(base)
+    for info in additions:
+        actual = stream_signature(info)
+        if actual != expected:
+            raise RuntimeError(
+                f"Cannot append {info.path.name} to {base.path.name}: codec parameters differ "
+                f"({actual} != {expected})"
+            )
+
+
+def describe_streams(info: MediaInfo) -> str:
+    """Short human readable summary of a file's stream parameters"""
+    parts = []
+    for stream in info.streams:
+        if stream.codec_type == "video":
+            parts.append(f"{stream.codec_name} {stream.profile or ''} {stream.width}x{stream.height} "
+                         f"{stream.pix_fmt}".replace("  ", " "))
+        elif stream.codec_type == "audio":
+            parts.append(f"{stream.codec_name} {stream.sample_rate}Hz {stream.channel_layout or stream.channels}")
+    return ", ".join(parts) or "no audio/video streams"
+
+
+def group_compatible(infos: list[MediaInfo]) -> list[list[MediaInfo]]:
+    """Split clips into runs that can be stream-copy concatenated together
+
+    Clips stay in order; a new group starts wherever the codec parameters
+    (stream_signature) change.
+
+    Args:
+        infos: Probed clips in concatenation order
+
+    Returns:
+        Consecutive groups of compatible clips
+    """
+    groups = []
+    for info in infos:
+        if groups and stream_signature(groups[-1][0]) == stream_signature(info):
+            groups[-1].append(info)
+        else:
+            groups.append([info])
+    return groups
+
+
+def _video_time_base(info: MediaInfo) -> str | None:
+    """Time base of a file's first video stream"""
+    return info.video_streams[0].time_base if info.video_streams else None
+
+
+def plan_remux(group: list[MediaInfo]) -> dict[str, int | None]:
+    """Find the clips of a compatible group that need a container remux first
+
+    The concat demuxer copies packets but not containers: clips in another
+    container (e.g. MPEG-TS named .mp4), or whose video track uses a
+    different timescale than the rest of the group, are stream-copied into
+    an MP4 with the group's timescale before concatenation.
+
+    Args:
+        group: Compatible clips from group_compatible
+
+    Returns:
+        Clip name -> video timescale to remux it to (None keeps the timescale)
+    """
+    time_bases = [_video_time_base(info) for info in group]
+    in_mp4 = [tb for info, tb in zip(group, time_bases) if "mp4" in info.format_name.split(",")]
+    # most common timescale among the MP4 clips, the earliest one on a tie
+    target = Counter(in_mp4 or time_bases).most_common(1)[0][0]
+    timescale = None
+    if target is not None and target.startswith("1/") and target[2:].isdigit():
+        timescale = int(target[2:])
+
+    remux = {}
+    for info, time_base in zip(group, time_bases):
+        if "mp4" not in info.format_name.split(",") or time_base != target:
+            remux[info.path.name] = timescale
+    return remux
+
+
+def remux_clip(source: Path, destination: Path, timescale: int | None, log_file: Path) -> None:
+    """Stream-copy a clip into a fresh MP4 container
+
+    Args:
+        source: Clip to remux
+        destination: MP4 file to write
+        timescale: Video track timescale to use, or None to keep the clip's own
+        log_file: Directory log to append ffmpeg's output to
+    """
+    destination.unlink(missing_ok=True)
+    cmd = ["ffmpeg", "-v", "error", "-i", str(source), "-map", "0:v?", "-map", "0:a?", "-c", "copy"]
+    if timescale is not None:
+        cmd.extend(["-video_track_timescale", str(timescale)])
+    cmd.extend(["-f", "mp4", str(destination)])
+    with trace_span("remux", "io", clip=source.name, bytes=source.stat().st_size):
+        run_command(cmd, f"FFmpeg remux of {source.name} failed", log_file=log_file)
+
+
+def default_cache_dir() -> Path:
+    """Get the per-user cache directory, following the XDG base directory spec
+
+    Returns:
+        Path to $XDG_CACHE_HOME/ffmpeg_handbrake_combo (or ~/.cache/ffmpeg_handbrake_combo)
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "ffmpeg_handbrake_combo"
+
+
+class ProbeCache:
+    """Persistent SQLite cache of ffprobe results
+
+    Entries are keyed by absolute path and only reused while the file's size
+    and modification time (in nanoseconds) are unchanged; a mismatch drops
+    the stale entry. The least recently used entries are evicted once the
+    cache holds more than max_entries files.
+    """
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path: Path, max_entries: int = PROBE_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            self._conn.execute("DROP TABLE IF EXISTS probes")
+            self._conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS probes ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, data TEXT, last_used REAL)"
+        )
+        self._conn.commit()
+
+    def get(self, file_path: Path, size: int, mtime_ns: int) -> dict | None:
+        """Look up the ffprobe output for a file
+
+        Args:
+            file_path: Absolute path of the file
+            size: Current st_size of the file
+            mtime_ns: Current st_mtime_ns of the file
+
+        Returns:
+            The cached ffprobe JSON, or None if missing or stale
+        """
+        key = str(file_path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, data FROM probes WHERE path = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if (row[0], row[1]) != (size, mtime_ns):
+                self._conn.execute("DELETE FROM probes WHERE path = ?", (key,))
+                self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE probes SET last_used = ? WHERE path = ?", (time.time(), key))
+            self.hits += 1
+        return json.loads(row[2])
+
+    def put(self, file_path: Path, size: int, mtime_ns: int, data: dict) -> None:
+        """Store the ffprobe output for a file
+
+        Args:
+            file_path: Absolute path of the file
+            size: st_size of the file when it was probed
+            mtime_ns: st_mtime_ns of the file when it was probed
+            data: Parsed ffprobe JSON output
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO probes (path, size, mtime_ns, data, last_used) VALUES (?, ?, ?, ?, ?)",
+                (str(file_path), size, mtime_ns, json.dumps(data), time.time())
+            )
+            self._conn.commit()
+
+    def prune(self) -> None:
+        """Evict the least recently used entries beyond max_entries"""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM probes WHERE path IN ("
+                "SELECT path FROM probes ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def close(self) -> None:
+        """Prune the cache and close the database"""
+        self.prune()
+        with self._lock:
+            self._conn.close()
+
+
+# Cache consulted by probe_media, configured by main() unless --no-cache is given
+_probe_cache: ProbeCache | None = None
+
+
+def set_probe_cache(cache: ProbeCache | None) -> None:
+    """Set the persistent cache used by probe_media (None disables caching)
+
+    Args:
+        cache: ProbeCache to use, or None
+    """
+    global _probe_cache
+    _probe_cache = cache
+
+
+def open_probe_cache(args: argparse.Namespace) -> ProbeCache | None:
+    """Open the probe cache requested on the command line
+
+    Args:
+        args: Command line arguments namespace containing no_cache and cache_path
+
+    Returns:
+        An open ProbeCache, or None if caching is disabled or unavailable
+    """
+    if args.no_cache:
+        return None
+    cache_path = Path(args.cache_path) if args.cache_path else default_cache_dir() / "probe_cache.sqlite"
+    try:
+        return ProbeCache(cache_path)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning("Probe cache unavailable (%s), continuing without it", e)
+        return None
+
+
+# Weight of the newest measurement in the throughput model's moving averages
+THROUGHPUT_EWMA_WEIGHT = 0.3
+
+# Throughput model key of stream-copy concatenation
+COPY_THROUGHPUT_KEY = "stream copy"
+
+
+class ThroughputModel:
+    """Persistent SQLite record of measured concat and encode throughput
+
+    Three kinds of rates are kept, each as an exponentially weighted moving
+    average so the model follows new hardware or settings within a few runs:
+
+    - "copy": bytes per second of stream-copy concatenation
+    - "encode_fps": source frames per second encoded, keyed by source codec,
+      resolution and encoder preset (see encode_throughput_key)
+    - "encode_bytes": input bytes per second encoded, keyed by preset only,
+      for predictions made before the clips are probed
+    """
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path: Path, weight: float = THROUGHPUT_EWMA_WEIGHT, read_only: bool = False):
+        self.path = path
+        self.weight = weight
+        self._lock = threading.Lock()
+        if read_only:
+            # only for looking at the estimates: nothing is created or migrated
+            self._conn = sqlite3.connect(f"{path.absolute().as_uri()}?mode=ro", uri=True,
+                                         check_same_thread=False)
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            self._conn.execute("DROP TABLE IF EXISTS rates")
+            self._conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rates ("
+            "kind TEXT, key TEXT, rate REAL, samples INTEGER, updated REAL, PRIMARY KEY (kind, key))"
+        )
+        self._conn.commit()
+
+    def record(self, kind: str, key: str, rate: float) -> None:
+        """Fold a measurement into the moving average for (kind, key)
+
+        Args:
+            kind: "copy", "encode_fps" or "encode_bytes"
+            key: What was measured, like a preset or COPY_THROUGHPUT_KEY
+            rate: Measured rate
+        """
+        if rate <= 0:
+            return
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT rate, samples FROM rates WHERE kind = ? AND key = ?", (kind, key)
+            ).fetchone()
+            if row is None:
+                rate, samples = rate, 1
+            else:
+                rate, samples = row[0] + self.weight * (rate - row[0]), row[1] + 1
+            self._conn.execute(
+                "INSERT OR REPLACE INTO rates (kind, key, rate, samples, updated) VALUES (?, ?, ?, ?, ?)",
+                (kind, key, rate, samples, time.time())
+            )
+            self._conn.commit()
+
+    def rate(self, kind: str, key: str) -> float | None:
+        """Current estimate for (kind, key), or None if it was never measured"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT rate FROM rates WHERE kind = ? AND key = ?", (kind, key)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def rows(self) -> list[tuple[str, str, float, int, float]]:
+        """Every estimate as (kind, key, rate, samples, updated), ordered by kind and key"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT kind, key, rate, samples, updated FROM rates ORDER BY kind, key"
+            ).fetchall()
+
+    def close(self) -> None:
+        """Close the database"""
+        with self._lock:
+            self._conn.close()
+
+
+# Model updated and consulted for predictions, configured by main() unless --no-history is given
+_throughput: ThroughputModel | None = None
+
+
+def set_throughput_model(model: ThroughputModel | None) -> None:
+    """Set the throughput model runs are recorded into (None disables it)
+
+    Args:
+        model: ThroughputModel to use, or None
+    """
+    global _throughput
+    _throughput = model
+
+
+def read_throughput(path: Path) -> list[tuple[str, str, float, int, float]]:
+    """Read the stored estimates for --show-throughput without creating or changing anything
+
+    Args:
+        path: Throughput database
+
+    Returns:
+        ThroughputModel.rows() of the database, empty if there is none or it cannot be read
+    """
+    if not path.exists():
+        return []
+    try:
+        model = ThroughputModel(path, read_only=True)
+    except sqlite3.Error:
+        return []
+    try:
+        return model.rows()
+    except sqlite3.Error:
+        # written by an older version, or not a throughput database at all
+        return []
+    finally:
+        model.close()
+
+
+def open_throughput_model(args: argparse.Namespace) -> ThroughputModel | None:
+    """Open the throughput model requested on the command line
+
+    Args:
+        args: Command line arguments namespace containing no_history
+
+    Returns:
+        An open ThroughputModel, or None if it is disabled or unavailable
+    """
+    if args.no_history:
+        return None
+    try:
+        return ThroughputModel(default_cache_dir() / "throughput.sqlite")
+    except (OSError, sqlite3.Error) as e:
+        logger.warning("Throughput history unavailable (%s), continuing without it", e)
+        return None
+
+
+def format_throughput(rows: Iterable[tuple[str, str, float, int, float]]) -> str:
+    """Render throughput model rows as a table for --show-throughput
+
+    Args:
+        rows: Rows from ThroughputModel.rows
+
+    Returns:
+        One line per row, or a note that nothing was measured yet
+    """
+    units = {"copy": ("MB/s", 1e6), "encode_bytes": ("MB/s", 1e6), "encode_fps": ("fps", 1.0)}
+    lines = []
+    for kind, key, rate, samples, updated in rows:
+        unit, scale = units.get(kind, ("", 1.0))
+        stamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(updated))
+        lines.append(f"{kind:<13} {key:<60} {rate / scale:>9.1f} {unit:<5} {samples:>5} runs  {stamp}")
+    return "\n".join(lines) if lines else "No throughput measured yet"
+
+
+def _run_ffprobe(file_path: Path) -> dict:
+    """Run ffprobe once and return its parsed JSON output
+
+    Args:
+        file_path: Path to the media file
+
+    Returns:
+        Parsed output of ffprobe -show_format -show_streams
+    """
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe", "-v", "error", "-show_format", "-show_streams",
+                "-of", "json", str(file_path)
+            ],
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        return json.loads(result.stdout)
+    except subprocess.CalledProcessError as e:
+        stderr_msg = e.stderr.strip() if e.stderr else "No error output"
+        raise RuntimeError(f"Failed to probe {file_path}: {stderr_msg}")
+    except ValueError as e:
+        raise RuntimeError(f"Failed to parse ffprobe output for {file_path}: {e}")
+
+
+def probe_media(file_path: Path, size: int | None = None, mtime_ns: int | None = None) -> MediaInfo:
+    """Read duration, size, codec parameters and stream layout with one ffprobe call
+
+    Results are served from the persistent probe cache when the file's size
+    and modification time are unchanged since it was last probed.
+
+    Args:
+        file_path: Path to the media file
+        size: Known st_size of the file, to avoid another stat() for the cache key
+        mtime_ns: Known st_mtime_ns of the file, to avoid another stat() for the cache key
+
+    Returns:
+        MediaInfo describing the file
+    """
+    with trace_span("probe", "probe", file=file_path.name, bytes=size) as span:
+        cache = _probe_cache
+        if cache is None:
+            return MediaInfo.from_ffprobe(file_path, _run_ffprobe(file_path))
+
+        absolute = file_path.absolute()
+        if size is None or mtime_ns is None:
+            st = absolute.stat()
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+        span["bytes"] = size
+        data = cache.get(absolute, size, mtime_ns)
+        span["cached"] = data is not None
+        if data is None:
+            data = _run_ffprobe(file_path)
+            info = MediaInfo.from_ffprobe(file_path, data)
+            cache.put(absolute, size, mtime_ns, data)
+            return info
+        return MediaInfo.from_ffprobe(file_path, data)
+
+
+def probe_files(files: list[Path | Clip], workers: int = DEFAULT_PROBE_WORKERS) -> list[MediaInfo]:
+    """Probe many files concurrently on a bounded thread pool
+
+    Clips found by scan_clips reuse their stat data for the cache key.
+
+    Args:
+        files: Paths or clips to probe
+        workers: Maximum number of ffprobe processes running at once
+
+    Returns:
+        MediaInfo for each file, in the same order as files
+    """
+    def probe(file):
+        if isinstance(file, Clip):
+            return probe_media(file.path, file.size, file.mtime_ns)
+        return probe_media(file)
+
+    workers = max(1, min(workers, len(files)))
+    if workers == 1:
+        return [probe(file) for file in files]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(probe, files))
+
+
+def get_video_duration(file_path: Path) -> float:
+    """Get video duration in seconds using ffprobe
+
+    Args:
+        file_path: Path to the video file
+
+    Returns:
+        Duration in seconds as a float
+    """
+    with trace_span("get_video_duration", "probe", file=file_path.name):
+        return probe_media(file_path).duration
+
+
+def measured_duration(file_path: Path, reported_duration: float | None, level: str = "standard",
+                      full_probe: bool = False) -> float | None:
+    """Get an output's duration, preferring what the encoder reported while writing it
+
+    The --verify level decides how far the reported duration is trusted:
+    "none" and "fast" never probe, "standard" probes only when nothing was
+    reported and "deep" always probes.
+
+    Args:
+        file_path: Output file
+        reported_duration: Duration taken from the tool's progress output, if any
+        level: --verify level
+        full_probe: Always probe the file instead of trusting reported_duration
+
+    Returns:
+        Duration in seconds, or None if nothing was reported and the level does not probe
+    """
+    if level in ("none", "fast"):
+        return reported_duration
+    if full_probe or level == "deep" or reported_duration is None:
+        return get_video_duration(file_path)
+    return reported_duration
+
+
+def check_durations(input_duration: float | None, output_duration: float | None, operation: str,
+                    level: str) -> None:
+    """Compare input and output durations when the --verify level asks for it
+
+    With "fast" a duration nobody reported is not checked rather than probed.
+
+    Args:
+        input_duration: Expected duration in seconds, if known
+        output_duration: Actual duration in seconds, if known
+        operation: Name of the operation being verified (for error messages)
+        level: --verify level
+    """
+    if level == "none":
+        return
+    if input_duration is None or output_duration is None:
+        logger.info("%s duration not reported, not checked with --verify %s", operation, level)
+        return
+    verify_duration_match(input_duration, output_duration, operation)
+
+
+def sample_decode(file_path: Path, duration: float | None, operation: str, log_file: Path | None = None,
+                  windows: int = DEEP_VERIFY_WINDOWS) -> None:
+    """Decode a few randomly placed short windows of a file to catch corrupt streams
+
+    The windows are decoded by parallel ffmpeg processes with -xerror, so
+    the first decoding error fails the check.
+
+    Args:
+        file_path: File to check
+        duration: Duration of the file, or None to probe it
+        operation: Name of the operation that wrote the file (for error messages)
+        log_file: Log the ffmpeg output is appended to
+        windows: Number of windows to decode
+
+    Raises:
+        RuntimeError: If any window fails to decode
+    """
+    if duration is None:
+        duration = get_video_duration(file_path)
+    # a short file has room for fewer windows
+    windows = max(1, min(windows, int(duration // DEEP_VERIFY_SECONDS)))
+    latest = max(0.0, duration - DEEP_VERIFY_SECONDS)
+    starts = sorted(random.uniform(0.0, latest) for _ in range(windows))
+
+    def decode(start: float) -> None:
+        with trace_span("sample_decode", "verify", file=file_path.name, start=start):
+            run_command([
+                "ffmpeg", "-nostdin", "-v", "error", "-xerror",
+                "-ss", f"{start:.3f}", "-i", str(file_path), "-t", f"{DEEP_VERIFY_SECONDS:g}",
+                "-map", "0:v?", "-map", "0:a?", "-f", "null", "-"
+            ], f"{operation} verification failed: {file_path.name} does not decode at {start:.1f}s",
+                log_file=log_file)
+
+    with ThreadPoolExecutor(max_workers=windows) as executor:
+        list(executor.map(decode, starts))
+    logger.info("Decoded %d samples of %s", windows, file_path.name)
+
+
+def verify_output_file(file_path: Path, operation: str) -> None:
+    """Verify that output file exists and has content
+    
+    Args:
+        file_path: Path to the output file to verify
+        operation: Name of the operation that created the file (for error messages)
+    """
+    if not file_path.exists():
+        raise RuntimeError(f"{operation} failed: output file {file_path} does not exist")
+    if file_path.stat().st_size == 0:
+        raise RuntimeError(f"{operation} failed: output file {file_path} is empty")
+
+
+def verify_duration_match(input_duration: float, output_duration: float, operation: str, tolerance: float = 1.0) -> None:
+    """Verify that output duration matches input duration within tolerance
+    
+    Args:
+        input_duration: Expected duration in seconds
+        output_duration: Actual duration in seconds
+        operation: Name of the operation being verified (for error messages)
+        tolerance: Maximum acceptable difference in seconds (default: 1.0)
+    """
+    logger.info("Input duration: %.3f seconds", input_duration)
+    logger.info("Output duration: %.3f seconds", output_duration)
+    
+    if abs(output_duration - input_duration) > tolerance:
+        raise RuntimeError(
+            f"{operation} verification failed: output duration ({output_duration:.3f}s) "
+            f"does not match input duration ({input_duration:.3f}s)"
+        )
+    
+    logger.info("Duration verification passed")
+
+
+def is_output_name(title: str, name: str) -> bool:
+    """Check whether a file is one the tool itself writes into a directory
+
+    Args:
+        title: Name of the directory
+        name: File name
+
+    Returns:
+        True for the concatenated and compressed outputs (including extra
+        parts, which start at "part 2") and their temporaries
+    """
+    t = re.escape(title)
+    temporary = r"(?:\.appending|\.chunk\d+(?:\.enc)?)?"
+    part = r"(?: part (?:[2-9]|[1-9]\d+))?"
+    pattern = rf"{t}{part}(?:\(cp\))?{temporary}\.mp4|{t}\.tail(?:\(cp\))?{temporary}\.mp4|{t}\.remux\..*"
+    return re.fullmatch(pattern, name, re.IGNORECASE) is not None
+
+
+def scan_clips(r_dir: Path, dropped: list[Clip] | None = None, skipped: list[str] | None = None) -> list[Clip]:
+    """Find the MP4 files in a directory that should be concatenated
+
+    Uses os.scandir so every file is stat'ed at most once; the sizes and
+    modification times are carried along for size totals and the probe cache.
+    Outputs of an earlier run (see is_output_name) are not clips.
+
+    Args:
+        r_dir: Directory to search for MP4 files
+        dropped: If given, MP4 files at or above the size limit are added to it
+        skipped: If given, the names of outputs of an earlier run are added to it
+
+    Returns:
+        Naturally sorted list of clips smaller than the size limit
+    """
+    clips = []
+
+    # loop through each file in current directory
+    with os.scandir(r_dir) as entries:
+        for entry in entries:
+            # Checks that file ends with ".mp4" (case insensitive)
+            if not entry.name.lower().endswith(".mp4") or not entry.is_file():
+                continue
+            if is_output_name(r_dir.name, entry.name):
+                if skipped is not None:
+                    skipped.append(entry.name)
+                continue
+            st = entry.stat()
+            clip = Clip(entry.name, r_dir / entry.name, st.st_size, st.st_mtime_ns)
+            # Checks that file is smaller than size limit
+            if st.st_size < DEFAULT_SIZE_LIMIT:
+                clips.append(clip)
+            elif dropped is not None:
+                dropped.append(clip)
+
+    # sorts clips using "natural sorting"
+    return natsorted(clips, key=lambda clip: clip.name)
+
+
+def _hash_file(path: Path, edge: int | None = None) -> str:
+    """BLAKE2b digest of a whole file, or of only its first and last `edge` bytes
+
+    Args:
+        path: File to hash
+        edge: Bytes to read at each end, or None to hash everything
+
+    Returns:
+        Hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        if edge is None:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        else:
+            digest.update(f.read(edge))
+            size = os.fstat(f.fileno()).st_size
+            if size > edge:
+                f.seek(max(edge, size - edge))
+                digest.update(f.read(edge))
+    return digest.hexdigest()
+
+
+def split_duplicates(clips: list[Clip]) -> tuple[list[Clip], list[tuple[Clip, Clip]]]:
+    """Separate byte-identical copies of a clip from the clips to concatenate
+
+    Only clips of the same size can be copies. Those are told apart by a
+    hash of their first and last DEDUP_EDGE_BYTES, and a full hash confirms
+    any match unless the edges already cover the whole file. Of each set of
+    copies the one with the shortest name is kept, so "GX010123.MP4" wins
+    over "GX010123 (1).MP4".
+
+    Args:
+        clips: Clips in concatenation order
+
+    Returns:
+        The clips without duplicates, and (duplicate, kept clip) pairs
+    """
+    by_size: dict[int, list[Clip]] = {}
+    for clip in clips:
+        by_size.setdefault(clip.size, []).append(clip)
+
+    originals: dict[str, Clip] = {}
+    for size, same_size in by_size.items():
+        if len(same_size) < 2:
+            continue
+        by_edges: dict[str, list[Clip]] = {}
+        for clip in same_size:
+            by_edges.setdefault(_hash_file(clip.path, DEDUP_EDGE_BYTES), []).append(clip)
+        for candidates in by_edges.values():
+            if len(candidates) < 2:
+                continue
+            if size <= 2 * DEDUP_EDGE_BYTES:
+                groups = [candidates]
+            else:
+                by_content: dict[str, list[Clip]] = {}
+                for clip in candidates:
+                    by_content.setdefault(_hash_file(clip.path), []).append(clip)
+                groups = list(by_content.values())
+            for group in groups:
+                original = min(group, key=lambda clip: len(clip.name))
+                for duplicate in group:
+                    if duplicate is not original:
+                        originals[duplicate.name] = original
+
+    kept = [clip for clip in clips if clip.name not in originals]
+    duplicates = [(clip, originals[clip.name]) for clip in clips if clip.name in originals]
+    return kept, duplicates
+
+
+def unique_destination(path: Path) -> Path:
+    """Pick a path that does not exist yet by appending a counter to the name
+
+    Args:
+        path: Preferred destination path
+
+    Returns:
+        The preferred path, or "<name> (N)" if it is already taken
+    """
+    candidate = path
+    counter = 2
+    while candidate.exists():
+        candidate = path.with_name(f"{path.name} ({counter})")
+        counter += 1
+    return candidate
+
+
+# ioctl that makes a file share another file's extents (Linux, <linux/fs.h>)
+FICLONE = 0x40049409
+
+
+@dataclass
+class RelocationStats:
+    """How files were moved into the archive"""
+    renamed: int = 0
+    reflinked: int = 0
+    copy_range: int = 0
+    copied: int = 0
+    bytes_copied: int = 0
+
+    @property
+    def files(self) -> int:
+        """Number of files relocated"""
+        return self.renamed + self.reflinked + self.copy_range + self.copied
+
+    def add(self, other: "RelocationStats") -> None:
+        """Add another directory's counts to these"""
+        self.renamed += other.renamed
+        self.reflinked += other.reflinked
+        self.copy_range += other.copy_range
+        self.copied += other.copied
+        self.bytes_copied += other.bytes_copied
+
+
+def _copy_file(source: Path, destination: Path) -> str:
+    """Copy a file's data as cheaply as the filesystems allow
+
+    Tries a reflink first, which shares the extents instead of copying them
+    (btrfs/XFS subvolumes and bind mounts of one filesystem), then
+    copy_file_range, which copies in the kernel, then a plain read/write copy.
+
+    Args:
+        source: File to copy
+        destination: New file to create (must not exist)
+
+    Returns:
+        "reflinked", "copy_range" or "copied"
+    """
+    with open(source, "rb") as src, open(destination, "xb") as dst:
+        try:
+            import fcntl
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return "reflinked"
+        except (ImportError, OSError):
+            pass
+
+        size = os.fstat(src.fileno()).st_size
+        if hasattr(os, "copy_file_range"):
+            try:
+                copied = 0
+                while copied < size:
+                    n = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+                if copied == size:
+                    return "copy_range"
+            except OSError:
+                pass
+            # start over with a plain copy from wherever copy_file_range stopped
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+        return "copied"
+
+
+def relocate_files(sources: list[Path], destination_dir: Path) -> RelocationStats:
+    """Move files into a directory with as little data copying as possible
+
+    Each file is renamed straight into place when it is on the same device as
+    the destination. Otherwise (different mounts, or a rename refused with
+    EXDEV across bind mounts) it is reflinked or copied and the original
+    removed once the copy is complete.
+
+    Args:
+        sources: Files to move
+        destination_dir: Existing directory to move them into
+
+    Returns:
+        Counts of how each file was moved
+    """
+    stats = RelocationStats()
+    destination_dev = destination_dir.stat().st_dev
+    for source in sources:
+        destination = destination_dir / source.name
+        st = source.stat()
+        if st.st_dev == destination_dev:
+            try:
+                os.rename(source, destination)
+                stats.renamed += 1
+                continue
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+
+        try:
+            method = _copy_file(source, destination)
+            shutil.copystat(source, destination)
+        except BaseException:
+            destination.unlink(missing_ok=True)
+            raise
+        source.unlink()
+        setattr(stats, method, getattr(stats, method) + 1)
+        if method != "reflinked":
+            stats.bytes_copied += st.st_size
+    return stats
+
+
+@dataclass
+class JournalState:
+    """Progress of one directory as recorded in the run journal"""
+    done: list[str] = field(default_factory=list)
+    in_progress: str | None = None
+    clips: list[Clip] | None = None
+    duplicates: list[Clip] = field(default_factory=list)
+    output_duration: float | None = None
+    append: bool = False
+    append_compressed: bool = False
+    group_sizes: list[int] = field(default_factory=list)
+    archive_dir: str | None = None
+
+    @property
+    def finished(self) -> bool:
+        """True once the last stage completed"""
+        return "finalize" in self.done
+
+
+class RunJournal:
+    """Append-only, fsync'ed JSON-lines record of each directory's progress
+
+    Every stage writes a "start" record before it runs and a "done" (or
+    "failed") record after it, so after a crash the journal tells which
+    stage each directory reached. The concat start record carries the clip
+    list, because the clips are moved away once archived.
+    """
+
+    def __init__(self, path: Path, resume: bool = False):
+        self.path = path
+        self._lock = threading.Lock()
+        states = self.load(path) if path.exists() else {}
+        unfinished = [directory for directory, state in states.items() if not state.finished]
+        self._states = states if resume else {}
+        if unfinished and not resume:
+            # a fresh run must not wipe what a later --resume still needs
+            logger.warning("Keeping the journal of %d unfinished director%s in %s for --resume",
+                           len(unfinished), "y" if len(unfinished) == 1 else "ies", path)
+        # a fresh run starts a new journal, unless the old one is still needed
+        self._file = open(path, "a" if resume or unfinished else "w", encoding="utf8")
+
+    @staticmethod
+    def load(path: Path) -> dict[str, JournalState]:
+        """Read a journal into the latest state of every directory
+
+        Args:
+            path: Journal file
+
+        Returns:
+            Mapping of directory path to JournalState
+        """
+        states: dict[str, JournalState] = {}
+        with open(path, encoding="utf8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a torn last line from a crash is expected
+                    continue
+                directory, stage, status = record.get("directory"), record.get("stage"), record.get("status")
+                if directory is None:
+                    continue
+                if stage == "concat" and status == "start":
+                    # a new attempt at the directory supersedes anything older
+                    states[directory] = JournalState(clips=[
+                        Clip(name, Path(directory) / name, size, mtime_ns)
+                        for name, size, mtime_ns in record.get("clips", [])
+                    ], duplicates=[
+                        Clip(name, Path(directory) / name, size, mtime_ns)
+                        for name, size, mtime_ns in record.get("duplicates", [])
+                    ], append=record.get("append", False),
+                       append_compressed=record.get("append_compressed", False),
+                       group_sizes=record.get("groups", []))
+                state = states.setdefault(directory, JournalState())
+                if status == "start":
+                    state.in_progress = stage
+                elif status == "done":
+                    # steps inside a stage (like "join") finish while it is still running
+                    if state.in_progress == stage:
+                        state.in_progress = None
+                    if stage not in state.done:
+                        state.done.append(stage)
+                    if "output_duration" in record:
+                        state.output_duration = record["output_duration"]
+                if "archive_dir" in record:
+                    state.archive_dir = record["archive_dir"]
+        return states
+
+    def state(self, directory: Path) -> JournalState | None:
+        """Get the recorded state of a directory from the journal this run resumed
+
+        Args:
+            directory: Leaf directory
+
+        Returns:
+            JournalState, or None if the directory was never started
+        """
+        return self._states.get(str(directory))
+
+    def record(self, directory: Path, stage: str, status: str, **data) -> None:
+        """Append one record and fsync it to disk
+
+        Args:
+            directory: Leaf directory the record is about
+            stage: Stage name
+            status: "start", "done", "failed" or "claimed" (the archive folder a stage took)
+            **data: Extra values stored with the record
+        """
+        entry = {"ts": time.time(), "directory": str(directory), "stage": stage, "status": status, **data}
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        """Close the journal file"""
+        with self._lock:
+            self._file.close()
+
+
+# Journal that stages record into, configured by main()
+_journal: RunJournal | None = None
+
+
+def set_journal(journal: RunJournal | None) -> None:
+    """Set the run journal stages record their progress into (None disables it)
+
+    Args:
+        journal: RunJournal to use, or None
+    """
+    global _journal
+    _journal = journal
+
+
+def _journal_data(stage: str, status: str, job: "DirectoryJob") -> dict:
+    """Extra values stored with a journal record, needed to resume later
+
+    Args:
+        stage: Stage name
+        status: Record status
+        job: Directory job being recorded
+
+    Returns:
+        Values to store with the record
+    """
+    if stage == "concat" and status == "start":
+        return {"clips": [[clip.name, clip.size, clip.mtime_ns] for clip in job.clips],
+                "duplicates": [[clip.name, clip.size, clip.mtime_ns] for clip in job.duplicates],
+                "append": job.append, "append_compressed": job.append_compressed,
+                "groups": job.group_sizes}
+    if stage == "verify" and status == "done":
+        return {"output_duration": job.output_duration}
+    return {}
+
+
+def single_pass_encode(args: argparse.Namespace) -> bool:
+    """Check whether concatenation and compression run as one ffmpeg process
+
+    With -c and -d the uncompressed output is only an intermediate file, so
+    an ffmpeg encoder reads the clips through the concat demuxer and writes
+    the compressed output directly.
+
+    Args:
+        args: Command line arguments namespace containing c, d and encoder
+
+    Returns:
+        True if an ffmpeg encoder is selected together with -c and -d, and
+        --chunks does not need the concatenated file to split
+    """
+    return args.c and args.d and args.encoder != "handbrake" and args.chunks <= 1
+
+
+@dataclass
+class DirectoryJob:
+    """State of one leaf directory as it moves through the processing stages"""
+    root: Path
+    directory: Path
+    args: argparse.Namespace
+    clips: list[Clip]
+    output_duration: float | None = None
+    reported_durations: list[float | None] = field(default_factory=list)
+    done_stages: set[str] = field(default_factory=set)
+    started: float = field(default_factory=time.monotonic)
+    # --append: the clips are joined onto an existing output instead of
+    # replacing it, and with append_compressed only they get compressed
+    append: bool = False
+    append_compressed: bool = False
+    relocation: RelocationStats | None = None
+    # set by the preflight stage: clips per output when the clips had to be
+    # split into compatible groups (empty for a single output), the clips
+    # that need a remux first, and the probe results
+    group_sizes: list[int] = field(default_factory=list)
+    remux: dict[str, int | None] = field(default_factory=dict)
+    clip_infos: list[MediaInfo] | None = None
+    # wall time spent verifying outputs, for the run summary
+    verify_seconds: float = 0.0
+    # copies of clips left out of the concatenation, archived with the clips
+    duplicates: list[Clip] = field(default_factory=list)
+    # folder in the archive claimed by the archive stage, reused on --resume
+    archive_dir: Path | None = None
+    # --scratch: local folder holding copies of the clips and the outputs
+    # until the finalize stage moves the outputs into the directory
+    work_dir: Path | None = None
+
+    @property
+    def single_pass(self) -> bool:
+        """Whether the concat stage encodes straight into the final output"""
+        return single_pass_encode(self.args) and not self.append
+
+    @property
+    def title(self) -> str:
+        """Name of the directory, used to name the outputs"""
+        return self.directory.name
+
+    @property
+    def filelist(self) -> list[str]:
+        """Names of the clips being concatenated, in order"""
+        return [clip.name for clip in self.clips]
+
+    @property
+    def clip_bytes(self) -> int:
+        """Combined size of the clips being concatenated"""
+        return sum(clip.size for clip in self.clips)
+
+    @property
+    def log_file(self) -> Path:
+        """Log of the ffmpeg/HandBrake output for this directory"""
+        return directory_log(self.root, self.directory)
+
+    @property
+    def work_directory(self) -> Path:
+        """Directory the clips are read from and the outputs written to"""
+        return self.work_dir if self.work_dir is not None else self.directory
+
+    @property
+    def output_file(self) -> Path:
+        """Concatenated output file"""
+        return self.work_directory / f"{self.title}.mp4"
+
+    @property
+    def compressed_file(self) -> Path:
+        """Compressed output file"""
+        return self.work_directory / f"{self.title}(cp).mp4"
+
+    @property
+    def groups(self) -> list[list[Clip]]:
+        """Clips of each output, in order"""
+        if not self.group_sizes:
+            return [self.clips]
+        groups, start = [], 0
+        for size in self.group_sizes:
+            groups.append(self.clips[start:start + size])
+            start += size
+        return groups
+
+    def part_output(self, index: int) -> Path:
+        """File the concat stage writes for the clips of one group"""
+        if index == 0:
+            return self.concat_output
+        return self.work_directory / f"{self.title} part {index + 1}.mp4"
+
+    def remux_file(self, clip_name: str) -> Path:
+        """Temporary remuxed copy of a clip, used for concatenation"""
+        return self.work_directory / f"{self.title}.remux.{clip_name}"
+
+    def part_compressed(self, index: int) -> Path:
+        """File the compress stage writes for one group's output"""
+        if index == 0:
+            return self.compress_output
+        return self.work_directory / f"{self.title} part {index + 1}(cp).mp4"
+
+    def existing_outputs(self) -> list[Path]:
+        """Outputs of the concat and compress stages that exist right now"""
+        paths = []
+        for index in range(len(self.groups)):
+            paths.extend([self.part_output(index), self.part_compressed(index)])
+        return [path for path in paths if path.exists()]
+
+    @property
+    def tail_file(self) -> Path:
+        """New clips concatenated on their own, before being appended"""
+        return self.work_directory / f"{self.title}.tail.mp4"
+
+    @property
+    def compressed_tail_file(self) -> Path:
+        """Compressed tail, before being appended to the compressed output"""
+        return self.work_directory / f"{self.title}.tail(cp).mp4"
+
+    @property
+    def concat_output(self) -> Path:
+        """File the concat stage writes"""
+        return self.tail_file if self.append else self.output_file
+
+    @property
+    def append_base(self) -> Path | None:
+        """Existing uncompressed output the tail is appended to
+
+        With -c and -d the existing output is the compressed one, so there is
+        no uncompressed output to extend.
+        """
+        if not self.append or (self.args.c and self.args.d):
+            return None
+        return self.output_file
+
+    @property
+    def compressed_base(self) -> Path | None:
+        """Existing compressed output the compressed tail is appended to"""
+        if not self.append_compressed:
+            return None
+        return self.output_file if self.args.d else self.compressed_file
+
+    @property
+    def compress_input(self) -> Path:
+        """File the compress stage encodes"""
+        return self.tail_file if self.append_compressed else self.output_file
+
+    @property
+    def compress_output(self) -> Path:
+        """File the compress stage writes"""
+        return self.compressed_tail_file if self.append_compressed else self.compressed_file
+
+
+def prepare_job(root: Path, r_dir: Path, args: argparse.Namespace,
+                dropped: list[Clip] | None = None) -> DirectoryJob | None:
+    """Find the clips in a directory and set up its job
+
+    Args:
+        root: Root directory path for organizing output files
+        r_dir: Directory containing MP4 files to concatenate
+        args: Command line arguments namespace
+        dropped: If given, MP4 files too large to concatenate are added to it (see scan_clips)
+
+    Returns:
+        DirectoryJob, or None if the directory has no MP4 files
+    """
+    state = _journal.state(r_dir) if _journal is not None and args.resume else None
+    if state is not None:
+        job = resume_job(root, r_dir, args, state)
+        if job is not None or state.finished:
+            return job
+
+    # find files that will be concatenated
+    skipped = []
+    clips = scan_clips(r_dir, dropped, skipped)
+    # (the main outputs are checked for below)
+    for name in skipped:
+        if name.lower() not in (f"{r_dir.name}.mp4".lower(), f"{r_dir.name}(cp).mp4".lower()):
+            logger.warning("Skipping %s in %s, it is named like an output of an earlier run", name, r_dir)
+
+    # Check if any MP4 files were found
+    if not clips:
+        logger.warning("No MP4 files found in %s, skipping", r_dir)
+        return None
+
+    job = DirectoryJob(root, r_dir, args, clips)
+    # with --scratch the local copies are hashed instead, in the preflight stage
+    if _stager is None:
+        drop_duplicates(job)
+    if job.output_file.exists():
+        if not args.append:
+            raise RuntimeError(f"{job.output_file.name} already exists, use --append to add the new clips to it")
+        plan_append(job)
+    return job
+
+
+def drop_duplicates(job: DirectoryJob) -> None:
+    """Leave clips the offload copied twice out of a job, unless --keep-duplicates is given
+
+    The duplicates are kept on the job so the archive stage moves (or -d
+    deletes) them along with the clips.
+
+    Args:
+        job: Directory job whose clips should be checked
+    """
+    if job.args.keep_duplicates:
+        return
+    with trace_span("dedup", "io", directory=job.title, files=len(job.clips)):
+        job.clips, duplicates = split_duplicates(job.clips)
+    for duplicate, original in duplicates:
+        logger.warning("Skipping %s in %s, it is a copy of %s", duplicate.name, job.directory, original.name)
+    job.duplicates.extend(duplicate for duplicate, _ in duplicates)
+
+
+def plan_append(job: DirectoryJob) -> None:
+    """Set up a job to add its clips to the directory's existing output
+
+    The new clips are concatenated into a tail file that is then stream-copied
+    onto the existing output. With -c the tail is compressed on its own and
+    joined onto the existing compressed output, so nothing already in the
+    output gets encoded again.
+
+    Args:
+        job: Job for a directory that already has an output
+
+    Raises:
+        RuntimeError: If the new clips cannot be stream-copied onto the existing output
+    """
+    args = job.args
+    job.append = True
+    # with -c and -d the existing output is the compressed one; with only -c
+    # an earlier run without -c may not have left a compressed output, in
+    # which case the whole extended output gets compressed
+    job.append_compressed = args.c and (args.d or job.compressed_file.exists())
+
+    if job.append_base is not None:
+        base_info, *clip_infos = probe_files([job.append_base, *(clip.path for clip in job.clips)],
+                                             args.probe_workers)
+        check_append_compatible(base_info, clip_infos)
+    if not args.c and job.compressed_file.exists():
+        logger.warning("%s will not include the new clips without -c", job.compressed_file.name)
+    logger.info("Appending %d new clip(s) to %s", len(job.clips),
+                (job.append_base or job.compressed_base).name)
+
+
+def resume_job(root: Path, r_dir: Path, args: argparse.Namespace, state: JournalState) -> DirectoryJob | None:
+    """Rebuild a directory's job from its journal entry
+
+    Partial outputs left by the interrupted stage are removed so the stage
+    can run again from the start.
+
+    Args:
+        root: Root directory path for organizing output files
+        r_dir: Directory being resumed
+        args: Command line arguments namespace
+        state: Journal state of the directory
+
+    Returns:
+        DirectoryJob continuing after the last completed stage, or None if
+        the directory is finished or has to start over from a fresh scan
+    """
+    if state.finished:
+        logger.info("Skipping %s, finished in an earlier run", r_dir)
+        return None
+
+    job = DirectoryJob(root, r_dir, args, state.clips or [], output_duration=state.output_duration,
+                       done_stages=set(state.done), append=state.append,
+                       append_compressed=state.append_compressed, group_sizes=state.group_sizes,
+                       duplicates=state.duplicates,
+                       archive_dir=Path(state.archive_dir) if state.archive_dir is not None else None)
+    if "concat" not in state.done:
+        # concatenation never finished: throw away the half-written outputs
+        # and start over with whatever clips are in the directory now
+        if state.in_progress == "concat":
+            leftovers = [job.part_output(index) for index in range(len(job.groups))]
+            leftovers += [job.remux_file(clip.name) for clip in job.clips] + [r_dir / "files.txt"]
+            for leftover in leftovers:
+                if leftover.exists():
+                    logger.info("Removing partial output %s", leftover)
+                    leftover.unlink()
+        return None
+
+    if state.in_progress == "compress":
+        for index in range(len(job.groups)):
+            remove_chunk_files(job.part_compressed(index))
+            if job.part_compressed(index).exists():
+                logger.info("Removing partial output %s", job.part_compressed(index))
+                job.part_compressed(index).unlink()
+        if job.append_compressed:
+            remove_chunk_files(job.compressed_tail_file)
+    logger.info("Resuming %s after %s", r_dir, ", ".join(stage for stage, _ in PIPELINE_STAGES
+                                                         if stage in state.done))
+    return job
+
+
+def _file_size(path: Path | None) -> int:
+    """Size of a file, or 0 if there is no file"""
+    try:
+        return path.stat().st_size if path is not None else 0
+    except FileNotFoundError:
+        return 0
+
+
+def estimate_peak_bytes(job: DirectoryJob) -> int:
+    """Estimate the most extra disk space a directory needs at any point
+
+    Walks the stages: concatenation writes a copy of the clips, compression
+    adds an output of about COMPRESSED_SIZE_RATIO of its input (plus a copy
+    of that input in segments with --chunks) and finalize removes the
+    uncompressed copy again. With --append, joining writes the extended
+    output beside the existing one before replacing it. -d gives the clips'
+    space back only in the finalize stage, after the peak.
+
+    Args:
+        job: Directory job to plan
+
+    Returns:
+        Estimated peak of additional bytes used on the directory's filesystem
+    """
+    args = job.args
+    clips = job.clip_bytes
+    # --chunks stream-copies the file being compressed into segments first
+    chunking = args.c and args.chunks > 1
+
+    if job.single_pass:
+        # only the compressed output is written, while the clips still exist
+        return int(clips * COMPRESSED_SIZE_RATIO)
+    if not job.append:
+        compressed = int(clips * COMPRESSED_SIZE_RATIO) if args.c else 0
+        return clips + compressed + (clips if chunking else 0)
+
+    # the tail, then a joined copy of base + tail while the base still exists
+    level = peak = clips
+    if job.append_base is not None:
+        peak = level + _file_size(job.append_base) + clips
+        level += clips
+    if args.c:
+        if job.append_compressed:
+            compressed = int(clips * COMPRESSED_SIZE_RATIO)
+            peak = max(peak, level + compressed + _file_size(job.compressed_base) + compressed,
+                       level + (clips + compressed if chunking else 0))
+        else:
+            extended = _file_size(job.append_base) + clips
+            peak = max(peak, level + int(extended * COMPRESSED_SIZE_RATIO) + (extended if chunking else 0))
+    return peak
+
+
+class DiskPlanner:
+    """Admits directories only when their estimated peak disk use fits in free space
+
+    Free space comes from statvfs on the directory's filesystem. Directories
+    already in the pipeline hold a reservation of their own estimate until
+    they finish, so together they never plan to use more than is free.
+    Reservations are kept while the written files already show up in
+    statvfs, which errs on the side of waiting.
+    """
+
+    def __init__(self, min_free: int = 0):
+        self.min_free = min_free
+        self._cond = threading.Condition()
+        self._reserved: dict[int, int] = {}
+        self._jobs: dict[Path, tuple[int, int]] = {}
+
+    def free_bytes(self, path: Path) -> int:
+        """Space available to this user on path's filesystem, minus the safety margin"""
+        st = os.statvfs(path)
+        return st.f_bavail * st.f_frsize - self.min_free
+
+    def admit(self, job: DirectoryJob) -> None:
+        """Reserve a directory's space, waiting while directories in progress hold it
+
+        Args:
+            job: Directory job about to enter the pipeline
+
+        Raises:
+            RuntimeError: If the directory does not fit even once nothing else is running
+        """
+        need = estimate_peak_bytes(job)
+        device = job.directory.stat().st_dev
+        with self._cond:
+            waiting = False
+            while True:
+                free = self.free_bytes(job.directory)
+                reserved = self._reserved.get(device, 0)
+                if need <= free - reserved:
+                    self._reserved[device] = reserved + need
+                    self._jobs[job.directory] = (device, need)
+                    return
+                if reserved == 0 or need > free:
+                    raise RuntimeError(f"Not enough free space: needs about {need} bytes, "
+                                       f"{max(free, 0)} available")
+                if not waiting:
+                    logger.info("Waiting for disk space for %s (needs about %d bytes)", job.directory, need)
+                    waiting = True
+                self._cond.wait()
+
+    def release(self, job: DirectoryJob) -> None:
+        """Give back a finished (or failed) directory's reservation
+
+        Args:
+            job: Directory job that left the pipeline
+        """
+        with self._cond:
+            entry = self._jobs.pop(job.directory, None)
+            if entry is not None:
+                device, need = entry
+                self._reserved[device] -= need
+                self._cond.notify_all()
+
+
+class ScratchStager:
+    """Copies directories' clips to a local scratch volume before they are processed
+
+    With --scratch each directory gets its own folder under the scratch
+    root. The fetch stage copies the clips into it while the directories
+    ahead of it are still being processed, the outputs are written there,
+    and the finalize stage moves only the final outputs back next to the
+    clips. Staged directories hold their clip bytes plus their estimated
+    peak output (see estimate_peak_bytes) until they leave the pipeline,
+    and together never more than `capacity`.
+    """
+
+    def __init__(self, root: Path, capacity: int):
+        self.root = root
+        self.capacity = capacity
+        self._cond = threading.Condition()
+        self._staged: dict[Path, int] = {}
+
+    @property
+    def used(self) -> int:
+        """Bytes held by the directories staged right now"""
+        return sum(self._staged.values())
+
+    def stage(self, job: DirectoryJob) -> None:
+        """Reserve scratch space for a directory, waiting while others hold it, and copy its clips
+
+        Args:
+            job: Directory job to stage; its work_dir is set to the scratch folder
+
+        Raises:
+            RuntimeError: If the directory does not fit in the scratch capacity at all
+        """
+        need = job.clip_bytes + estimate_peak_bytes(job)
+        if need > self.capacity:
+            raise RuntimeError(f"Not enough scratch space: needs about {need} bytes, {self.capacity} available")
+        with self._cond:
+            waiting = False
+            while self._staged and self.used + need > self.capacity:
+                if not waiting:
+                    logger.info("Waiting for scratch space for %s (needs about %d bytes)", job.directory, need)
+                    waiting = True
+                self._cond.wait()
+            self._staged[job.directory] = need
+
+        work_dir = Path(tempfile.mkdtemp(prefix=f"{job.title}.", dir=self.root))
+        job.work_dir = work_dir
+        with trace_span("stage_in", "io", directory=job.title, files=len(job.clips), bytes=job.clip_bytes):
+            for clip in job.clips:
+                _copy_file(clip.path, work_dir / clip.name)
+        # later stages probe and hash the local copies, not the share
+        job.clips = [replace(clip, path=work_dir / clip.name) for clip in job.clips]
+        logger.info("Staged %d clip(s) of %s in %s", len(job.clips), job.directory, work_dir)
+
+    def release(self, job: DirectoryJob) -> None:
+        """Remove a finished (or failed) directory's scratch folder and give back its space
+
+        A folder that still holds outputs, because a stage after the
+        concatenation failed, is kept so they are not lost.
+
+        Args:
+            job: Directory job that left the pipeline
+        """
+        if job.work_dir is not None:
+            if job.existing_outputs():
+                logger.warning("Kept scratch folder %s, it still holds outputs of %s", job.work_dir, job.directory)
+            else:
+                shutil.rmtree(job.work_dir, ignore_errors=True)
+        with self._cond:
+            if self._staged.pop(job.directory, None) is not None:
+                self._cond.notify_all()
+
+
+# Stager that copies clips to local scratch space, configured by main() with --scratch
+_stager: ScratchStager | None = None
+
+
+def set_scratch_stager(stager: ScratchStager | None) -> None:
+    """Set the stager the fetch stage copies clips with (None processes clips in place)
+
+    Args:
+        stager: ScratchStager to use, or None
+    """
+    global _stager
+    _stager = stager
+
+
+# Planner that admits directories by free space, configured by main()
+_disk_planner: DiskPlanner | None = None
+
+
+def set_disk_planner(planner: DiskPlanner | None) -> None:
+    """Set the planner directories are admitted through (None disables the check)
+
+    Args:
+        planner: DiskPlanner to use, or None
+    """
+    global _disk_planner
+    _disk_planner = planner
+
+
+def admit_job(job: DirectoryJob) -> None:
+    """Reserve disk space for a job if a planner is configured, and add it to the progress"""
+    if _disk_planner is not None:
+        _disk_planner.admit(job)
+    if _progress is not None:
+        _progress.add_job(job)
+
+
+def skip_progress(directory: Path) -> None:
+    """Take a directory that will not be processed out of the progress, if a reporter is configured"""
+    if _progress is not None:
+        _progress.skip(directory)
+
+
+def release_job(job: DirectoryJob) -> None:
+    """Release a job's disk space reservation and scratch folder, and finish its progress"""
+    if _disk_planner is not None:
+        _disk_planner.release(job)
+    if _stager is not None:
+        _stager.release(job)
+    if _progress is not None:
+        _progress.finish_job(job)
+
+
+def cgroup_cpu_limit() -> float | None:
+    """Read the CPU quota of this process's cgroup, in cores
+
+    Looks at cgroup v2 (cpu.max) first, then cgroup v1 (cpu.cfs_quota_us).
+
+    Returns:
+        Quota divided by period, or None if there is no quota
+    """
+    for quota_file, period_file in [("/sys/fs/cgroup/cpu.max", None),
+                                    ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us")]:
+        try:
+            with open(quota_file, encoding="utf8") as f:
+                fields = f.read().split()
+            if period_file is not None:
+                with open(period_file, encoding="utf8") as f:
+                    fields.append(f.read().strip())
+        except OSError:
+            continue
+        quota, period = _optional_int(fields[0]), _optional_int(fields[1]) if len(fields) > 1 else None
+        # "max" (v2) and -1 (v1) mean no quota
+        if quota is None or quota <= 0 or not period:
+            return None
+        return quota / period
+    return None
+
+
+def available_cpus() -> list[int] | None:
+    """Find the CPUs encoders may run on
+
+    Starts from this process's affinity mask and keeps only as many CPUs as
+    the cgroup CPU quota allows, since pinning more processes than that
+    would only make them wait for quota.
+
+    Returns:
+        Sorted CPU numbers, or None where affinity cannot be set (not Linux)
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = cpus[:max(1, int(limit))]
+    return cpus
+
+
+def partition_cpus(cpus: list[int], count: int) -> list[list[int]]:
+    """Split CPUs into contiguous, nearly equal shares
+
+    Args:
+        cpus: CPUs to split
+        count: Number of shares
+
+    Returns:
+        One list per share; with more shares than CPUs, shares get one CPU
+        each and take turns on them
+    """
+    if count > len(cpus):
+        return [[cpus[index % len(cpus)]] for index in range(count)]
+    size, extra = divmod(len(cpus), count)
+    shares, start = [], 0
+    for index in range(count):
+        end = start + size + (1 if index < extra else 0)
+        shares.append(cpus[start:end])
+        start = end
+    return shares
+
+
+def pin_process(pid: int, cpus: list[int]) -> None:
+    """Set the CPU affinity of every thread of a running process
+
+    Args:
+        pid: Process to pin
+        cpus: CPUs it may run on
+    """
+    for tid in _process_threads(pid):
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except OSError:
+            # the thread or process already exited
+            pass
+
+
+class CoreLease:
+    """The share of CPUs one encoder process currently runs on"""
+
+    def __init__(self, lock: threading.Lock):
+        self.cpus: list[int] = []
+        self.pid: int | None = None
+        self._lock = lock
+
+    @property
+    def threads(self) -> int:
+        """Number of encoder threads to ask for, matching the share at start"""
+        with self._lock:
+            return max(1, len(self.cpus))
+
+    def attach(self, pid: int | None) -> None:
+        """Pin a started encoder process to this share, or forget it once it exited
+
+        Args:
+            pid: Process id, or None
+        """
+        with self._lock:
+            self.pid = pid
+            if pid is not None:
+                pin_process(pid, self.cpus)
+
+    def _assign(self, cpus: list[int]) -> None:
+        """Move the lease (and its running process) to new CPUs; called with the lock held"""
+        if cpus == self.cpus:
+            return
+        self.cpus = cpus
+        if self.pid is not None:
+            pin_process(self.pid, cpus)
+
+
+class CorePool:
+    """Splits the available CPUs between the encoder processes running at once
+
+    Each encoder holds a lease for as long as it runs. Whenever one starts or
+    finishes, the CPUs are split again into equal contiguous shares and every
+    running encoder is re-pinned to its share, so a finished encoder's cores
+    go to the ones still running. Encoder thread counts are chosen from the
+    share an encoder gets when it starts.
+    """
+
+    def __init__(self, cpus: list[int]):
+        self.available = cpus
+        self.cpus = cpus
+        self._lock = threading.Lock()
+        self._leases: list[CoreLease] = []
+
+    def set_cpus(self, cpus: list[int]) -> None:
+        """Split a different set of CPUs (like a changed --cpu-limit) between the running encoders
+
+        Args:
+            cpus: CPUs to use from now on
+        """
+        with self._lock:
+            self.cpus = cpus
+            self._rebalance()
+
+    def _rebalance(self) -> None:
+        """Give every lease its share of the CPUs; called with the lock held"""
+        if self._leases:
+            for lease, cpus in zip(self._leases, partition_cpus(self.cpus, len(self._leases))):
+                lease._assign(cpus)
+
+    @contextmanager
+    def lease(self) -> Iterator[CoreLease]:
+        """Hold a share of the CPUs for the enclosed block
+
+        Yields:
+            CoreLease for one encoder process
+        """
+        lease = CoreLease(self._lock)
+        with self._lock:
+            self._leases.append(lease)
+            self._rebalance()
+        try:
+            yield lease
+        finally:
+            with self._lock:
+                self._leases.remove(lease)
+                self._rebalance()
+
+
+# Pool that encoders lease CPUs from, configured by main() unless --no-cpu-partition is given
+_core_pool: CorePool | None = None
+
+
+def set_core_pool(pool: CorePool | None) -> None:
+    """Set the pool encoders lease CPUs from (None disables partitioning)
+
+    Args:
+        pool: CorePool to use, or None
+    """
+    global _core_pool
+    _core_pool = pool
+
+
+@contextmanager
+def core_lease() -> Iterator[CoreLease | None]:
+    """Lease a share of the CPUs for one encoder if a pool is configured
+
+    Yields:
+        CoreLease, or None without a pool
+    """
+    pool = _core_pool
+    if pool is None:
+        yield None
+        return
+    with pool.lease() as lease:
+        yield lease
+
+
+# ioprio_set(2) syscall numbers by machine, and the I/O scheduling classes
+SYS_IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "arm64": 30}
+IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+IOPRIO_WHO_PROCESS = 1
+
+# Seconds between checks of the --limits-file control file for changes
+LIMITS_POLL_SECONDS = 5.0
+
+
+@dataclass
+class Limits:
+    """Politeness limits for the ffmpeg/HandBrake processes, so a run leaves room for other services"""
+    # niceness of every child process
+    nice: int | None = None
+    # I/O scheduling class ("idle", "best-effort" or "realtime") and level (0 highest to 7)
+    ionice: str | None = None
+    ionice_level: int = 4
+    # most CPUs, in cores, the child processes may run on
+    cpu_limit: float | None = None
+    # most MB/s the concat stage reads its clips with
+    read_limit: float | None = None
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "Limits":
+        """Build the limits given on the command line"""
+        return cls(args.nice, args.ionice, args.ionice_level, args.cpu_limit, args.read_limit)
+
+    def updated(self, values: dict) -> "Limits":
+        """Copy of the limits with the values of a --limits-file control file applied
+
+        Args:
+            values: Parsed JSON object; missing keys keep their current value
+
+        Raises:
+            ValueError: For unknown keys or values of the wrong type
+        """
+        unknown = set(values) - set(self.__dataclass_fields__)
+        if unknown:
+            raise ValueError(f"unknown limits: {', '.join(sorted(unknown))}")
+        limits = Limits(**{**self.__dict__, **values})
+        if limits.ionice is not None and limits.ionice not in IOPRIO_CLASSES:
+            raise ValueError(f"unknown ionice class {limits.ionice!r}")
+        for name in ("nice", "ionice_level", "cpu_limit", "read_limit"):
+            value = getattr(limits, name)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                raise ValueError(f"{name} must be a number")
+        return limits
+
+
+def cap_cpus(cpus: list[int], limit: float | None) -> list[int]:
+    """Keep only as many CPUs as a --cpu-limit allows
+
+    Args:
+        cpus: Available CPUs
+        limit: Most cores to use, or None for all
+
+    Returns:
+        The first CPUs, at least one
+    """
+    if limit is None:
+        return cpus
+    return cpus[:max(1, int(limit))]
+
+
+def _process_threads(pid: int) -> list[int]:
+    """Thread ids of a running process (just the pid where /proc is missing)"""
+    try:
+        return [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+    except OSError:
+        return [pid]
+
+
+def _io_priority_call(io_class: str, level: int) -> Callable[[int], int]:
+    """Prepare an ioprio_set(2) call, so it can be made without loading libc
+
+    Args:
+        io_class: Key of IOPRIO_CLASSES
+        level: Priority within the class, 0 (highest) to 7
+
+    Returns:
+        Function taking a thread id (0 for the caller) and returning the syscall's result
+
+    Raises:
+        OSError: If ioprio_set is unknown on this machine
+    """
+    number = SYS_IOPRIO_SET.get(platform.machine()) if sys.platform.startswith("linux") else None
+    if number is None:
+        raise OSError(errno.ENOSYS, "ioprio_set is not available on this system")
+    syscall = ctypes.CDLL(None, use_errno=True).syscall
+    ioprio = (IOPRIO_CLASSES[io_class] << 13) | (level if io_class != "idle" else 0)
+    return lambda tid: syscall(number, IOPRIO_WHO_PROCESS, tid, ioprio)
+
+
+def set_io_priority(tid: int, io_class: str, level: int) -> None:
+    """Set the I/O scheduling class of a thread with ioprio_set(2)
+
+    Args:
+        tid: Thread (or process) id
+        io_class: Key of IOPRIO_CLASSES
+        level: Priority within the class, 0 (highest) to 7
+
+    Raises:
+        OSError: If the kernel refuses, or ioprio_set is unknown on this machine
+    """
+    if _io_priority_call(io_class, level)(tid) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def child_limits(limits: Limits, cpus: list[int] | None = None) -> Callable[[], None] | None:
+    """Build the preexec_fn that applies limits in a child before it execs
+
+    The command then starts with its niceness, I/O class and CPUs already
+    set, instead of running unrestrained until apply_process_limits reaches
+    it. Failures are skipped in the child (it cannot log safely between fork
+    and exec) and reported by apply_process_limits afterwards.
+
+    Args:
+        limits: Limits to apply
+        cpus: CPUs a CorePool lease pins the command to, None to apply the --cpu-limit
+
+    Returns:
+        Function for preexec_fn, or None if there is nothing to apply
+    """
+    if cpus is None and limits.cpu_limit is not None and hasattr(os, "sched_getaffinity"):
+        cpus = cap_cpus(available_cpus() or sorted(os.sched_getaffinity(0)), limits.cpu_limit)
+    if not hasattr(os, "sched_setaffinity"):
+        cpus = None
+    set_priority = None
+    if limits.ionice is not None:
+        try:
+            set_priority = _io_priority_call(limits.ionice, limits.ionice_level)
+        except OSError:
+            pass
+    nice = limits.nice
+    if nice is None and set_priority is None and not cpus:
+        return None
+
+    def apply() -> None:
+        # only plain system calls: nothing here may take a lock another thread held at fork
+        if nice is not None:
+            try:
+                os.setpriority(os.PRIO_PROCESS, 0, nice)
+            except OSError:
+                pass
+        if set_priority is not None:
+            set_priority(0)
+        if cpus:
+            try:
+                os.sched_setaffinity(0, cpus)
+            except OSError:
+                pass
+
+    return apply
+
+
+_limit_warnings: set[str] = set()
+
+
+def apply_process_limits(pid: int, limits: Limits, pinned: bool = False) -> None:
+    """Apply niceness, I/O class and CPU cap to every thread of a running process
+
+    Failures (like raising priority again without CAP_SYS_NICE) are logged
+    once and otherwise ignored; the process just keeps its old setting.
+
+    Args:
+        pid: Child process
+        limits: Limits to apply
+        pinned: Whether a CorePool lease already pins the process to capped CPUs
+    """
+    def warn(what, e):
+        if what not in _limit_warnings:
+            _limit_warnings.add(what)
+            logger.warning("Could not set %s of child processes: %s", what, e)
+
+    for tid in _process_threads(pid):
+        if limits.nice is not None:
+            try:
+                os.setpriority(os.PRIO_PROCESS, tid, limits.nice)
+            except OSError as e:
+                warn("niceness", e)
+        if limits.ionice is not None:
+            try:
+                set_io_priority(tid, limits.ionice, limits.ionice_level)
+            except OSError as e:
+                warn("I/O priority", e)
+    if not pinned and hasattr(os, "sched_setaffinity"):
+        # without a cap the process keeps the CPUs it inherited from this one
+        cpus = sorted(os.sched_getaffinity(0))
+        if limits.cpu_limit is not None:
+            cpus = cap_cpus(available_cpus() or cpus, limits.cpu_limit)
+        pin_process(pid, cpus)
+
+
+def read_rate_options(input_bytes: int, duration: float | None) -> list[str]:
+    """ffmpeg input options that keep reading within the --read-limit
+
+    ffmpeg can only pace its input relative to the media's own speed
+    (-readrate), so the byte limit becomes a multiple of the clips' average
+    bitrate.
+
+    Args:
+        input_bytes: Combined size of the inputs
+        duration: Combined duration of the inputs, if known
+
+    Returns:
+        Options to put before -i, empty without a limit or a known duration
+    """
+    limit = _limits.read_limit
+    if limit is None or not duration or not input_bytes:
+        return []
+    return ["-readrate", f"{limit * 1e6 / (input_bytes / duration):.3f}"]
+
+
+# Limits applied to every child process, changed by main() and its LimitsControl
+_limits = Limits()
+
+
+def set_limits(limits: Limits) -> None:
+    """Set the limits for child processes and apply them to the ones already running
+
+    Args:
+        limits: New limits
+    """
+    global _limits
+    _limits = limits
+    pool = _core_pool
+    if pool is not None:
+        pool.set_cpus(cap_cpus(pool.available, limits.cpu_limit))
+    runner = _command_runner
+    if runner is not None:
+        runner.apply_limits(limits)
+
+
+class LimitsControl:
+    """Keeps the limits in sync with a --limits-file control file during a run
+
+    The file holds a JSON object with any of the Limits fields, like
+    {"nice": 15, "ionice": "idle", "cpu_limit": 4, "read_limit": 80}; fields
+    it leaves out keep their command line value. It is read at start, again
+    whenever its modification time changes (checked every `interval`
+    seconds), and straight away on SIGHUP. A file that is missing or does
+    not parse leaves the current limits in place.
+    """
+
+    def __init__(self, path: Path, base: Limits, interval: float = LIMITS_POLL_SECONDS):
+        self.path = path
+        self.base = base
+        self.interval = interval
+        self._mtime_ns: int | None = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def reload(self, force: bool = False) -> None:
+        """Read the control file if it changed (or always with force) and apply it"""
+        try:
+            mtime_ns = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime_ns == self._mtime_ns and not force:
+            return
+        self._mtime_ns = mtime_ns
+        try:
+            with open(self.path, encoding="utf8") as f:
+                values = json.load(f)
+            if not isinstance(values, dict):
+                raise ValueError("expected a JSON object")
+            limits = self.base.updated(values)
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring limits file %s: %s", self.path, e)
+            return
+        if limits != _limits:
+            logger.info("Limits now %s", limits)
+            set_limits(limits)
+
+    def wake(self) -> None:
+        """Reload from a signal handler (SIGHUP) without doing the work there"""
+        self._wake.set()
+
+    def start(self) -> None:
+        """Apply the file and start following it in the background"""
+        self.reload(force=True)
+
+        def loop():
+            while not self._stop.is_set():
+                forced = self._wake.wait(self.interval)
+                self._wake.clear()
+                if not self._stop.is_set():
+                    self.reload(force=forced)
+
+        self._thread = threading.Thread(target=loop, name="limits", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """Stop following the file"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def concat_list_entry(name: str) -> str:
+    """Format one line of an ffmpeg concat demuxer file list
+
+    Args:
+        name: File name, relative to the list file
+
+    Returns:
+        "file" directive with the name quoted for the concat demuxer
+    """
+    escaped = name.replace("'", "'\\''")
+    return f"file '{escaped}'\n"
+
+
+def record_step(job: DirectoryJob, name: str) -> None:
+    """Mark a step that must not run twice as done, like a stage
+
+    Stages are rerun from the start when an interrupted run is resumed; steps
+    recorded here are skipped on that rerun.
+
+    Args:
+        job: Directory job the step belongs to
+        name: Step name
+    """
+    job.done_stages.add(name)
+    if _journal is not None:
+        _journal.record(job.directory, name, "done")
+
+
+def append_segment(base: Path, segment: Path, operation: str, args: argparse.Namespace,
+                   log_file: Path | None = None) -> float:
+    """Stream-copy a file onto the end of an existing output
+
+    The joined file is written beside the base and only replaces it once its
+    duration has been verified, so a failure leaves the base untouched.
+
+    Args:
+        base: Existing output to extend
+        segment: File to add to the end of base
+        operation: Description of the operation for error messages
+        args: Command line arguments namespace
+        log_file: Directory log to append ffmpeg's output to
+
+    Returns:
+        Duration of the extended output in seconds
+    """
+    base_info, segment_info = probe_files([base, segment], args.probe_workers)
+    check_append_compatible(base_info, [segment_info])
+
+    joined = base.with_name(f"{base.stem}.appending.mp4")
+    joined.unlink(missing_ok=True)
+    list_path = base.with_name(f"{base.stem}.append.txt")
+    list_path.write_text(concat_list_entry(base.name) + concat_list_entry(segment.name), encoding="utf8")
+    try:
+        progress = FFmpegProgress()
+        with trace_span("ffmpeg_stream_copy", directory=base.parent.name,
+                        bytes=base_info.size + segment_info.size):
+            run_command([
+                "ffmpeg", "-f", "concat", "-safe", "0",
+                "-i", str(list_path),
+                "-c", "copy",
+                "-progress", "pipe:1", "-nostats",
+                str(joined)
+            ], f"FFmpeg {operation.lower()} failed", progress, log_file=log_file)
+        verify_output_file(joined, operation)
+        duration = measured_duration(joined, progress.duration, args.verify, args.full_probe)
+        check_durations(base_info.duration + segment_info.duration, duration, operation, args.verify)
+    except RuntimeError:
+        joined.unlink(missing_ok=True)
+        raise
+    finally:
+        list_path.unlink()
+
+    os.replace(joined, base)
+    logger.info("Appended %s to %s", segment.name, base.name)
+    return duration
+
+
+def fetch_stage(job: DirectoryJob) -> None:
+    """Copy a directory's clips to local scratch space when --scratch is given
+
+    The stage has a single worker, so it copies the next directory while
+    the ones ahead of it are being concatenated and compressed.
+
+    Args:
+        job: Directory job to stage
+    """
+    if _stager is not None:
+        _stager.stage(job)
+
+
+def preflight_stage(job: DirectoryJob) -> None:
+    """Check that the clips can be concatenated before anything is written
+
+    Probes every clip and groups consecutive clips with the same codec
+    parameters. Mixed clips fail the directory right away, or with
+    --on-mismatch split get one output per group ("<title> part N.mp4" after
+    the first). Clips that only differ in container or video timescale are
+    remuxed during concatenation instead. With --scratch this runs on the
+    staged copies, and duplicate clips are only looked for here.
+
+    Args:
+        job: Directory job to check
+    """
+    if job.work_dir is not None:
+        drop_duplicates(job)
+    job.clip_infos = probe_files(job.clips, job.args.probe_workers)
+    groups = group_compatible(job.clip_infos)
+
+    if len(groups) > 1:
+        summary = "; ".join(
+            f"{group[0].path.name}{'..' + group[-1].path.name if len(group) > 1 else ''}: "
+            f"{describe_streams(group[0])}"
+            for group in groups
+        )
+        if job.append or job.args.on_mismatch == "refuse":
+            hint = "" if job.append else ", use --on-mismatch split to write one output per group"
+            raise RuntimeError(f"Clips cannot be concatenated into one file ({summary}){hint}")
+        logger.warning("Splitting %s into %d outputs: %s", job.directory, len(groups), summary)
+        job.group_sizes = [len(group) for group in groups]
+        for index in range(1, len(groups)):
+            if job.part_output(index).exists():
+                raise RuntimeError(f"{job.part_output(index).name} already exists")
+
+    job.remux = {}
+    for group in groups:
+        job.remux.update(plan_remux(group))
+    if job.remux:
+        logger.info("Remuxing %d clip(s) in %s before concatenation", len(job.remux), job.directory)
+
+
+def encoder_preset(args: argparse.Namespace) -> str:
+    """Name the encoder settings -c compresses with, for the throughput model
+
+    Args:
+        args: Command line arguments namespace containing encoder and j
+
+    Returns:
+        The built-in settings of the encoder, or the -j preset file's name
+    """
+    if args.encoder != "handbrake":
+        return f"ffmpeg {args.encoder} veryfast crf 22"
+    if args.j:
+        return f"HandBrake {Path(args.j).name}"
+    if platform.system() == "Darwin":
+        return "HandBrake Very Fast 1080p30 vt_h265 q30"
+    return "HandBrake Very Fast 1080p30 h265 q22"
+
+
+def encode_throughput_key(info: MediaInfo, args: argparse.Namespace) -> str:
+    """Throughput model key for encoding clips like `info` with the selected preset
+
+    Args:
+        info: Probe results of a clip
+        args: Command line arguments namespace containing encoder and j
+
+    Returns:
+        Key like "h264 1920x1080 | HandBrake Very Fast 1080p30 h265 q22"
+    """
+    video = info.video_streams[0] if info.video_streams else None
+    source = f"{video.codec_name} {video.width}x{video.height}" if video else "no video"
+    return f"{source} | {encoder_preset(args)}"
+
+
+def source_frames(infos: list[MediaInfo]) -> float:
+    """Estimate how many video frames a list of clips holds from duration and frame rate
+
+    Args:
+        infos: Probe results of the clips
+
+    Returns:
+        Frame count, 0 if no clip reports a frame rate
+    """
+    frames = 0.0
+    for info in infos:
+        if not info.video_streams or not info.video_streams[0].r_frame_rate:
+            continue
+        num, _, den = info.video_streams[0].r_frame_rate.partition("/")
+        try:
+            frames += info.duration * float(num) / float(den or 1)
+        except (ValueError, ZeroDivisionError):
+            continue
+    return frames
+
+
+def predict_seconds(args: argparse.Namespace, clip_bytes: int, infos: list[MediaInfo] | None = None,
+                    append: bool = False) -> float | None:
+    """Predict how long a directory takes to concatenate and (with -c) compress
+
+    Rates measured on earlier runs (see ThroughputModel) are preferred, the
+    defaults fill in for what was never measured. `infos` may be a sample
+    of the clips, like the first one; its frames and duration are scaled
+    up to `clip_bytes`.
+
+    Args:
+        args: Command line arguments namespace
+        clip_bytes: Combined size of the clips
+        infos: Probe results of the clips or a sample of them, if known
+        append: Whether the clips are appended to an existing output
+
+    Returns:
+        Predicted seconds, or None if the encode time cannot be guessed without probe results
+    """
+    model = _throughput
+    copy_rate = model.rate("copy", COPY_THROUGHPUT_KEY) if model else None
+    single_pass = single_pass_encode(args) and not append
+    seconds = 0.0 if single_pass else clip_bytes / (copy_rate or DEFAULT_COPY_BYTES_PER_SECOND)
+    if not args.c:
+        return seconds
+
+    sample_bytes = sum(info.size for info in infos) if infos else 0
+    scale = clip_bytes / sample_bytes if sample_bytes else 1.0
+    fps = model.rate("encode_fps", encode_throughput_key(infos[0], args)) if model and infos else None
+    frames = source_frames(infos) if infos else 0.0
+    if fps and frames:
+        return seconds + frames * scale / fps
+    bytes_rate = model.rate("encode_bytes", encoder_preset(args)) if model else None
+    if bytes_rate:
+        return seconds + clip_bytes / bytes_rate
+    if infos:
+        return seconds + sum(info.duration for info in infos) * scale / DEFAULT_ENCODE_SPEED
+    return None
+
+
+def record_throughput(job: DirectoryJob, encoded: bool, seconds: float) -> None:
+    """Fold a directory's measured concat or compress time into the throughput model
+
+    Args:
+        job: Directory job that just finished the pass
+        encoded: Whether the pass encoded (compression or a single-pass concat) or stream-copied
+        seconds: Wall time the pass took
+    """
+    model = _throughput
+    if model is None or seconds <= 0:
+        return
+    if not encoded:
+        model.record("copy", COPY_THROUGHPUT_KEY, job.clip_bytes / seconds)
+        return
+    # appending without --append-compressed re-encodes the whole output, not just the clips
+    if job.append and not job.append_compressed:
+        return
+    model.record("encode_bytes", encoder_preset(job.args), job.clip_bytes / seconds)
+    frames = source_frames(job.clip_infos) if job.clip_infos else 0.0
+    if frames:
+        model.record("encode_fps", encode_throughput_key(job.clip_infos[0], job.args), frames / seconds)
+
+
+def concat_stage(job: DirectoryJob) -> None:
+    """Concatenate a directory's clips with ffmpeg
+
+    With --append only the new clips are concatenated, into the tail file.
+    Clips split into groups by the preflight stage get one output per group.
+    With a single-pass encode (see single_pass_encode) the clips are
+    compressed on the way instead of stream-copied.
+
+    Args:
+        job: Directory job to concatenate
+    """
+    started = time.monotonic()
+    job.reported_durations = [
+        concat_clips(job, clips, job.part_output(index)) for index, clips in enumerate(job.groups)
+    ]
+    record_throughput(job, job.single_pass, time.monotonic() - started)
+
+
+def concat_clips(job: DirectoryJob, clips: list[Clip], output_file: Path) -> float | None:
+    """Concatenate clips of a directory into one file, remuxing the ones that need it first
+
+    Args:
+        job: Directory job the clips belong to
+        clips: Clips to concatenate, in order
+        output_file: File to write
+
+    Returns:
+        Output duration reported by ffmpeg, if any
+    """
+    current_path = job.work_directory
+    remuxed = []
+    try:
+        names = []
+        for clip in clips:
+            if clip.name in job.remux:
+                remuxed.append(job.remux_file(clip.name))
+                remux_clip(current_path / clip.name, remuxed[-1], job.remux[clip.name], job.log_file)
+                names.append(remuxed[-1].name)
+            else:
+                names.append(clip.name)
+
+        # build ffmpeg file list entries
+        files_txt_entries = [concat_list_entry(file) for file in names]
+
+        # write all entries to files.txt in one operation
+        files_txt_path = current_path / "files.txt"
+        with open(files_txt_path, "w", encoding="utf8") as f:
+            f.writelines(files_txt_entries)
+
+        if job.append:
+            # a tail left over from an earlier failed attempt is never the real output
+            output_file.unlink(missing_ok=True)
+        output_existed = output_file.exists()
+        try:
+            # only an encoding concat needs a share of the CPUs
+            with core_lease() if job.single_pass else nullcontext() as cores:
+                input_bytes = sum(clip.size for clip in clips)
+                durations = {info.path.name: info.duration for info in job.clip_infos or []}
+                expected = sum(durations.get(clip.name, 0.0) for clip in clips) or None
+                # ffmpeg command that concatenates all files into one bigger file
+                cmd = ["ffmpeg", "-f", "concat", "-safe", "0", *read_rate_options(input_bytes, expected),
+                       "-i", str(files_txt_path)]
+                if job.single_pass:
+                    span_name, error_message = "ffmpeg_encode", "FFmpeg concatenation and encode failed"
+                    cmd.extend(ffmpeg_encode_options(job.args.encoder, cores))
+                else:
+                    span_name, error_message = "ffmpeg_stream_copy", "FFmpeg concatenation failed"
+                    cmd.extend(["-c", "copy"])
+                cmd.extend(["-progress", "pipe:1", "-nostats", str(output_file)])
+                progress = FFmpegProgress()
+                with trace_span(span_name, directory=job.title, bytes=input_bytes), \
+                        track_progress(job, "encode" if job.single_pass else "concat", progress, input_bytes, expected):
+                    run_command(cmd, error_message, progress, cores, job.log_file)
+            return progress.duration
+        except RuntimeError:
+            # don't leave a half-written output beside the clips
+            if not output_existed:
+                output_file.unlink(missing_ok=True)
+            raise
+        finally:
+            # remove uneeded "files.txt" file (even if ffmpeg failed)
+            files_txt_path.unlink()
+    finally:
+        for path in remuxed:
+            path.unlink(missing_ok=True)
+
+
+def verify_stage(job: DirectoryJob) -> None:
+    """Verify that the concatenated file is complete
+
+    With --append the verified tail is then joined onto the existing output.
+
+    Args:
+        job: Directory job whose concatenated output should be verified
+    """
+    args = job.args
+    started = time.monotonic()
+    # the preflight stage already probed the clips (unless this run was resumed)
+    input_infos = job.clip_infos
+    if input_infos is None and args.verify in ("standard", "deep"):
+        input_infos = probe_files(job.clips, args.probe_workers)
+    logger.info("Folder size: %d bytes", job.clip_bytes)
+
+    start = 0
+    for index, clips in enumerate(job.groups):
+        output_file = job.part_output(index)
+
+        # === VERIFICATION: Check output file exists and has content ===
+        verify_output_file(output_file, "Concatenation")
+
+        # === VERIFICATION: Verify video duration matches sum of inputs ===
+        total_input_duration = None
+        if input_infos is not None:
+            total_input_duration = 0.0
+            for info in input_infos[start:start + len(clips)]:
+                total_input_duration += info.duration
+                logger.debug("Input file %s duration: %.3f seconds", info.path.name, info.duration)
+        start += len(clips)
+
+        reported = job.reported_durations[index] if index < len(job.reported_durations) else None
+        duration = measured_duration(output_file, reported, args.verify, args.full_probe)
+        check_durations(total_input_duration, duration, "Concatenation", args.verify)
+        if args.verify == "deep":
+            sample_decode(output_file, duration, "Concatenation", job.log_file)
+        if index == 0:
+            job.output_duration = duration
+
+        # log size of the concatenated file
+        logger.info("Concat size: %d bytes", output_file.stat().st_size)
+
+    job.verify_seconds += time.monotonic() - started
+    output_file = job.concat_output
+
+    if job.append_base is not None:
+        joined_duration = None
+        if "join" not in job.done_stages:
+            joined_duration = append_segment(job.append_base, output_file, "Append", args, job.log_file)
+            record_step(job, "join")
+        if not job.append_compressed:
+            # the whole extended output gets compressed, not just the tail
+            job.output_duration = joined_duration
+
+
+def archive_stage(job: DirectoryJob) -> None:
+    """Move the concatenated clips to the archive folder
+
+    Runs once the concatenated file has been verified, so the clips are no
+    longer needed in place. The clips, and any duplicate copies of them left
+    out of the concatenation, go straight into
+    "files to delete/<title> split files" with one relocate_files batch.
+    Copies staged with --scratch are deleted. With -d the clips are left
+    alone here; the finalize stage deletes them once compression succeeded.
+    The folder is recorded in the journal, so a move that was interrupted
+    carries on into the same folder on --resume.
+
+    Args:
+        job: Directory job whose clips should be archived or deleted
+    """
+    current_path = job.directory
+    title = job.title
+    files = job.filelist + [duplicate.name for duplicate in job.duplicates]
+
+    # the staged copies are no longer needed either
+    if job.work_dir is not None:
+        for file in files:
+            (job.work_dir / file).unlink(missing_ok=True)
+
+    # with -d the clips stay until finalize, so a failed compression keeps them
+    if job.args.d:
+        return
+
+    remaining = [current_path / file for file in files if (current_path / file).exists()]
+    if not remaining:
+        # everything was archived before an interrupted run stopped
+        return
+
+    with trace_span("move", "io", directory=title, files=len(remaining), bytes=job.clip_bytes) as span:
+        if job.archive_dir is None:
+            # claim this directory's folder in the main folder for old files
+            # (locked so parallel workers never race on the shared archive)
+            with ARCHIVE_LOCK:
+                files_to_delete_path = job.root / ARCHIVE_DIR_NAME
+                files_to_delete_path.mkdir(parents=True, exist_ok=True)
+                job.archive_dir = unique_destination(files_to_delete_path / f"{title} split files")
+                job.archive_dir.mkdir()
+            if _journal is not None:
+                _journal.record(job.directory, "archive", "claimed", archive_dir=str(job.archive_dir))
+        else:
+            job.archive_dir.mkdir(parents=True, exist_ok=True)
+
+        # move each file straight to its final place
+        job.relocation = relocate_files(remaining, job.archive_dir)
+        span["bytes_copied"] = job.relocation.bytes_copied
+
+
+def delete_clips(job: DirectoryJob) -> None:
+    """Delete a directory's clips and their duplicate copies for -d
+
+    Args:
+        job: Directory job whose clips should be deleted
+    """
+    files = job.filelist + [duplicate.name for duplicate in job.duplicates]
+    with trace_span("unlink", "io", directory=job.title, files=len(files), bytes=job.clip_bytes):
+        # loop through each file in sorted filelist and delete file
+        # (files already gone were deleted before an interrupted run stopped)
+        for file in files:
+            (job.directory / file).unlink(missing_ok=True)
+
+
+def compress_stage(job: DirectoryJob) -> None:
+    """Compress the concatenated file(s) with HandBrake or ffmpeg when -c is given
+
+    Args:
+        job: Directory job whose output should be compressed
+    """
+    args = job.args
+    # if user did not add "-c" flag there is nothing to do
+    if not args.c:
+        return
+    # the concat stage already wrote compressed output
+    if job.single_pass:
+        return
+    # an interrupted run already joined the compressed tail on
+    if "join_compressed" in job.done_stages:
+        return
+
+    encode_seconds = compress_file(job, job.compress_input, job.compress_output, job.output_duration)
+    for index in range(1, len(job.groups)):
+        encode_seconds += compress_file(job, job.part_output(index), job.part_compressed(index), None)
+    record_throughput(job, True, encode_seconds)
+
+    if job.compressed_base is not None:
+        append_segment(job.compressed_base, job.compress_output, "Compressed append", args,
+                       job.log_file)
+        record_step(job, "join_compressed")
+
+
+def ffmpeg_encode_options(encoder: str, cores: CoreLease | None = None) -> list[str]:
+    """ffmpeg output options matching HandBrake's "Very Fast 1080p30" preset at -q 22
+
+    The first video and audio track are kept, video is scaled down to fit
+    1080p (never up) at the source frame rate, and audio becomes 160 kbit/s
+    stereo AAC, like HandBrake's preset.
+
+    Args:
+        encoder: Key of FFMPEG_VIDEO_ENCODERS
+        cores: CPU lease whose size sets the encoder's thread count
+
+    Returns:
+        Options to put between ffmpeg's input and output file
+    """
+    options = [
+        "-map", "0:v:0", "-map", "0:a:0?",
+        *FFMPEG_VIDEO_ENCODERS[encoder], "-preset", "veryfast", "-crf", "22", "-pix_fmt", "yuv420p",
+        "-vf", "scale=w='min(1920,iw)':h='min(1080,ih)':force_original_aspect_ratio=decrease:force_divisible_by=2",
+        "-fps_mode", "passthrough",
+        "-c:a", "aac", "-b:a", "160k", "-ac", "2",
+    ]
+    if cores is not None:
+        threads = str(cores.threads)
+        options.extend(["-threads", threads])
+        if encoder == "x265":
+            # x265 sizes its own thread pool instead of following -threads
+            options.extend(["-x265-params", f"pools={threads}"])
+    return options
+
+
+def handbrake_command(input_file: Path, output_file: Path, args: argparse.Namespace,
+                      cores: CoreLease | None = None) -> list[str]:
+    """Build the HandBrakeCLI command that compresses one file
+
+    Args:
+        input_file: File to compress
+        output_file: Compressed file to write
+        args: Command line arguments namespace containing j
+        cores: CPU lease whose size sets the encoder's thread count
+
+    Returns:
+        HandBrakeCLI command line
+    """
+    cmd = ["HandBrakeCLI", "--json", "-i", str(input_file), "-o", str(output_file)]
+
+    # if user added "-j" flag to use customized json file for handbrake
+    if args.j:
+        cmd.extend(["--preset-import-file", args.j])
+    else:
+        # Add preset and common options
+        cmd.extend([
+            "--preset", "Very Fast 1080p30",
+            "-r", "same as source",
+            "--encoder-level", "auto"
+        ])
+
+        # if running on MacOS, use VideoToolBox which is more efficient
+        if platform.system() == "Darwin":
+            cmd.extend(["-e", "vt_h265", "-q", "30"])
+        else:
+            cmd.extend(["-e", "h265", "-q", "22"])
+            if cores is not None:
+                # x265 thread pool size
+                cmd.extend(["--encopts", f"pools={cores.threads}"])
+    return cmd
+
+
+def encode_file(job: DirectoryJob, input_file: Path, output_file: Path,
+                duration: float | None = None) -> FFmpegProgress | HandBrakeProgress:
+    """Run the selected encoder on one file
+
+    Args:
+        job: Directory job the file belongs to
+        input_file: File to compress
+        output_file: Compressed file to write
+        duration: Expected duration of input_file, for progress reporting
+
+    Returns:
+        The encoder's parsed progress output
+    """
+    args = job.args
+    input_bytes = input_file.stat().st_size
+    with core_lease() as cores:
+        if args.encoder == "handbrake":
+            progress = HandBrakeProgress()
+            with trace_span("handbrake", directory=job.title, bytes=input_bytes), \
+                    track_progress(job, "compress", progress, input_bytes):
+                run_command(handbrake_command(input_file, output_file, args, cores),
+                            "HandBrake compression failed", progress, cores, job.log_file)
+        else:
+            progress = FFmpegProgress()
+            with trace_span("ffmpeg_encode", directory=job.title, bytes=input_bytes), \
+                    track_progress(job, "compress", progress, input_bytes, duration):
+                # -y: a partial output from a failed attempt is overwritten, as HandBrake does
+                run_command(["ffmpeg", "-y", "-i", str(input_file), *ffmpeg_encode_options(args.encoder, cores),
+                             "-progress", "pipe:1", "-nostats", str(output_file)],
+                            "FFmpeg compression failed", progress, cores, job.log_file)
+    return progress
+
+
+def chunk_count(args: argparse.Namespace, duration: float) -> int:
+    """Number of segments to split a file into for chunked compression
+
+    Args:
+        args: Command line arguments namespace containing chunks
+        duration: Duration of the file in seconds
+
+    Returns:
+        Up to --chunks, keeping every segment at least MIN_CHUNK_SECONDS long
+    """
+    return max(1, min(args.chunks, int(duration // MIN_CHUNK_SECONDS)))
+
+
+def remove_chunk_files(output_file: Path) -> None:
+    """Delete the segments and encoded segments of a chunked compression
+
+    Args:
+        output_file: Compressed file the chunks belong to
+    """
+    prefix = f"{output_file.stem}.chunk"
+    with os.scandir(output_file.parent) as entries:
+        for entry in entries:
+            if entry.name.startswith(prefix) and entry.name.endswith(".mp4"):
+                os.unlink(entry.path)
+
+
+def compress_chunked(job: DirectoryJob, input_file: Path, output_file: Path,
+                     input_duration: float, count: int) -> FFmpegProgress:
+    """Compress a long file as segments encoded in parallel
+
+    The file is stream-copied into segments with ffmpeg's segment muxer,
+    which cuts at the first keyframe after each split point, so no frame is
+    decoded twice or lost. Up to `count` encoders run at once, one per
+    segment, and the encoded segments are stream-copied back together.
+
+    Args:
+        job: Directory job the file belongs to
+        input_file: File to compress
+        output_file: Compressed file to write
+        input_duration: Duration of input_file in seconds
+        count: Number of segments to split into
+
+    Returns:
+        Progress output of the ffmpeg run that joined the segments
+    """
+    remove_chunk_files(output_file)
+    prefix = f"{output_file.stem}.chunk"
+    # "%" is special in segment muxer file names
+    pattern = str(output_file.with_name(prefix)).replace("%", "%%") + "%03d.mp4"
+    split_points = ",".join(f"{input_duration * n / count:.3f}" for n in range(1, count))
+    try:
+        with trace_span("split_chunks", "io", directory=job.title, bytes=input_file.stat().st_size):
+            run_command([
+                "ffmpeg", "-v", "error", "-i", str(input_file),
+                "-map", "0:v", "-map", "0:a?", "-c", "copy",
+                "-f", "segment", "-segment_times", split_points, "-segment_format", "mp4",
+                "-reset_timestamps", "1",
+                pattern
+            ], "FFmpeg split into chunks failed", log_file=job.log_file)
+        segments = sorted(path for path in output_file.parent.iterdir()
+                          if re.fullmatch(rf"{re.escape(prefix)}\d+\.mp4", path.name))
+        if not segments:
+            raise RuntimeError(f"FFmpeg split of {input_file.name} wrote no chunks")
+        logger.info("Compressing %s as %d chunks", input_file.name, len(segments))
+
+        def encode_segment(segment):
+            encoded_file = segment.with_name(f"{segment.stem}.enc.mp4")
+            encode_file(job, segment, encoded_file, input_duration / len(segments))
+            verify_output_file(encoded_file, "Chunk compression")
+            # the segment is no longer needed once it is encoded
+            segment.unlink()
+            return encoded_file
+
+        with ThreadPoolExecutor(max_workers=min(count, len(segments))) as executor:
+            encoded = list(executor.map(encode_segment, segments))
+
+        list_path = output_file.with_name(f"{prefix}s.txt")
+        list_path.write_text("".join(concat_list_entry(path.name) for path in encoded), encoding="utf8")
+        try:
+            progress = FFmpegProgress()
+            with trace_span("ffmpeg_stream_copy", directory=job.title,
+                            bytes=sum(path.stat().st_size for path in encoded)):
+                run_command([
+                    "ffmpeg", "-y", "-f", "concat", "-safe", "0",
+                    "-i", str(list_path),
+                    "-c", "copy",
+                    "-progress", "pipe:1", "-nostats",
+                    str(output_file)
+                ], "FFmpeg join of compressed chunks failed", progress, log_file=job.log_file)
+        finally:
+            list_path.unlink()
+        return progress
+    finally:
+        remove_chunk_files(output_file)
+
+
+def compress_file(job: DirectoryJob, input_file: Path, output_file: Path, input_duration: float | None) -> float:
+    """Compress one file with the selected encoder and verify the result
+
+    With --chunks, files long enough to split are compressed by
+    compress_chunked instead of a single encoder.
+
+    Args:
+        job: Directory job the file belongs to
+        input_file: File to compress
+        output_file: Compressed file to write
+        input_duration: Known duration of input_file, or None to take it from HandBrake
+
+    Returns:
+        Seconds spent encoding, without the verification of the output
+    """
+    args = job.args
+
+    if args.chunks > 1 and input_duration is None:
+        # the split points need the duration up front
+        input_duration = get_video_duration(input_file)
+    count = chunk_count(args, input_duration) if args.chunks > 1 else 1
+    started = time.monotonic()
+    if count > 1:
+        progress = compress_chunked(job, input_file, output_file, input_duration, count)
+    else:
+        progress = encode_file(job, input_file, output_file, input_duration)
+    encode_seconds = time.monotonic() - started
+
+    # === VERIFICATION: Check compressed file exists and has content ===
+    verify_output_file(output_file, "Compression")
+
+    # === VERIFICATION: Verify compressed file duration matches input ===
+    # The input duration is already known from concatenation (or HandBrake's
+    # own source scan). HandBrake does not report output timestamps, so its
+    # compressed file is the only one that still needs a probe; ffmpeg does,
+    # including when it joins the chunks of a chunked compression.
+    if isinstance(progress, HandBrakeProgress):
+        source_duration, reported_duration = progress.source_duration, None
+    else:
+        source_duration, reported_duration = None, progress.duration
+    started = time.monotonic()
+    if input_duration is None or args.full_probe:
+        input_duration = measured_duration(input_file, source_duration, args.verify, args.full_probe)
+    output_duration = measured_duration(output_file, reported_duration, args.verify, args.full_probe)
+    check_durations(input_duration, output_duration, "Compression", args.verify)
+    if args.verify == "deep":
+        sample_decode(output_file, output_duration, "Compression", job.log_file)
+    job.verify_seconds += time.monotonic() - started
+    return encode_seconds
+
+
+def finalize_stage(job: DirectoryJob) -> None:
+    """Replace the concatenated file with the compressed one when both -c and -d are given
+
+    With --append the tail files are removed instead; the compressed tail has
+    already been joined onto the compressed output. With --scratch the
+    outputs are then moved from the scratch folder into the directory. Only
+    after all of that are the clips deleted for -d.
+
+    Args:
+        job: Directory job to finalize
+    """
+    if job.append:
+        job.tail_file.unlink(missing_ok=True)
+        job.compressed_tail_file.unlink(missing_ok=True)
+    elif job.args.d and job.args.c:
+        for index in range(len(job.groups)):
+            output_file, compressed_file = job.part_output(index), job.part_compressed(index)
+            # (the compressed file is gone if an interrupted run already renamed it)
+            if compressed_file.exists():
+                with trace_span("replace_with_compressed", "io", directory=job.title):
+                    # remove non-compressed file and rename compressed file
+                    output_file.unlink(missing_ok=True)
+                    compressed_file.rename(output_file)
+
+    if job.work_dir is not None:
+        outputs = job.existing_outputs()
+        with trace_span("store_outputs", "io", directory=job.title, files=len(outputs)):
+            relocate_files(outputs, job.directory)
+        logger.info("Moved %d output(s) of %s back from scratch", len(outputs), job.directory)
+
+    if job.args.d:
+        delete_clips(job)
+
+
+def run_stage(name: str, stage: Callable[[DirectoryJob], None], job: DirectoryJob) -> None:
+    """Run one processing stage for a job inside a trace span
+
+    Args:
+        name: Stage name
+        stage: Stage function
+        job: Directory job to process
+    """
+    if name in job.done_stages:
+        logger.debug("Skipping %s for %s, already done in an earlier run", name, job.directory)
+        return
+
+    journal = _journal
+    if journal is not None:
+        journal.record(job.directory, name, "start", **_journal_data(name, "start", job))
+    try:
+        with trace_span(name, directory=job.title, bytes=job.clip_bytes):
+            stage(job)
+    except Exception as e:
+        if journal is not None:
+            journal.record(job.directory, name, "failed", error=str(e))
+        raise
+    job.done_stages.add(name)
+    if journal is not None:
+        journal.record(job.directory, name, "done", **_journal_data(name, "done", job))
+
+
+# Processing stages in order, as (name, function) pairs
+PIPELINE_STAGES = [
+    ("fetch", fetch_stage),
+    ("preflight", preflight_stage),
+    ("concat", concat_stage),
+    ("verify", verify_stage),
+    ("archive", archive_stage),
+    ("compress", compress_stage),
+    ("finalize", finalize_stage),
+]
+
+
+def ffmpeg_concat(root: Path, r_dir: Path, args: argparse.Namespace) -> DirectoryJob | None:
+    """finds and combines all MP4 files in folder
+    
+    Runs every processing stage for a single directory in order.
+
+    Args:
+        root: Root directory path for organizing output files
+        r_dir: Directory containing MP4 files to concatenate
+        args: Command line arguments namespace containing flags (d, c, j, y)
+
+    Returns:
+        The finished DirectoryJob, or None if there was nothing to concatenate
+    """
+    with trace_span("ffmpeg_concat", directory=r_dir.name):
+        job = prepare_job(root, r_dir, args)
+        if job is None:
+            return None
+        admit_job(job)
+        try:
+            for name, stage in PIPELINE_STAGES:
+                run_stage(name, stage, job)
+        finally:
+            release_job(job)
+        return job
+
+
+def _is_excluded(relative_path: str, name: str, exclude: tuple[str, ...]) -> bool:
+    """Check a directory against user supplied exclude globs
+
+    Args:
+        relative_path: Path relative to the walk root, using forward slashes
+        name: Directory name
+        exclude: Glob patterns matched against both the name and the relative path
+
+    Returns:
+        True if any pattern matches
+    """
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative_path, pattern) for pattern in exclude)
+
+
+def walk_leaf_dirs(directory_path: Path, exclude: tuple[str, ...] = (), max_depth: int | None = None) -> Iterator[Path]:
+    """Yield directories with no subdirectories as they are found
+
+    Walks the tree depth first with os.scandir, reusing the DirEntry type
+    information instead of stat'ing every path. Archive folders ("files to
+    delete") are never entered, so archived split files are not concatenated
+    again, and do not count as a subdirectory: a root holding clips next to
+    its archive is still a leaf. Directories matching an exclude glob are
+    skipped entirely.
+
+    Args:
+        directory_path: Root directory to search for leaf directories
+        exclude: Glob patterns for directories to skip
+        max_depth: Treat directories at this depth below the root as leaves
+
+    Yields:
+        Leaf directories in sorted depth-first order
+    """
+    stack = [(directory_path, 0)]
+    while stack:
+        directory, depth = stack.pop()
+        subdirectories = []
+        has_subdirectories = False
+        try:
+            with trace_span("scandir", "discovery", directory=directory.name), os.scandir(directory) as entries:
+                dir_entries = [entry for entry in entries if entry.is_dir(follow_symlinks=False)]
+        except OSError as e:
+            logger.warning("Cannot read directory %s: %s", directory, e)
+            continue
+
+        for entry in dir_entries:
+            if entry.name in (ARCHIVE_DIR_NAME, LOG_DIR_NAME):
+                continue
+            path = Path(entry.path)
+            if exclude and _is_excluded(path.relative_to(directory_path).as_posix(), entry.name, exclude):
+                continue
+            has_subdirectories = True
+            subdirectories.append(path)
+
+        if not has_subdirectories or (max_depth is not None and depth >= max_depth):
+            yield directory
+            continue
+
+        # push in reverse so directories are visited in name order
+        for path in sorted(subdirectories, key=lambda p: p.name, reverse=True):
+            stack.append((path, depth + 1))
+
+
+def dir_no_subs(directory_path: Path, exclude: tuple[str, ...] = (), max_depth: int | None = None) -> list[Path]:
+    """finds all directories with no subdirectories and returns their
+    absolute paths as a list using pathlib
+    
+    Args:
+        directory_path: Root directory to search for leaf directories
+        exclude: Glob patterns for directories to skip
+        max_depth: Treat directories at this depth below the root as leaves
+        
+    Returns:
+        List of Path objects representing directories with no subdirectories
     """
-    try:
-        subprocess.run(cmd_list, check=True)
-    except subprocess.CalledProcessError:
-        raise RuntimeError(error_message)
+    with trace_span("dir_no_subs", "discovery"):
+        nsub_list = list(walk_leaf_dirs(directory_path, exclude, max_depth))
 
+    # If no leaf directories found, return the root
+    if not nsub_list:
+        return [directory_path]
+
+    return sorted(nsub_list, key=str)
+
+
+def predict_directory_seconds(directory: Path, args: argparse.Namespace) -> float:
+    """Predict a directory's processing time for scheduling
+
+    With -c only the first clip is probed (usually from the probe cache) to
+    find its codec, resolution and frame rate; the rest is scaled by size.
 
-def get_video_duration(file_path: Path) -> float:
-    """Get video duration in seconds using ffprobe
-    
     Args:
-        file_path: Path to the video file
-        
+        directory: Leaf directory to predict
+        args: Command line arguments namespace
+
     Returns:
-        Duration in seconds as a float
+        Predicted seconds (see predict_seconds)
     """
-    try:
-        result = subprocess.run(
-            [
-                "ffprobe", "-v", "error", "-show_entries", "format=duration",
-                "-of", "default=noprint_wrappers=1:nokey=1", file_path
-            ],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        return float(result.stdout.strip())
-    except subprocess.CalledProcessError as e:
-        stderr_msg = e.stderr.strip() if e.stderr else "No error output"
-        raise RuntimeError(f"Failed to get duration for {file_path}: {stderr_msg}")
-    except ValueError as e:
-        raise RuntimeError(f"Failed to parse duration for {file_path}: {e}")
+    clips = scan_clips(directory)
+    clip_bytes = sum(clip.size for clip in clips)
+    infos = None
+    if args.c and clips:
+        infos = [probe_media(clips[0].path, clips[0].size, clips[0].mtime_ns)]
+    predicted = predict_seconds(args, clip_bytes, infos)
+    return clip_bytes / DEFAULT_COPY_BYTES_PER_SECOND if predicted is None else predicted
 
 
-def verify_output_file(file_path: Path, operation: str) -> None:
-    """Verify that output file exists and has content
-    
+def discover_directories(directories: Iterable[Path], args: argparse.Namespace) -> Iterator[Path]:
+    """Walk ahead of the pipeline, adding every directory found to the progress
+
+    A background thread runs the walk to the end and sums each directory's
+    clip sizes (a stat per clip), so the batch total and ETA cover the whole
+    tree while the first directories are being processed. Directories are
+    passed on as soon as they are found. Without a progress reporter the
+    directories are passed through as they are.
+
     Args:
-        file_path: Path to the output file to verify
-        operation: Name of the operation that created the file (for error messages)
+        directories: Leaf directories to process (a list or a walk_leaf_dirs generator)
+        args: Command line arguments namespace
+
+    Yields:
+        The same directories, in the same order
     """
-    if not file_path.exists():
-        raise RuntimeError(f"{operation} failed: output file {file_path} does not exist")
-    if file_path.stat().st_size == 0:
-        raise RuntimeError(f"{operation} failed: output file {file_path} is empty")
+    reporter = _progress
+    if reporter is None:
+        yield from directories
+        return
 
+    found = queue.Queue()
+    errors = []
+
+    def walk():
+        try:
+            for directory in directories:
+                if _stopping.is_set():
+                    break
+                try:
+                    clip_bytes = sum(clip.size for clip in scan_clips(directory))
+                except OSError:
+                    clip_bytes = 0
+                reporter.discover(directory, clip_bytes, args)
+                found.put(directory)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            reporter.end_discovery()
+            found.put(_STOP)
+
+    threading.Thread(target=walk, name="discover", daemon=True).start()
+    while (directory := found.get()) is not _STOP:
+        yield directory
+    if errors:
+        raise errors[0]
+
+
+def schedule_directories(directories: Iterable[Path], args: argparse.Namespace) -> Iterable[Path]:
+    """Order directories for processing
+
+    With a single concat job directories are passed through as they are
+    found. With more than one job the directories predicted to take longest
+    (see predict_directory_seconds) go first so the longest jobs do not end
+    up running alone at the end, which needs the full list up front.
 
-def verify_duration_match(input_duration: float, output_duration: float, operation: str, tolerance: float = 1.0) -> None:
-    """Verify that output duration matches input duration within tolerance
-    
     Args:
-        input_duration: Expected duration in seconds
-        output_duration: Actual duration in seconds
-        operation: Name of the operation being verified (for error messages)
-        tolerance: Maximum acceptable difference in seconds (default: 1.0)
+        directories: Leaf directories to process (a list or a walk_leaf_dirs generator)
+        args: Command line arguments namespace containing jobs
+
+    Returns:
+        Directories in processing order
     """
-    logger.info("Input duration: %.3f seconds", input_duration)
-    logger.info("Output duration: %.3f seconds", output_duration)
-    
-    if abs(output_duration - input_duration) > tolerance:
-        raise RuntimeError(
-            f"{operation} verification failed: output duration ({output_duration:.3f}s) "
-            f"does not match input duration ({input_duration:.3f}s)"
-        )
-    
-    logger.info("Duration verification passed")
+    if args.jobs <= 1:
+        return directories
 
+    directory_list = list(directories)
+    predicted = {}
+    for directory in directory_list:
+        try:
+            predicted[directory] = predict_directory_seconds(directory, args)
+        except (OSError, RuntimeError):
+            predicted[directory] = 0.0
+    return sorted(directory_list, key=lambda d: predicted[d], reverse=True)
+
+
+def process_directories(root: Path, directories: Iterable[Path], args: argparse.Namespace) -> list[DirectoryResult]:
+    """Process every leaf directory through a pipeline of stages
+
+    Each stage (fetch, preflight, concat, verify, archive, compress,
+    finalize) has its own pool of worker threads and hands finished jobs to the next stage
+    through a bounded queue, so the next directory can be concatenated
+    while the previous one is compressing. Concatenation and verification
+    use --jobs workers, compression --compress-jobs workers (as does
+    concatenation when it encodes in a single pass) and the
+    archive/finalize bookkeeping a single worker each. A failure drops the directory from
+    the pipeline and is reported in its result. On Ctrl-C the running
+    commands are killed and every worker gives up before the
+    KeyboardInterrupt is passed on.
 
-def ffmpeg_concat(root: Path, r_dir: Path, args: argparse.Namespace) -> None:
-    """finds and combines all MP4 files in folder
-    
     Args:
         root: Root directory path for organizing output files
-        r_dir: Directory containing MP4 files to concatenate
-        args: Command line arguments namespace containing flags (d, c, j, y)
+        directories: Leaf directories to process (a list or a walk_leaf_dirs generator)
+        args: Command line arguments namespace containing jobs, compress_jobs and queue_depth
+
+    Returns:
+        One DirectoryResult per directory, in the order they finished
     """
+    # a single-pass encode does the compressing in the concat stage
+    concat_jobs = args.compress_jobs if single_pass_encode(args) else args.jobs
+    workers = {"preflight": max(1, args.jobs), "concat": max(1, concat_jobs), "verify": max(1, args.jobs),
+               "compress": max(1, args.compress_jobs)}
+    queues = [queue.Queue(maxsize=max(1, args.queue_depth)) for _ in PIPELINE_STAGES]
+    results = []
+    results_lock = threading.Lock()
 
-    # Use absolute paths to avoid directory changes
-    current_path = r_dir
-    title = r_dir.name
+    def record(result):
+        with results_lock:
+            results.append(result)
 
-    # initialize empty list to store files that will be concatenated
-    filelist = []
+    def stage_worker(index):
+        name, stage = PIPELINE_STAGES[index]
+        while True:
+            job = queues[index].get()
+            if job is _STOP:
+                return
+            if _stopping.is_set():
+                release_job(job)
+                return
+            try:
+                run_stage(name, stage, job)
+            except Exception as e:  # keep the batch going, failure is reported in the summary
+                release_job(job)
+                if _stopping.is_set():
+                    logger.warning("Interrupted %s during %s", job.directory, name)
+                    return
+                logger.error("Failed to process %s during %s: %s", job.directory, name, e)
+                record(DirectoryResult(job.directory, False, time.monotonic() - job.started,
+                                       job.clip_bytes, f"{name}: {e}", job.relocation, job.verify_seconds))
+                continue
+            if _stopping.is_set():
+                release_job(job)
+                return
+            if index + 1 < len(PIPELINE_STAGES):
+                queues[index + 1].put(job)
+            else:
+                release_job(job)
+                record(DirectoryResult(job.directory, True, time.monotonic() - job.started, job.clip_bytes,
+                                       relocation=job.relocation, verify_seconds=job.verify_seconds))
 
-    # loop through each file in current directory
-    for file_path in current_path.iterdir():
-        if file_path.is_file():
-            filename = file_path.name
-            # Checks that file ends with ".mp4" (case insensitive) and is smaller than size limit
-            if filename.lower().endswith(".mp4") and file_path.stat().st_size < DEFAULT_SIZE_LIMIT:
-                # adds filename to "filelist" if conditions are met
-                filelist.append(filename)
+    threads = []
+    for index, (name, _) in enumerate(PIPELINE_STAGES):
+        stage_threads = [
+            threading.Thread(target=stage_worker, args=(index,), name=f"{name}-{n}", daemon=True)
+            for n in range(workers.get(name, 1))
+        ]
+        for thread in stage_threads:
+            thread.start()
+        threads.append(stage_threads)
 
-    # sorts "filelist" using "natural sorting"
-    filelist = natsorted(filelist)
+    def shut_down():
+        # wake every worker until all have given up their directory; the
+        # queues of stages whose workers are gone are emptied so no worker
+        # stays blocked handing a directory on
+        while True:
+            alive = False
+            for stage_queue, stage_threads in zip(queues, threads):
+                if any(thread.is_alive() for thread in stage_threads):
+                    alive = True
+                    try:
+                        stage_queue.put(_STOP, timeout=0.1)
+                    except queue.Full:
+                        pass
+                    continue
+                while True:
+                    try:
+                        job = stage_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is not _STOP:
+                        release_job(job)
+            if not alive:
+                return
 
-    # Check if any MP4 files were found
-    if not filelist:
-        logger.warning("No MP4 files found in %s, skipping", current_path)
-        return
+    admitted = 0
+    try:
+        # feed directories into the first stage as they are found
+        for directory in schedule_directories(discover_directories(directories, args), args):
+            if _stopping.is_set():
+                break
+            job = None
+            try:
+                job = prepare_job(root, directory, args)
+                if job is not None:
+                    # blocks while directories in the pipeline hold the free space
+                    admit_job(job)
+                    admitted += 1
+            except Exception as e:
+                if job is not None and not admitted and _disk_planner is not None:
+                    # nothing is running that could free space: don't try the rest
+                    raise RuntimeError(f"{directory} does not fit even with nothing else running, "
+                                       f"stopping the batch: {e}") from None
+                logger.error("Failed to process %s: %s", directory, e)
+                skip_progress(directory)
+                record(DirectoryResult(directory, False, 0.0, error=str(e)))
+                continue
+            if job is None:
+                skip_progress(directory)
+                record(DirectoryResult(directory, True, 0.0))
+                continue
+            queues[0].put(job)
+
+        # drain the stages in order so every job reaches the end
+        for index, stage_threads in enumerate(threads):
+            for _ in stage_threads:
+                queues[index].put(_STOP)
+            for thread in stage_threads:
+                thread.join()
+    except BaseException:
+        # Ctrl-C: kill the running commands and wait for the workers to give
+        # up, so nothing keeps running or writing to the journal afterwards
+        stop_run()
+        shut_down()
+        raise
+    return results
+
+
+def log_summary(results: list[DirectoryResult], verify: str | None = None) -> None:
+    """Log a per-directory success/failure summary
+
+    Args:
+        results: Results returned by process_directories
+        verify: --verify level the outputs were checked with, to report its cost
+    """
+    failed = [r for r in results if not r.ok]
+    logger.info("Summary: %d succeeded, %d failed", len(results) - len(failed), len(failed))
+    if verify is not None and results:
+        verify_seconds = sum(result.verify_seconds for result in results)
+        total_seconds = sum(result.seconds for result in results)
+        logger.info("Verification (--verify %s): %.1fs, %.0f%% of processing time", verify, verify_seconds,
+                    100 * verify_seconds / total_seconds if total_seconds else 0)
+
+    relocation = RelocationStats()
+    for result in results:
+        if result.relocation is not None:
+            relocation.add(result.relocation)
+    if relocation.files:
+        logger.info("Archived %d files: %d renamed, %d reflinked, %d copy_file_range, %d copied "
+                    "(%d bytes copied)", relocation.files, relocation.renamed, relocation.reflinked,
+                    relocation.copy_range, relocation.copied, relocation.bytes_copied)
+    for result in sorted(results, key=lambda r: str(r.directory)):
+        if result.ok:
+            logger.info("  OK     %s (%.1fs, %d bytes)", result.directory, result.seconds, result.clip_bytes)
+        else:
+            logger.error("  FAILED %s (%.1fs): %s", result.directory, result.seconds, result.error)
+
+
+# inotify event flags, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# Events watched on every directory of the tree
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_ONLYDIR
+
+# File events that mean a clip is still arriving
+CLIP_EVENTS = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# struct inotify_event without its variable length name
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """Minimal ctypes binding to the Linux inotify API"""
+
+    def __init__(self):
+        try:
+            self._libc = ctypes.CDLL(None, use_errno=True)
+            init = self._libc.inotify_init1
+        except (OSError, AttributeError):
+            raise RuntimeError("--watch needs inotify, which is only available on Linux") from None
+        self.fd = init(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise RuntimeError(f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+
+    def add_watch(self, path: Path, mask: int) -> int:
+        """Start watching a directory
+
+        Args:
+            path: Directory to watch
+            mask: Events to report
+
+        Returns:
+            Watch descriptor the directory's events are reported with
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise RuntimeError(f"Out of inotify watches while adding {path}, "
+                                   "raise the fs.inotify.max_user_watches sysctl")
+            raise OSError(err, os.strerror(err), str(path))
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        """Stop watching a directory (errors for watches the kernel already dropped are ignored)"""
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout: float | None) -> list[tuple[int, int, str]]:
+        """Wait for events
+
+        Args:
+            timeout: Seconds to wait, or None to wait until an event arrives
+
+        Returns:
+            (watch descriptor, mask, name) for every event read, empty on timeout
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self) -> None:
+        """Close the inotify file descriptor, dropping every watch"""
+        os.close(self.fd)
+
+
+class FolderWatcher:
+    """Follows a tree with inotify and reports leaf directories once their clips settle
+
+    Every directory gets one watch, added with a scandir walk like a normal
+    run's discovery, and events are mapped back to their directory with a
+    dict lookup, so handling an event costs the same however large the tree
+    is. A directory is ready once no clip in it has been created, written or
+    moved in for `settle` seconds.
+    """
+
+    def __init__(self, root: Path, exclude: tuple[str, ...] = (), max_depth: int | None = None,
+                 settle: float = DEFAULT_SETTLE_SECONDS, inotify: Inotify | None = None):
+        self.root = root
+        self.exclude = exclude
+        self.max_depth = max_depth
+        self.settle = settle
+        self.inotify = inotify if inotify is not None else Inotify()
+        self._paths: dict[int, Path] = {}
+        self._pending: dict[Path, float] = {}
+
+    @property
+    def watch_count(self) -> int:
+        """Number of directories being watched"""
+        return len(self._paths)
+
+    def _depth(self, path: Path) -> int:
+        return len(path.relative_to(self.root).parts)
+
+    def _is_watched(self, path: Path) -> bool:
+        """Whether a directory belongs to the tree being processed"""
+        # archive and log folders never hold new clips
+        if path.name in (ARCHIVE_DIR_NAME, LOG_DIR_NAME):
+            return False
+        if self.max_depth is not None and self._depth(path) > self.max_depth:
+            return False
+        return not (self.exclude and _is_excluded(path.relative_to(self.root).as_posix(), path.name, self.exclude))
+
+    def _is_leaf(self, path: Path, entries: list[os.DirEntry]) -> bool:
+        """Same rule as walk_leaf_dirs: no subdirectories besides excluded ones, the archive and the logs"""
+        if self.max_depth is not None and self._depth(path) >= self.max_depth:
+            return True
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False) and self._is_watched(Path(entry.path)):
+                return False
+        return True
+
+    def add_tree(self, directory: Path) -> list[Path]:
+        """Watch a directory and every directory below it
+
+        Args:
+            directory: Directory to start watching
+
+        Returns:
+            Leaf directories in the tree that already hold clips
+        """
+        found = []
+        stack = [directory]
+        while stack:
+            path = stack.pop()
+            try:
+                wd = self.inotify.add_watch(path, WATCH_MASK)
+                with os.scandir(path) as it:
+                    entries = list(it)
+            except FileNotFoundError:
+                # removed again before we got to it
+                continue
+            except OSError as e:
+                logger.warning("Cannot watch directory %s: %s", path, e)
+                continue
+            self._paths[wd] = path
 
-    # initialize combined size all files in folder starting at 0
-    folder_size = 0
-
-    # build ffmpeg file list entries
-    files_txt_entries = []
-    for file in filelist:
-        file_path = current_path / file
-        # Calculate size of all files in list
-        folder_size += file_path.stat().st_size
-        # build file entry formatted for ffmpeg
-        files_txt_entries.append(f"file '{file}'\n")
-
-    # write all entries to files.txt in one operation
-    files_txt_path = current_path / "files.txt"
-    with open(files_txt_path, "w", encoding="utf8") as f:
-        f.writelines(files_txt_entries)
-
-    # run ffmpeg command that concatenates all files into one bigger file
-    output_file = current_path / f"{title}.mp4"
-    run_command([
-        "ffmpeg", "-f", "concat", "-safe", "0",
-        "-i", str(files_txt_path),
-        "-c", "copy",
-        str(output_file)
-    ], "FFmpeg concatenation failed")
+            has_clips = any(entry.name.lower().endswith(".mp4") and not is_output_name(path.name, entry.name)
+                            and entry.is_file() for entry in entries)
+            if has_clips and self._is_leaf(path, entries):
+                found.append(path)
+            stack.extend(Path(entry.path) for entry in entries
+                         if entry.is_dir(follow_symlinks=False) and self._is_watched(Path(entry.path)))
+        return found
 
+    def _forget(self, directory: Path) -> None:
+        """Drop the watches of a directory that was moved away"""
+        for wd, path in list(self._paths.items()):
+            if path == directory or directory in path.parents:
+                self.inotify.rm_watch(wd)
+                del self._paths[wd]
+        for path in list(self._pending):
+            if path == directory or directory in path.parents:
+                del self._pending[path]
+
+    def touch(self, directory: Path, now: float) -> None:
+        """(Re)start a directory's settle period"""
+        self._pending[directory] = now + self.settle
+
+    def handle(self, wd: int, mask: int, name: str, now: float) -> None:
+        """Update the watches and settle timers for one inotify event
+
+        Args:
+            wd: Watch descriptor the event was reported on
+            mask: Event flags
+            name: Name of the file or directory the event is about
+            now: Current time.monotonic()
+        """
+        if mask & IN_Q_OVERFLOW:
+            # events were lost: rescan everything once rather than miss clips
+            logger.warning("inotify queue overflowed, rescanning %s", self.root)
+            for directory in self.add_tree(self.root):
+                self.touch(directory, now)
+            return
+
+        directory = self._paths.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self._paths[wd]
+            return
+
+        if mask & IN_ISDIR:
+            path = directory / name
+            if mask & (IN_CREATE | IN_MOVED_TO) and self._is_watched(path):
+                for leaf in self.add_tree(path):
+                    self.touch(leaf, now)
+            elif mask & IN_MOVED_FROM:
+                self._forget(path)
+            return
+
+        if mask & CLIP_EVENTS and name.lower().endswith(".mp4") and not is_output_name(directory.name, name):
+            self.touch(directory, now)
+
+    def timeout(self, now: float) -> float | None:
+        """Seconds until the next directory settles, or None if none is pending"""
+        if not self._pending:
+            return None
+        return max(0.0, min(self._pending.values()) - now)
+
+    def ready(self, now: float) -> list[Path]:
+        """Take the directories whose settle period is over
+
+        Args:
+            now: Current time.monotonic()
+
+        Returns:
+            Settled directories that are still leaves
+        """
+        due = sorted(path for path, deadline in self._pending.items() if deadline <= now)
+        ready = []
+        for path in due:
+            del self._pending[path]
+            try:
+                with os.scandir(path) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            if self._is_leaf(path, entries):
+                ready.append(path)
+        return ready
+
+    def close(self) -> None:
+        """Stop watching"""
+        self.inotify.close()
+
+
+def watch_directories(root: Path, args: argparse.Namespace) -> list[DirectoryResult]:
+    """Process leaf directories as clips arrive in them, until interrupted
+
+    Leaf directories that already hold clips at startup are processed once
+    they have settled too. Each settled directory is handed to
+    ffmpeg_concat() on a worker thread, so events keep being read while a
+    directory is processed; a directory that changes while it is being
+    processed is looked at again afterwards. Ctrl-C kills the running
+    commands, like in a normal run, and the interrupted directory is left
+    for --resume.
+
+    Args:
+        root: Root directory to watch
+        args: Command line arguments namespace containing exclude, max_depth and settle
+
+    Returns:
+        One DirectoryResult per processed directory
+    """
+    watcher = FolderWatcher(root, tuple(args.exclude), args.max_depth, args.settle)
+    work = queue.Queue()
+    busy = set()
+    busy_lock = threading.Lock()
+    results = []
+
+    def worker():
+        while True:
+            directory = work.get()
+            if directory is _STOP:
+                return
+            started = time.monotonic()
+            try:
+                job = ffmpeg_concat(root, directory, args)
+                results.append(DirectoryResult(directory, True, time.monotonic() - started,
+                                               job.clip_bytes if job is not None else 0,
+                                               relocation=job.relocation if job is not None else None,
+                                               verify_seconds=job.verify_seconds if job is not None else 0.0))
+                logger.info("Finished %s", directory)
+            except Exception as e:  # keep watching, the failure is reported in the summary
+                logger.error("Failed to process %s: %s", directory, e)
+                results.append(DirectoryResult(directory, False, time.monotonic() - started, error=str(e)))
+            finally:
+                with busy_lock:
+                    busy.discard(directory)
+
+    thread = threading.Thread(target=worker, name="watch-0", daemon=True)
+    thread.start()
     try:
-        # === VERIFICATION: Check output file exists and has content ===
-        verify_output_file(output_file, "Concatenation")
+        with trace_span("watch_setup", "discovery"):
+            for directory in watcher.add_tree(root):
+                watcher.touch(directory, time.monotonic())
+        logger.info("Watching %d directories under %s", watcher.watch_count, root)
 
-        # === VERIFICATION: Verify video duration matches sum of inputs ===
-        total_input_duration = 0.0
-        for file in filelist:
-            file_path = current_path / file
-            duration = get_video_duration(file_path)
-            total_input_duration += duration
-            logger.debug("Input file %s duration: %.3f seconds", file, duration)
-
-        output_duration = get_video_duration(output_file)
-        verify_duration_match(total_input_duration, output_duration, "Concatenation")
+        while True:
+            for directory in watcher.ready(time.monotonic()):
+                with busy_lock:
+                    if directory in busy:
+                        watcher.touch(directory, time.monotonic())
+                        continue
+                    busy.add(directory)
+                work.put(directory)
+            for wd, mask, name in watcher.inotify.read(watcher.timeout(time.monotonic())):
+                watcher.handle(wd, mask, name, time.monotonic())
+    except KeyboardInterrupt:
+        logger.info("Stopping watch")
+        # drop what is queued; the directory in progress had its commands
+        # killed by the same Ctrl-C and is left for --resume
+        while True:
+            try:
+                work.get_nowait()
+            except queue.Empty:
+                break
+        stop_run()
     finally:
-        # remove uneeded "files.txt" file after verification (even if it failed)
-        files_txt_path.unlink()
+        work.put(_STOP)
+        thread.join()
+        watcher.close()
+    return results
 
-    # calculate size of the newly concatenated file
-    concat_file = output_file.stat().st_size
 
-    # log size of all smaller files and the concatenated file
-    logger.info("Folder size: %d bytes", folder_size)
-    logger.info("Concat size: %d bytes", concat_file)
+def plan_directory(root: Path, r_dir: Path, args: argparse.Namespace, planner: DiskPlanner) -> dict:
+    """Work out what processing a directory would do, without writing anything
 
-    # if user did not add "-d" flag to save old files
-    if not args.d:
-        # create folder where old files from current directory will be moved to
-        split_files_dir = current_path / f"{title} split files"
-        split_files_dir.mkdir(parents=True, exist_ok=True)
-
-        # move each file to folder for old files
-        for file in filelist:
-            source = current_path / file
-            destination = split_files_dir / file
-            shutil.move(str(source), str(destination))
-
-        # move current folder for old files to main folder for old files
-        files_to_delete_path = root / "files to delete"
-        files_to_delete_path.mkdir(parents=True, exist_ok=True)
-        split_destination = files_to_delete_path / f"{title} split files"
-        shutil.move(str(split_files_dir), str(split_destination))
-
-    # if user added "-c" flag to compress the concatenated file
-    if args.c:
-        # Build HandBrakeCLI command dynamically
-        input_file = current_path / f"{title}.mp4"
-        output_file = current_path / f"{title}(cp).mp4"
+    Args:
+        root: Root directory path for organizing output files
+        r_dir: Leaf directory to plan
+        args: Command line arguments namespace
+        planner: DiskPlanner whose free space and margin the headroom is measured against
 
-        cmd = ["HandBrakeCLI", "-i", str(input_file), "-o", str(output_file)]
+    Returns:
+        JSON-serializable plan entry for the directory
+    """
+    dropped = []
+    entry = {"directory": str(r_dir), "clips": [], "dropped": [], "duplicates": []}
+    try:
+        job = prepare_job(root, r_dir, args, dropped)
+        if job is None:
+            entry["action"] = "skip"
+            return entry
+        entry["duplicates"] = [{"name": clip.name, "bytes": clip.size} for clip in job.duplicates]
 
-        # if user added "-j" flag to use customized json file for handbrake
-        if args.j:
-            cmd.extend(["--preset-import-file", args.j])
-        else:
-            # Add preset and common options
-            cmd.extend([
-                "--preset", "Very Fast 1080p30",
-                "-r", "same as source",
-                "--encoder-level", "auto"
-            ])
-
-            # if running on MacOS, use VideoToolBox which is more efficient
-            if platform.system() == "Darwin":
-                cmd.extend(["-e", "vt_h265", "-q", "30"])
-            else:
-                cmd.extend(["-e", "h265", "-q", "22"])
+        infos = probe_files(job.clips, args.probe_workers)
+        groups = group_compatible(infos)
+        remux = {}
+        for group in groups:
+            remux.update(plan_remux(group))
+        duration = sum(info.duration for info in infos)
+        compressed = int(job.clip_bytes * COMPRESSED_SIZE_RATIO) if args.c else None
+        peak = estimate_peak_bytes(job)
+        free = planner.free_bytes(r_dir)
+        entry.update({
+            "action": "append" if job.append else "concat",
+            "clips": [{"name": info.path.name, "bytes": info.size, "duration": info.duration} for info in infos],
+            "clip_bytes": job.clip_bytes,
+            "duration": duration,
+            "groups": len(groups),
+            "remux": sorted(remux),
+            "outputs": [job.part_output(index).name for index in range(len(groups))],
+            "concat_bytes": None if job.single_pass else job.clip_bytes,
+            "compressed_bytes": compressed,
+            "peak_bytes": peak,
+            "estimated_seconds": predict_seconds(args, job.clip_bytes, infos, job.append),
+            "free_bytes": free,
+            "headroom_bytes": free - peak,
+        })
+        if len(groups) > 1 and (job.append or args.on_mismatch == "refuse"):
+            entry["error"] = "clips cannot be concatenated into one file"
+    except (OSError, RuntimeError) as e:
+        entry["error"] = str(e)
+    finally:
+        entry["dropped"] = [{"name": clip.name, "bytes": clip.size} for clip in dropped]
+    return entry
 
-        run_command(cmd, "HandBrake compression failed")
 
-        # === VERIFICATION: Check compressed file exists and has content ===
-        verify_output_file(output_file, "Compression")
+def build_plan(root: Path, directories: Iterable[Path], args: argparse.Namespace) -> dict:
+    """Run discovery and probing for every directory and collect the execution plan
 
-        # === VERIFICATION: Verify compressed file duration matches input ===
-        input_duration = get_video_duration(input_file)
-        output_duration = get_video_duration(output_file)
-        verify_duration_match(input_duration, output_duration, "Compression")
+    Nothing is written and ffmpeg/HandBrake are never started; only ffprobe
+    runs (and its results go into the probe cache as usual).
 
-    # if user added "-d" flag to delete old files
-    if args.d:
-        # loop through each file in sorted filelist and delete file
-        for file in filelist:
-            (current_path / file).unlink()
-        # if user added "-c" flag to compress concatenated files
-        if args.c:
-            # remove non-compressed file and rename compressed file
-            new = current_path / f"{title}.mp4"
-            old = current_path / f"{title}(cp).mp4"
-            new.unlink()
-            old.rename(new)
-
-
-def dir_no_subs(directory_path: Path) -> list[Path]:
-    """finds all directories with no subdirectories and returns their
-    absolute paths as a list using pathlib
-    
     Args:
-        directory_path: Root directory to search for leaf directories
-        
+        root: Root directory being planned
+        directories: Leaf directories in processing order
+        args: Command line arguments namespace
+
     Returns:
-        List of Path objects representing directories with no subdirectories
+        JSON-serializable plan with one entry per directory and batch totals
     """
+    planner = DiskPlanner(int(args.min_free * 1024 ** 3))
+    entries = []
+    with trace_span("plan", "discovery"):
+        for directory in schedule_directories(directories, args):
+            entries.append(plan_directory(root, directory, args, planner))
+            logger.info("Planned %s", directory)
 
-    all_directories = {directory_path}
-    has_subdirectories = set()
-
-    # Walk directories efficiently - only find directories, not files
-    # Note: rglob('*/') may match files on some Python versions, so we filter explicitly
-    for path in directory_path.rglob('*'):
-        if path.is_dir():
-            all_directories.add(path)
-            # Every directory found means its parent has a subdirectory
-            has_subdirectories.add(path.parent)
+    planned = [entry for entry in entries if "peak_bytes" in entry and "error" not in entry]
+    return {
+        "root": str(root),
+        "created": time.time(),
+        "options": {"compress": args.c, "delete": args.d, "encoder": args.encoder, "append": args.append,
+                    "on_mismatch": args.on_mismatch, "verify": args.verify, "jobs": args.jobs,
+                    "compress_jobs": args.compress_jobs, "size_limit": DEFAULT_SIZE_LIMIT},
+        "directories": entries,
+        "totals": {
+            "directories": len(planned),
+            "failed": sum(1 for entry in entries if "error" in entry),
+            "clip_bytes": sum(entry["clip_bytes"] for entry in planned),
+            "dropped_bytes": sum(clip["bytes"] for entry in entries for clip in entry["dropped"]),
+            "duplicate_bytes": sum(clip["bytes"] for entry in entries for clip in entry["duplicates"]),
+            "duration": sum(entry["duration"] for entry in planned),
+            "estimated_seconds": sum(entry["estimated_seconds"] for entry in planned),
+            "max_peak_bytes": max((entry["peak_bytes"] for entry in planned), default=0),
+        },
+    }
 
-    # Find leaf directories (those with no subdirectories)
-    nsub_list = list(all_directories - has_subdirectories)
 
-    # If no leaf directories found, return the root
-    if not nsub_list:
-        return [directory_path]
+def write_plan(plan: dict, destination: str) -> None:
+    """Write an execution plan as JSON
 
-    return sorted(nsub_list, key=str)
+    Args:
+        plan: Plan from build_plan
+        destination: File to write, or "-" for stdout
+    """
+    if destination == "-":
+        json.dump(plan, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+    with open(destination, "w", encoding="utf8") as f:
+        json.dump(plan, f, indent=2)
+    logger.info("Plan written to %s", destination)
 
 
 def check_c(args: argparse.Namespace) -> None:
@@ -364,7 +4776,7 @@ def validate_tools(args: argparse.Namespace) -> None:
     """Check that required tools (ffmpeg, ffprobe, and HandBrakeCLI) are installed
     
     Args:
-        args: Command line arguments namespace containing c flag to determine if HandBrakeCLI is needed
+        args: Command line arguments namespace containing c flag and encoder to determine if HandBrakeCLI is needed
     """
     # Check for ffmpeg (always required)
     if shutil.which("ffmpeg") is None:
@@ -378,25 +4790,153 @@ def validate_tools(args: argparse.Namespace) -> None:
             "Please ensure your ffmpeg installation includes ffprobe."
         )
 
-    # Check for HandBrakeCLI only if compression flag is set
-    if args.c and shutil.which("HandBrakeCLI") is None:
-        raise RuntimeError("HandBrakeCLI is not installed or not in PATH. Please install HandBrakeCLI or run without the -c flag.")
+    # Check for HandBrakeCLI only if it is going to compress
+    if args.c and args.encoder == "handbrake" and shutil.which("HandBrakeCLI") is None:
+        raise RuntimeError("HandBrakeCLI is not installed or not in PATH. Please install HandBrakeCLI, run without the -c flag or pick an ffmpeg --encoder.")
 
 
-def main() -> None:
-    """Main entry point for the script"""
+def build_parser() -> argparse.ArgumentParser:
+    """Build the command line argument parser
+
+    Returns:
+        Configured ArgumentParser
+    """
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        '-d', '--delete', help='Delete leftover files', action='store_true')
-    parser.add_argument('-c', '--compress',
+        '-d', '--delete', dest='d', help='Delete leftover files', action='store_true')
+    parser.add_argument('-c', '--compress', dest='c',
                         help='Compress concatenated files', action='store_true')
-    parser.add_argument('-f', '--filepath',
+    parser.add_argument('-f', '--filepath', dest='f',
                         help='Run script in specified directory')
     parser.add_argument(
-        '-j', '--json', help='Run compression with preset from given JSON file')
+        '-j', '--json', dest='j', help='Run compression with preset from given JSON file')
+    parser.add_argument(
+        '--encoder', choices=['handbrake', *FFMPEG_VIDEO_ENCODERS], default='handbrake',
+        help='Compress with HandBrakeCLI (the default) or with ffmpeg using libx265/libx264; with -c and -d '
+             'ffmpeg encodes while concatenating, without an intermediate file')
+    parser.add_argument(
+        '--chunks', type=int, default=1, metavar='N',
+        help=f'Split each file being compressed into up to N segments (at least {MIN_CHUNK_SECONDS}s long) '
+             f'at keyframes and encode them in parallel (default: 1)')
+    parser.add_argument(
+        '-y', '--yes', dest='y', help='Skip all confirmation prompts', action='store_true')
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help='Number of directories to concatenate in parallel (default: 1)')
+    parser.add_argument(
+        '--compress-jobs', type=int, default=1,
+        help='Number of directories to compress in parallel (default: 1)')
+    parser.add_argument(
+        '--queue-depth', type=int, default=2,
+        help='Maximum number of directories waiting between two stages (default: 2)')
+    parser.add_argument(
+        '--probe-workers', type=int, default=DEFAULT_PROBE_WORKERS,
+        help=f'Number of ffprobe processes to run at once (default: {DEFAULT_PROBE_WORKERS})')
+    parser.add_argument(
+        '--exclude', action='append', default=[], metavar='GLOB',
+        help='Skip directories whose name or relative path matches GLOB (repeatable)')
+    parser.add_argument(
+        '--max-depth', type=int,
+        help='Treat directories this many levels below the root as leaves')
+    parser.add_argument(
+        '--keep-duplicates', action='store_true',
+        help='Concatenate byte-identical copies of a clip instead of leaving them out')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Skip directories finished by an interrupted run and continue partial ones')
+    parser.add_argument(
+        '--append', action='store_true',
+        help='Add new clips to the end of an existing output instead of refusing to overwrite it')
+    parser.add_argument(
+        '--on-mismatch', choices=['refuse', 'split'], default='refuse',
+        help='When clips in a directory cannot be concatenated together, fail the directory (refuse, '
+             'the default) or write one output per group of compatible clips (split)')
+    parser.add_argument(
+        '--min-free', type=float, default=DEFAULT_MIN_FREE_GB, metavar='GB',
+        help=f'Free space to always leave on the disk when admitting directories (default: {DEFAULT_MIN_FREE_GB:g})')
+    parser.add_argument(
+        '--no-space-check', action='store_true',
+        help='Do not check free disk space before processing a directory')
+    parser.add_argument(
+        '--no-cpu-partition', action='store_true',
+        help='Let every encoder use all CPUs instead of splitting them between the encoders running at once')
+    parser.add_argument(
+        '--nice', type=int, metavar='N',
+        help='Run ffmpeg/HandBrake at this niceness (0-19, higher is lower priority)')
+    parser.add_argument(
+        '--ionice', choices=list(IOPRIO_CLASSES),
+        help='Run ffmpeg/HandBrake in this I/O scheduling class (Linux)')
+    parser.add_argument(
+        '--ionice-level', type=int, default=4, choices=range(8), metavar='0-7',
+        help='Priority within the --ionice class, 0 is highest (default: 4)')
+    parser.add_argument(
+        '--cpu-limit', type=float, metavar='CORES',
+        help='Run ffmpeg/HandBrake on at most this many CPUs')
+    parser.add_argument(
+        '--read-limit', type=float, metavar='MB/S',
+        help='Read clips no faster than this while concatenating')
+    parser.add_argument(
+        '--limits-file', metavar='JSON',
+        help='Control file that overrides the limits above while running; re-read when it changes or on SIGHUP')
+    parser.add_argument(
+        '--scratch', metavar='DIR',
+        help='Copy each directory\'s clips to this local folder ahead of time, process them there and move '
+             'only the outputs back (for clips on network shares)')
+    parser.add_argument(
+        '--scratch-max', type=float, metavar='GB',
+        help='Most space to use in the --scratch folder (default: its free space minus --min-free)')
+    parser.add_argument(
+        '--watch', action='store_true',
+        help='Keep running and process leaf directories as new clips arrive (Linux inotify)')
+    parser.add_argument(
+        '--settle', type=float, default=DEFAULT_SETTLE_SECONDS, metavar='SECONDS',
+        help=f'With --watch, wait until a directory has had no new clip data for this long '
+             f'(default: {DEFAULT_SETTLE_SECONDS:g})')
+    parser.add_argument(
+        '--command-timeout', type=float, metavar='SECONDS',
+        help='Kill any ffmpeg/HandBrake command still running after this long and fail its directory')
+    parser.add_argument(
+        '--no-progress', action='store_true',
+        help='Do not show progress, throughput and ETA while commands run')
+    parser.add_argument(
+        '--progress-interval', type=float, default=DEFAULT_PROGRESS_INTERVAL, metavar='SECONDS',
+        help=f'When not on a terminal, log progress this often (default: {DEFAULT_PROGRESS_INTERVAL:g})')
+    parser.add_argument(
+        '--plan', metavar='OUT_JSON',
+        help='Only probe the clips and write what would be done as JSON ("-" for stdout), without running ffmpeg')
     parser.add_argument(
-        '-y', '--yes', help='Skip all confirmation prompts', action='store_true')
-    args = parser.parse_args()
+        '--no-history', action='store_true',
+        help='Do not record measured throughput or use it to predict run times')
+    parser.add_argument(
+        '--show-throughput', action='store_true',
+        help='Print the throughput measured on earlier runs and exit')
+    parser.add_argument(
+        '--trace', metavar='OUT_JSON',
+        help='Write a Chrome trace-event file of the run (open in Perfetto)')
+    parser.add_argument(
+        '--verify', choices=['none', 'fast', 'standard', 'deep'], default='standard',
+        help='How outputs are checked: only that they exist (none), against the durations ffmpeg/HandBrake '
+             'report without running ffprobe (fast), probing when nothing was reported (standard, the default), '
+             'or also probing every output and decoding a few random windows of it (deep)')
+    parser.add_argument(
+        '--full-probe', action='store_true',
+        help='Probe every output with ffprobe instead of trusting ffmpeg/HandBrake progress output')
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='Do not read or update the persistent probe cache')
+    parser.add_argument(
+        '--cache-path',
+        help='Location of the probe cache database (default: $XDG_CACHE_HOME/ffmpeg_handbrake_combo/probe_cache.sqlite)')
+    return parser
+
+
+def main() -> None:
+    """Main entry point for the script"""
+    args = build_parser().parse_args()
+
+    if args.show_throughput:
+        print(format_throughput(read_throughput(default_cache_dir() / "throughput.sqlite")))
+        return
 
     # Determine target directory (either specified via -f or current directory)
     base_dir = Path(args.f).resolve() if args.f else Path.cwd()
@@ -405,6 +4945,17 @@ def main() -> None:
     if not base_dir.is_dir():
         raise RuntimeError(f"Target path is not a directory: {base_dir}")
 
+    if args.j and args.encoder != "handbrake":
+        raise RuntimeError("-j presets are HandBrake presets and need --encoder handbrake")
+
+    scratch_dir = Path(args.scratch).resolve() if args.scratch else None
+    if scratch_dir is not None:
+        if not scratch_dir.is_dir():
+            raise RuntimeError(f"Scratch directory does not exist: {scratch_dir}")
+        # a resumed or appended directory's earlier outputs are not in the scratch folder
+        if args.resume or args.append:
+            raise RuntimeError("--scratch cannot be combined with --resume or --append")
+
     # sets "folder" as base path of current working directory
     folder = base_dir.name
 
@@ -413,6 +4964,24 @@ def main() -> None:
 
     logger.info('Starting')
 
+    # a plan changes nothing, so it needs no confirmation, journal or archive folder
+    if args.plan:
+        cache = open_probe_cache(args)
+        set_probe_cache(cache)
+        model = open_throughput_model(args)
+        set_throughput_model(model)
+        try:
+            plan = build_plan(base_dir, walk_leaf_dirs(base_dir, tuple(args.exclude), args.max_depth), args)
+        finally:
+            set_throughput_model(None)
+            if model is not None:
+                model.close()
+            set_probe_cache(None)
+            if cache is not None:
+                cache.close()
+        write_plan(plan, args.plan)
+        return
+
     # if user added "-d" flag to delete old files
     if args.d:
         # asks user to confirm
@@ -425,21 +4994,114 @@ def main() -> None:
     # asks user to confirm current working directory is correct
     check_f(folder, args)
 
-    # fills "directory_list" with all directories to run ffmpeg in
-    directory_list = dir_no_subs(base_dir)
+    # record every directory's progress so an interrupted run can be resumed
+    journal = RunJournal(base_dir / JOURNAL_NAME, resume=args.resume)
+    set_journal(journal)
+
+    # record spans for the whole run if user asked for a trace
+    tracer = Tracer() if args.trace else None
+    set_tracer(tracer)
+
+    # lazily finds all directories to run ffmpeg in
+    directories = walk_leaf_dirs(base_dir, tuple(args.exclude), args.max_depth)
 
     # if user did not add "-d" flag to delete old files
     if not args.d:
         # creates directory to store old files
-        (base_dir / "files to delete").mkdir(parents=True, exist_ok=True)
+        (base_dir / ARCHIVE_DIR_NAME).mkdir(parents=True, exist_ok=True)
 
-    # loops through each folder in "directory_list"
-    for directory in directory_list:
-        # runs ffmpeg in current working directory
-        ffmpeg_concat(base_dir, directory, args)
+    # reuse ffprobe results from earlier runs for unchanged clips
+    cache = open_probe_cache(args)
+    set_probe_cache(cache)
+
+    # learn how fast this machine concatenates and encodes, to predict later runs
+    model = open_throughput_model(args)
+    set_throughput_model(model)
+
+    # only start directories whose outputs will fit on the disk
+    if not args.no_space_check:
+        set_disk_planner(DiskPlanner(int(args.min_free * 1024 ** 3)))
+
+    # stage clips on local disk ahead of processing
+    if scratch_dir is not None:
+        if args.scratch_max is not None:
+            capacity = int(args.scratch_max * 1024 ** 3)
+        else:
+            capacity = DiskPlanner(int(args.min_free * 1024 ** 3)).free_bytes(scratch_dir)
+        set_scratch_stager(ScratchStager(scratch_dir, capacity))
+        logger.info("Staging clips in %s (up to %d bytes)", scratch_dir, capacity)
+
+    # run ffmpeg/HandBrake with their output captured into per-directory logs
+    runner = CommandRunner(timeout=args.command_timeout)
+    set_command_runner(runner)
+
+    # show what is running and when the batch will be done
+    reporter = None
+    if not args.no_progress:
+        reporter = ProgressReporter(sys.stderr.isatty(), args.progress_interval)
+        set_progress_reporter(reporter)
+        reporter.start()
+
+    # give encoders running at the same time their own share of the CPUs
+    cpus = None if args.no_cpu_partition else available_cpus()
+    if cpus:
+        set_core_pool(CorePool(cpus))
+        logger.info("Splitting %d CPUs between encoders", len(cpus))
+
+    # keep ffmpeg/HandBrake from crowding out other services on the host
+    limits = Limits.from_args(args)
+    set_limits(limits)
+    control = None
+    previous_sighup = None
+    if args.limits_file:
+        control = LimitsControl(Path(args.limits_file), limits)
+        control.start()
+        if hasattr(signal, "SIGHUP"):
+            previous_sighup = signal.signal(signal.SIGHUP, lambda signum, frame: control.wake())
+
+    # runs ffmpeg in every folder found
+    try:
+        with trace_span("run", root=str(base_dir)):
+            if args.watch:
+                results = watch_directories(base_dir, args)
+            else:
+                results = process_directories(base_dir, directories, args)
+    finally:
+        if control is not None:
+            if previous_sighup is not None:
+                signal.signal(signal.SIGHUP, previous_sighup)
+            control.close()
+        set_disk_planner(None)
+        set_scratch_stager(None)
+        set_core_pool(None)
+        set_progress_reporter(None)
+        if reporter is not None:
+            reporter.close()
+        # kills whatever is still running if the run was interrupted
+        set_command_runner(None)
+        runner.cancel_all()
+        runner.close()
+        set_limits(Limits())
+        set_journal(None)
+        journal.close()
+        set_throughput_model(None)
+        if model is not None:
+            model.close()
+        set_probe_cache(None)
+        if cache is not None:
+            logger.info("Probe cache: %d hits, %d misses", cache.hits, cache.misses)
+            cache.close()
+        set_tracer(None)
+        if tracer is not None:
+            tracer.write(Path(args.trace))
+            logger.info("Trace written to %s", args.trace)
+    log_summary(results, args.verify)
 
     logger.info("FINISHED")
 
+    if any(not result.ok for result in results):
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()
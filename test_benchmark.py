@@ -0,0 +1,49 @@
+"""
+Unit Test Suite for the benchmark harness
+
+This test suite covers the parts of benchmark.py that do not need ffmpeg:
+- compare_to_baseline: Regression detection against a stored baseline
+- phase_totals: Turning trace spans into per-phase timings
+
+The harness itself is exercised by running benchmark.py.
+"""
+
+from benchmark import compare_to_baseline, phase_totals
+from main import Tracer, set_tracer, trace_span
+
+
+def test_compare_to_baseline_flags_slow_phases():
+    """Test that only phases slower than the threshold are reported"""
+    baseline = {"discovery": 1.0, "probing": 2.0, "concatenation": 4.0}
+    current = {"discovery": 1.1, "probing": 3.0, "concatenation": 3.0}
+
+    regressions = compare_to_baseline(current, baseline, threshold=0.2)
+
+    assert len(regressions) == 1
+    assert regressions[0].startswith("probing: 2.000s -> 3.000s")
+
+
+def test_compare_to_baseline_ignores_noise_and_new_phases():
+    """Test that tiny absolute changes and phases missing from the baseline pass"""
+    baseline = {"discovery": 0.001}
+    current = {"discovery": 0.004, "relocation": 9.0}
+
+    assert compare_to_baseline(current, baseline, threshold=0.2) == []
+    assert compare_to_baseline(current, baseline, threshold=0.2, noise_floor=0.0) != []
+
+
+def test_phase_totals_sums_spans():
+    """Test that stage spans are summed into the reported phases"""
+    tracer = Tracer()
+    set_tracer(tracer)
+    try:
+        for name in ["ffmpeg_stream_copy", "ffmpeg_stream_copy", "verify", "move", "probe"]:
+            with trace_span(name):
+                pass
+    finally:
+        set_tracer(None)
+
+    totals = phase_totals(tracer)
+
+    assert set(totals) == {"concatenation", "verification", "relocation"}
+    assert all(seconds >= 0 for seconds in totals.values())
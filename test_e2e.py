@@ -13,6 +13,7 @@ This test suite provides comprehensive E2E and integration testing covering:
 For unit tests (isolated function testing), see test_main.py
 """
 
+import argparse
 import os
 import subprocess
 import sys
@@ -32,6 +33,7 @@ warnings.filterwarnings("ignore", message="OpenCV: AVF: waiting to write video d
 
 # Import main module functions
 from main import (
+    build_parser,
     dir_no_subs,
     ffmpeg_concat,
     main,
@@ -89,13 +91,17 @@ def nested_structure(temp_dir):
 @pytest.fixture
 def mock_args():
     """Factory fixture to create mock args objects"""
-    class MockArgs:
-        def __init__(self, d=False, c=False, j=None, y=True, f=None):
+    class MockArgs(argparse.Namespace):
+        def __init__(self, d=False, c=False, j=None, y=True, f=None, **overrides):
+            # start from the real parser defaults so new options are always present
+            super().__init__(**vars(build_parser().parse_args([])))
             self.d = d
             self.c = c
             self.j = j
             self.y = y
             self.f = f
+            for name, value in overrides.items():
+                setattr(self, name, value)
     
     return MockArgs
 
@@ -2,24 +2,94 @@
 Unit Test Suite for FFmpeg/HandBrake Video Processing Tool
 
 This test suite provides unit tests for isolated function testing:
-- dir_no_subs: Directory traversal logic
+- dir_no_subs / walk_leaf_dirs: Directory traversal logic
+- scan_clips: Clip selection with cached stat data
 - check_c, check_d, check_f: Confirmation prompt logic
 - validate_tools: Tool validation logic
+- process_directories: Scheduling, stage pipeline and failure summary
+- relocate_files: Moving split files into the archive
+- MediaInfo / probe_files: ffprobe output parsing and batched probing
+- ProbeCache: Persistent probe cache keyed by path, size and mtime
+- FFmpegProgress / HandBrakeProgress / run_command: Progress output parsing
+- Tracer / trace_span: Chrome trace-event export
+- RunJournal / prepare_job: Crash-safe journal and --resume
+- check_append_compatible / prepare_job: --append onto an existing output
+- FolderWatcher / Inotify: --watch event handling and debouncing
+- DiskPlanner / estimate_peak_bytes: Free-space admission control
+- preflight_stage / group_compatible / plan_remux: Concat-compatibility pre-check
+- single_pass_encode / compress_file: ffmpeg encoder backend and single-pass concat+encode
+- chunk_count / compress_chunked: Chunked parallel compression of long files
+- CorePool / partition_cpus: Splitting CPUs between concurrent encoders
+- CommandRunner / run_command: asyncio subprocesses, logs, timeouts and cancellation
+- ProgressReporter: Live progress, throughput and ETA
+- plan_directory / build_plan: --plan dry run
+- ThroughputModel / predict_seconds: Historical throughput and runtime predictions
+- split_duplicates: Duplicate clip detection
+- measured_duration / check_durations / sample_decode: --verify levels
+- ScratchStager / fetch_stage: --scratch staging on local disk
+- Limits / LimitsControl: Niceness, I/O class, CPU cap and read limit for child processes
 
 For integration and E2E tests, see test_e2e.py
 """
 
+import argparse
+import errno
+import json
+import sys
 import tempfile
+import threading
+import time
 from pathlib import Path
 
 import pytest
 
+import main
 from main import (
+    ARCHIVE_DIR_NAME,
+    build_parser,
+    check_append_compatible,
+    chunk_count,
     dir_no_subs,
     check_c,
+    FFmpegProgress,
+    FolderWatcher,
+    group_compatible,
+    HandBrakeProgress,
+    Inotify,
     check_d,
+    Clip,
+    CommandRunner,
+    CorePool,
+    DirectoryJob,
+    DiskPlanner,
+    estimate_peak_bytes,
     check_f,
+    MediaInfo,
+    partition_cpus,
+    ProbeCache,
+    plan_remux,
+    probe_files,
+    probe_media,
+    relocate_files,
+    RelocationStats,
+    run_command,
+    set_probe_cache,
+    set_tracer,
+    single_pass_encode,
+    StreamInfo,
+    trace_span,
+    Tracer,
+    prepare_job,
+    process_directories,
+    RunJournal,
+    scan_clips,
+    set_core_pool,
+    set_disk_planner,
+    set_journal,
+    schedule_directories,
+    unique_destination,
     validate_tools,
+    walk_leaf_dirs,
 )
 
 
@@ -30,17 +100,52 @@ from main import (
 @pytest.fixture
 def mock_args():
     """Factory fixture to create mock args objects"""
-    class MockArgs:
-        def __init__(self, d=False, c=False, j=None, y=True, f=None):
+    class MockArgs(argparse.Namespace):
+        def __init__(self, d=False, c=False, j=None, y=True, f=None, **overrides):
+            # start from the real parser defaults so new options are always present
+            super().__init__(**vars(build_parser().parse_args([])))
             self.d = d
             self.c = c
             self.j = j
             self.y = y
             self.f = f
+            for name, value in overrides.items():
+                setattr(self, name, value)
     
     return MockArgs
 
 
+@pytest.fixture
+def make_job(tmp_path):
+    """Factory fixture to create directory jobs with clips written to disk"""
+    def make(args, name="cam", size=1000, count=1, root=None):
+        root = root or tmp_path
+        directory = root / name
+        directory.mkdir(parents=True)
+        clips = []
+        for letter in "abcdefgh"[:count]:
+            path = directory / f"{letter}.mp4"
+            # distinct contents, so the clips are never taken for duplicates
+            path.write_bytes((path.name.encode() * size)[:size])
+            clips.append(Clip(path.name, path, size, 0))
+        return DirectoryJob(root, directory, args, clips)
+
+    return make
+
+
+@pytest.fixture
+def media():
+    """Factory fixture to create probe results with one video and one audio stream"""
+    def make(path, width=1920, codec="h264", size=100, format_name="mov,mp4,m4a,3gp,3g2,mj2",
+             time_base="1/30000"):
+        return MediaInfo(path, 10.0, size, format_name, None, [
+            StreamInfo(0, "video", codec, "High", width, 1080, "yuv420p", "30/1", time_base),
+            StreamInfo(1, "audio", "aac", sample_rate=48000, channels=2, channel_layout="stereo"),
+        ])
+
+    return make
+
+
 # =============================================================================
 # Unit Tests - dir_no_subs
 # =============================================================================
@@ -108,6 +213,79 @@ def test_dir_no_subs4():
         ]
 
 
+def test_dir_no_subs_skips_archive_folder():
+    """Test that archived split files are not treated as leaf directories"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        (temp_path / "dir1").mkdir()
+        (temp_path / "files to delete" / "dir0 split files").mkdir(parents=True)
+
+        assert dir_no_subs(temp_path) == [temp_path / "dir1"]
+
+
+def test_dir_no_subs_archive_does_not_stop_root_being_a_leaf():
+    """Test that a flat root is still a leaf once its archive folder exists"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        (temp_path / "files to delete" / "root split files").mkdir(parents=True)
+
+        assert list(walk_leaf_dirs(temp_path)) == [temp_path]
+
+
+def test_dir_no_subs_exclude_and_max_depth():
+    """Test exclude globs and the maximum walk depth"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        (temp_path / "cam1" / "proxies").mkdir(parents=True)
+        (temp_path / "cam2" / "day1" / "raw").mkdir(parents=True)
+        (temp_path / "tmp_export").mkdir()
+
+        assert dir_no_subs(temp_path, exclude=("proxies", "tmp_*")) == [
+            temp_path / "cam1",
+            temp_path / "cam2" / "day1" / "raw",
+        ]
+        assert dir_no_subs(temp_path, exclude=("cam2/day1",)) == [
+            temp_path / "cam1" / "proxies",
+            temp_path / "cam2",
+            temp_path / "tmp_export",
+        ]
+        assert dir_no_subs(temp_path, max_depth=1) == [
+            temp_path / "cam1",
+            temp_path / "cam2",
+            temp_path / "tmp_export",
+        ]
+
+
+def test_walk_leaf_dirs_is_lazy():
+    """Test that leaf directories are yielded before the whole tree is walked"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        (temp_path / "a").mkdir()
+        (temp_path / "b").mkdir()
+
+        walker = walk_leaf_dirs(temp_path)
+        assert next(walker) == temp_path / "a"
+        # directories created after the first leaf was yielded are still found
+        (temp_path / "b" / "late").mkdir()
+        assert list(walker) == [temp_path / "b" / "late"]
+
+
+def test_scan_clips_filters_and_sorts():
+    """Test that scan_clips keeps small MP4 files in natural order with their stats"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        for name in ["clip10.MP4", "clip2.mp4", "notes.txt"]:
+            (temp_path / name).write_bytes(b"1234")
+        (temp_path / "folder.mp4").mkdir()
+
+        clips = scan_clips(temp_path)
+
+        assert [clip.name for clip in clips] == ["clip2.mp4", "clip10.MP4"]
+        assert clips[0].path == temp_path / "clip2.mp4"
+        assert clips[0].size == 4
+        assert clips[0].mtime_ns == (temp_path / "clip2.mp4").stat().st_mtime_ns
+
+
 # =============================================================================
 # Unit Tests - Tool Validation
 # =============================================================================
@@ -163,3 +341,1939 @@ class TestConfirmationPrompts:
         
         # Verify it logged the skip
         assert "confirmed via -y flag" in caplog.text.lower()
+
+
+# =============================================================================
+# Unit Tests - Parallel Directory Processing
+# =============================================================================
+
+class TestProcessDirectories:
+    """Tests for scheduling, the stage pipeline and the per-directory summary"""
+
+    @staticmethod
+    def make_dirs(tmp_path, names):
+        """Create leaf directories holding one small clip each"""
+        dirs = []
+        for name in names:
+            directory = tmp_path / name
+            directory.mkdir()
+            (directory / "clip.mp4").write_bytes(b"\0" * 10)
+            dirs.append(directory)
+        return dirs
+
+    @staticmethod
+    def patch_stages(monkeypatch, **stages):
+        """Replace pipeline stage functions, keeping the stage order"""
+        replaced = [(name, stages.get(name, lambda job: None)) for name, _ in main.PIPELINE_STAGES]
+        monkeypatch.setattr(main, "PIPELINE_STAGES", replaced)
+
+    def test_largest_directories_scheduled_first(self, tmp_path, mock_args):
+        """Test that directories are ordered by descending clip size with --jobs"""
+        sizes = {"small": 10, "large": 300, "medium": 100}
+        dirs = []
+        for name, size in sizes.items():
+            directory = tmp_path / name
+            directory.mkdir()
+            (directory / "clip.mp4").write_bytes(b"\0" * size)
+            dirs.append(directory)
+
+        ordered = schedule_directories(iter(dirs), mock_args(jobs=2))
+        assert [d.name for d in ordered] == ["large", "medium", "small"]
+
+        # a single job keeps discovery order and stays lazy
+        walker = iter(dirs)
+        assert schedule_directories(walker, mock_args(jobs=1)) is walker
+
+    def test_interrupt_kills_commands_and_stops_workers(self, tmp_path, mock_args, monkeypatch):
+        """Test that Ctrl-C kills the running command and no later directory starts one"""
+        monkeypatch.setattr(main, "_stopping", threading.Event())
+        dirs = self.make_dirs(tmp_path, ["a", "b", "c"])
+        runner = CommandRunner()
+        main.set_command_runner(runner)
+        started = []
+
+        def slow_concat(job):
+            started.append(job.title)
+            run_command([sys.executable, "-c", "import time; time.sleep(30)"], "FFmpeg concatenation failed")
+
+        def interrupted_walk():
+            yield dirs[0]
+            while not runner._processes:
+                threading.Event().wait(0.01)
+            yield dirs[1]
+            raise KeyboardInterrupt
+
+        self.patch_stages(monkeypatch, concat=slow_concat)
+        began = time.monotonic()
+        try:
+            with pytest.raises(KeyboardInterrupt):
+                process_directories(tmp_path, interrupted_walk(), mock_args(queue_depth=1))
+            assert time.monotonic() - began < 10
+            assert started == ["a"]
+            assert not runner._processes
+            with pytest.raises(RuntimeError, match="the run is being stopped"):
+                run_command(["true"], "failed")
+        finally:
+            main.set_command_runner(None)
+            runner.close()
+
+    def test_failures_do_not_stop_batch(self, tmp_path, mock_args, monkeypatch):
+        """Test that a RuntimeError in one directory is recorded and others still run"""
+        dirs = self.make_dirs(tmp_path, ["a", "b", "c"])
+        finalized = []
+
+        def fake_concat(job):
+            if job.title == "b":
+                raise RuntimeError("FFmpeg concatenation failed")
+
+        self.patch_stages(monkeypatch, concat=fake_concat,
+                          finalize=lambda job: finalized.append(job.title))
+
+        for jobs in (1, 3):
+            finalized.clear()
+            results = process_directories(tmp_path, dirs, mock_args(jobs=jobs))
+            outcome = {result.directory.name: result.ok for result in results}
+            assert outcome == {"a": True, "b": False, "c": True}
+            failed = [result for result in results if not result.ok]
+            assert failed[0].error == "concat: FFmpeg concatenation failed"
+            # a failed directory never reaches later stages
+            assert sorted(finalized) == ["a", "c"]
+
+    def test_concat_overlaps_compression(self, tmp_path, mock_args, monkeypatch):
+        """Test that the next directory is concatenated while the previous one compresses"""
+        dirs = self.make_dirs(tmp_path, ["first", "second"])
+        second_concat_started = threading.Event()
+
+        def fake_concat(job):
+            if job.title == "second":
+                second_concat_started.set()
+
+        def fake_compress(job):
+            if job.title == "first":
+                # would time out if stages ran strictly one directory at a time
+                assert second_concat_started.wait(timeout=5)
+
+        self.patch_stages(monkeypatch, concat=fake_concat, compress=fake_compress)
+        results = process_directories(tmp_path, dirs, mock_args(c=True))
+
+        assert all(result.ok for result in results)
+        assert len(results) == 2
+
+
+def test_unique_destination(tmp_path):
+    """Test that unique_destination never returns an existing path"""
+    target = tmp_path / "clips split files"
+    assert unique_destination(target) == target
+
+    target.mkdir()
+    (tmp_path / "clips split files (2)").mkdir()
+    assert unique_destination(target) == tmp_path / "clips split files (3)"
+
+
+class TestRelocation:
+    """Tests for moving split files into the archive"""
+
+    @staticmethod
+    def make_files(directory, names):
+        directory.mkdir(parents=True, exist_ok=True)
+        for name in names:
+            (directory / name).write_bytes(name.encode() * 100)
+        return [directory / name for name in names]
+
+    def test_same_device_is_renamed(self, tmp_path):
+        """Test that files on the destination's device are renamed, not copied"""
+        sources = self.make_files(tmp_path / "cam", ["a.mp4", "b.mp4"])
+        (tmp_path / "archive").mkdir()
+
+        stats = relocate_files(sources, tmp_path / "archive")
+
+        assert stats == RelocationStats(renamed=2)
+        assert sorted(p.name for p in (tmp_path / "archive").iterdir()) == ["a.mp4", "b.mp4"]
+        assert not any(source.exists() for source in sources)
+
+    def test_cross_device_falls_back_to_copy(self, tmp_path, monkeypatch):
+        """Test that a rename refused with EXDEV copies the data and removes the original"""
+        sources = self.make_files(tmp_path / "cam", ["a.mp4"])
+        mtime = sources[0].stat().st_mtime_ns - 10**9
+        main.os.utime(sources[0], ns=(mtime, mtime))
+        (tmp_path / "archive").mkdir()
+
+        def cross_device(source, destination):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+        monkeypatch.setattr(main.os, "rename", cross_device)
+        stats = relocate_files(sources, tmp_path / "archive")
+
+        moved = tmp_path / "archive" / "a.mp4"
+        assert stats.files == 1 and stats.renamed == 0
+        assert moved.read_bytes() == b"a.mp4" * 100
+        assert moved.stat().st_mtime_ns == mtime
+        assert not sources[0].exists()
+
+    def test_plain_copy_when_kernel_copies_fail(self, tmp_path, monkeypatch):
+        """Test the last-resort copy when reflinks and copy_file_range are unavailable"""
+        sources = self.make_files(tmp_path / "cam", ["a.mp4"])
+        import fcntl
+
+        def unsupported(*args):
+            raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+
+        monkeypatch.setattr(fcntl, "ioctl", unsupported)
+        monkeypatch.setattr(main.os, "copy_file_range", unsupported, raising=False)
+
+        assert main._copy_file(sources[0], tmp_path / "copy.mp4") == "copied"
+        assert (tmp_path / "copy.mp4").read_bytes() == b"a.mp4" * 100
+
+    def test_archive_stage_moves_clips_straight_to_archive(self, tmp_path, mock_args):
+        """Test that clips end up in the archive with one move each"""
+        self.make_files(tmp_path / "cam", ["a.mp4", "b.mp4", "cam.mp4"])
+        job = DirectoryJob(tmp_path, tmp_path / "cam", mock_args(), scan_clips(tmp_path / "cam"))
+        (tmp_path / ARCHIVE_DIR_NAME / "cam split files").mkdir(parents=True)
+
+        main.archive_stage(job)
+
+        archived = tmp_path / ARCHIVE_DIR_NAME / "cam split files (2)"
+        assert sorted(p.name for p in archived.iterdir()) == ["a.mp4", "b.mp4"]
+        assert [p.name for p in (tmp_path / "cam").iterdir()] == ["cam.mp4"]
+        assert job.relocation == RelocationStats(renamed=2)
+
+    def test_delete_waits_for_finalize(self, tmp_path, mock_args):
+        """Test that -d keeps the clips through archive and deletes them in finalize"""
+        self.make_files(tmp_path / "cam", ["a.mp4", "b.mp4", "cam.mp4"])
+        job = DirectoryJob(tmp_path, tmp_path / "cam", mock_args(d=True), scan_clips(tmp_path / "cam"))
+
+        main.archive_stage(job)
+        # a compression failing now still finds the clips
+        assert sorted(p.name for p in (tmp_path / "cam").iterdir()) == ["a.mp4", "b.mp4", "cam.mp4"]
+
+        main.finalize_stage(job)
+        assert [p.name for p in (tmp_path / "cam").iterdir()] == ["cam.mp4"]
+
+
+
+# =============================================================================
+# Unit Tests - Probing
+# =============================================================================
+
+class TestProbing:
+    """Tests for ffprobe result parsing and the batched probe engine"""
+
+    FFPROBE_OUTPUT = {
+        "format": {"duration": "12.500000", "size": "2048", "format_name": "mov,mp4,m4a,3gp,3g2,mj2",
+                   "bit_rate": "1310"},
+        "streams": [
+            {"index": 0, "codec_type": "video", "codec_name": "h264", "profile": "High",
+             "width": 1920, "height": 1080, "pix_fmt": "yuv420p", "r_frame_rate": "30000/1001",
+             "time_base": "1/30000", "duration": "12.479000"},
+            {"index": 1, "codec_type": "audio", "codec_name": "aac", "sample_rate": "48000",
+             "channels": 2, "channel_layout": "stereo", "time_base": "1/48000", "duration": "12.500000"},
+        ],
+    }
+
+    def test_media_info_from_ffprobe(self, tmp_path):
+        """Test that one ffprobe JSON result yields duration, size and stream layout"""
+        info = MediaInfo.from_ffprobe(tmp_path / "clip.mp4", self.FFPROBE_OUTPUT)
+
+        assert info.duration == 12.5
+        assert info.size == 2048
+        assert info.bit_rate == 1310
+        assert [s.codec_name for s in info.video_streams] == ["h264"]
+        assert info.video_streams[0].height == 1080
+        assert info.audio_streams[0].sample_rate == 48000
+        assert info.audio_streams[0].channels == 2
+
+    def test_media_info_falls_back_to_stream_duration(self, tmp_path):
+        """Test that a missing container duration uses the longest stream"""
+        data = {"format": {"duration": "N/A", "size": "10"}, "streams": self.FFPROBE_OUTPUT["streams"]}
+        info = MediaInfo.from_ffprobe(tmp_path / "clip.mp4", data)
+        assert info.duration == 12.5
+
+    def test_media_info_without_duration_raises(self, tmp_path):
+        """Test that a file with no duration anywhere is reported as an error"""
+        with pytest.raises(RuntimeError, match="Failed to parse duration"):
+            MediaInfo.from_ffprobe(tmp_path / "clip.mp4", {"format": {}, "streams": []})
+
+    def test_probe_files_preserves_order(self, tmp_path, monkeypatch):
+        """Test that concurrent probing returns results in input order"""
+        paths = [tmp_path / f"clip{i}.mp4" for i in range(10)]
+
+        def fake_probe(file_path):
+            return MediaInfo(file_path, float(file_path.stem[4:]), 0, "mp4", None, [])
+
+        monkeypatch.setattr(main, "probe_media", fake_probe)
+        infos = probe_files(paths, workers=4)
+
+        assert [info.path for info in infos] == paths
+        assert [info.duration for info in infos] == [float(i) for i in range(10)]
+
+
+# =============================================================================
+# Unit Tests - Probe Cache
+# =============================================================================
+
+class TestProbeCache:
+    """Tests for the persistent SQLite probe cache"""
+
+    DATA = {"format": {"duration": "3.0", "size": "4"}, "streams": []}
+
+    def test_hit_requires_same_size_and_mtime(self, tmp_path):
+        """Test that entries are reused only while size and mtime match"""
+        cache = ProbeCache(tmp_path / "cache.sqlite")
+        clip = tmp_path / "clip.mp4"
+        cache.put(clip, 4, 100, self.DATA)
+
+        assert cache.get(clip, 4, 100) == self.DATA
+        assert cache.get(clip, 4, 101) is None
+        # the stale entry is dropped, not just skipped
+        assert cache.get(clip, 4, 100) is None
+        assert (cache.hits, cache.misses) == (1, 2)
+        cache.close()
+
+    def test_persists_across_instances(self, tmp_path):
+        """Test that a new run sees entries written by a previous one"""
+        clip = tmp_path / "clip.mp4"
+        cache = ProbeCache(tmp_path / "cache.sqlite")
+        cache.put(clip, 4, 100, self.DATA)
+        cache.close()
+
+        cache = ProbeCache(tmp_path / "cache.sqlite")
+        assert cache.get(clip, 4, 100) == self.DATA
+        cache.close()
+
+    def test_prune_caps_entries(self, tmp_path):
+        """Test that the least recently used entries are evicted beyond the cap"""
+        cache = ProbeCache(tmp_path / "cache.sqlite", max_entries=2)
+        for i in range(4):
+            cache.put(tmp_path / f"clip{i}.mp4", 4, i, self.DATA)
+        cache.prune()
+
+        assert cache.get(tmp_path / "clip0.mp4", 4, 0) is None
+        assert cache.get(tmp_path / "clip3.mp4", 4, 3) == self.DATA
+        cache.close()
+
+    def test_probe_media_skips_ffprobe_for_unchanged_files(self, tmp_path, monkeypatch):
+        """Test that probe_media only runs ffprobe on a cache miss"""
+        clip = tmp_path / "clip.mp4"
+        clip.write_bytes(b"data")
+        calls = []
+
+        def fake_ffprobe(file_path):
+            calls.append(file_path)
+            return self.DATA
+
+        monkeypatch.setattr(main, "_run_ffprobe", fake_ffprobe)
+        cache = ProbeCache(tmp_path / "cache.sqlite")
+        set_probe_cache(cache)
+        try:
+            assert probe_media(clip).duration == 3.0
+            assert probe_media(clip).duration == 3.0
+            assert len(calls) == 1
+
+            clip.write_bytes(b"changed")
+            probe_media(clip)
+            assert len(calls) == 2
+        finally:
+            set_probe_cache(None)
+            cache.close()
+
+
+# =============================================================================
+# Unit Tests - Progress Parsing
+# =============================================================================
+
+class TestProgressParsing:
+    """Tests for reading output durations from ffmpeg and HandBrake progress"""
+
+    FFMPEG_LINES = [
+        "frame=120\n", "out_time_us=4000000\n", "progress=continue\n",
+        "frame=181\n", "out_time_us=6023000\n", "out_time=00:00:06.023000\n", "progress=end\n",
+    ]
+
+    HANDBRAKE_LINES = [
+        "Version: {\n", '"Name": "HandBrake"\n', "}\n",
+        "JSON Title Set: {\n", '"TitleList": [{"Duration": {"Hours": 0, "Minutes": 1, "Seconds": 30,\n',
+        '"Ticks": 8100000}}]\n', "}\n",
+        "Progress: {\n", '"State": "WORKING",\n', '"Working": {"Progress": 0.25, "Rate": 120.5}\n', "}\n",
+        "Progress: {\n", '"State": "WORKDONE",\n', '"WorkDone": {"Error": 0}\n', "}\n",
+    ]
+
+    def test_ffmpeg_progress_duration(self):
+        """Test that the final out_time is only trusted after progress=end"""
+        progress = FFmpegProgress()
+        for line in self.FFMPEG_LINES[:3]:
+            progress.feed(line)
+        assert progress.duration is None
+
+        for line in self.FFMPEG_LINES[3:]:
+            progress.feed(line)
+        assert progress.duration == pytest.approx(6.023)
+        assert progress.values["frame"] == "181"
+
+    def test_handbrake_progress(self):
+        """Test that HandBrake JSON blocks yield state, progress and source duration"""
+        progress = HandBrakeProgress()
+        for line in self.HANDBRAKE_LINES[:11]:
+            progress.feed(line)
+        assert progress.source_duration == 90.0
+        assert progress.state == "WORKING"
+        assert progress.fraction == 0.25
+        assert progress.rate == 120.5
+
+        for line in self.HANDBRAKE_LINES[11:]:
+            progress.feed(line)
+        assert progress.state == "WORKDONE"
+        assert progress.fraction == 1.0
+        assert progress.error == 0
+
+    def test_run_command_feeds_progress(self):
+        """Test that run_command streams stdout into the progress parser"""
+        script = "print('out_time_us=1500000'); print('progress=end')"
+        progress = FFmpegProgress()
+        run_command([sys.executable, "-c", script], "failed", progress)
+        assert progress.duration == 1.5
+
+    def test_run_command_with_progress_raises_on_failure(self):
+        """Test that a failing command still raises the given error"""
+        with pytest.raises(RuntimeError, match="tool failed"):
+            run_command([sys.executable, "-c", "raise SystemExit(3)"], "tool failed", FFmpegProgress())
+
+
+# =============================================================================
+# Unit Tests - Tracing
+# =============================================================================
+
+class TestTracing:
+    """Tests for span recording and Chrome trace-event output"""
+
+    def test_trace_span_is_noop_without_tracer(self):
+        """Test that spans cost nothing and record nothing when tracing is off"""
+        with trace_span("concat", directory="a") as span:
+            span["bytes"] = 10
+        assert span == {"directory": "a", "bytes": 10}
+
+    def test_spans_written_as_trace_events(self, tmp_path):
+        """Test that spans from several threads end up in a valid trace file"""
+        tracer = Tracer()
+        set_tracer(tracer)
+        # keep both threads alive together so they get distinct thread ids
+        barrier = threading.Barrier(2)
+        try:
+            def work(name):
+                with trace_span("concat", directory=name) as span:
+                    span["bytes"] = 42
+                    barrier.wait(timeout=5)
+
+            threads = [threading.Thread(target=work, args=(f"dir{i}",), name=f"concat-{i}") for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            with trace_span("probe", "probe", file="clip.mp4", bytes=None):
+                pass
+        finally:
+            set_tracer(None)
+
+        out = tmp_path / "trace.json"
+        tracer.write(out)
+        events = json.loads(out.read_text())["traceEvents"]
+
+        spans = [event for event in events if event["ph"] == "X"]
+        assert len(spans) == 3
+        concat = [event for event in spans if event["name"] == "concat"]
+        assert {event["args"]["directory"] for event in concat} == {"dir0", "dir1"}
+        assert all(event["args"]["bytes"] == 42 and event["dur"] >= 0 for event in concat)
+        # None values are dropped from the span arguments
+        assert [event["args"] for event in spans if event["name"] == "probe"] == [{"file": "clip.mp4"}]
+
+        thread_names = {event["args"]["name"] for event in events if event["ph"] == "M"}
+        assert {"concat-0", "concat-1"} <= thread_names
+
+
+# =============================================================================
+# Unit Tests - Run Journal
+# =============================================================================
+
+class TestRunJournal:
+    """Tests for the crash-safe run journal and --resume"""
+
+    @staticmethod
+    def make_clips(directory, names):
+        """Create small clips in a directory"""
+        directory.mkdir(parents=True, exist_ok=True)
+        for name in names:
+            (directory / name).write_bytes((name.encode() * 10)[:10])
+
+    def run_with_journal(self, tmp_path, directory, args, monkeypatch, fail_stage=None):
+        """Run process_directories with fake stages, optionally failing one stage"""
+        def make_stage(name):
+            def stage(job):
+                if name == fail_stage:
+                    raise RuntimeError(f"{name} crashed")
+                if name == "concat":
+                    job.output_file.write_bytes(b"output")
+                if name == "verify":
+                    job.output_duration = 30.0
+            return stage
+
+        stages = [(name, make_stage(name)) for name, _ in main.PIPELINE_STAGES]
+        monkeypatch.setattr(main, "PIPELINE_STAGES", stages)
+        journal = RunJournal(tmp_path / "journal.jsonl", resume=args.resume)
+        set_journal(journal)
+        try:
+            return process_directories(tmp_path, [directory], args)
+        finally:
+            set_journal(None)
+            journal.close()
+
+    def test_records_every_stage_boundary(self, tmp_path, mock_args, monkeypatch):
+        """Test that each stage writes a start and a done record"""
+        directory = tmp_path / "cam"
+        self.make_clips(directory, ["a.mp4", "b.mp4"])
+
+        self.run_with_journal(tmp_path, directory, mock_args(), monkeypatch)
+
+        records = [json.loads(line) for line in (tmp_path / "journal.jsonl").read_text().splitlines()]
+        assert [(r["stage"], r["status"]) for r in records] == [
+            (stage, status) for stage, _ in main.PIPELINE_STAGES for status in ("start", "done")
+        ]
+        concat_start = next(r for r in records if r["stage"] == "concat")
+        assert concat_start["clips"] == [["a.mp4", 10, (directory / "a.mp4").stat().st_mtime_ns],
+                                        ["b.mp4", 10, (directory / "b.mp4").stat().st_mtime_ns]]
+
+        state = RunJournal.load(tmp_path / "journal.jsonl")[str(directory)]
+        assert state.finished
+        assert state.output_duration == 30.0
+
+    def test_resume_continues_after_last_completed_stage(self, tmp_path, mock_args, monkeypatch):
+        """Test that --resume skips finished stages and removes the partial output"""
+        directory = tmp_path / "cam"
+        self.make_clips(directory, ["a.mp4"])
+        results = self.run_with_journal(tmp_path, directory, mock_args(c=True), monkeypatch,
+                                        fail_stage="compress")
+        assert not results[0].ok
+        (directory / "cam(cp).mp4").write_bytes(b"partial")
+
+        ran = []
+        stages = [(name, lambda job, name=name: ran.append(name)) for name, _ in main.PIPELINE_STAGES]
+        monkeypatch.setattr(main, "PIPELINE_STAGES", stages)
+        journal = RunJournal(tmp_path / "journal.jsonl", resume=True)
+        set_journal(journal)
+        try:
+            job = prepare_job(tmp_path, directory, mock_args(c=True, resume=True))
+        finally:
+            set_journal(None)
+            journal.close()
+
+        assert not (directory / "cam(cp).mp4").exists()
+        assert job.done_stages == {"concat", "verify", "archive"}
+        assert job.output_duration == 30.0
+        assert [clip.name for clip in job.clips] == ["a.mp4"]
+
+    def test_resume_archives_into_the_claimed_folder(self, tmp_path, mock_args):
+        """Test that an interrupted archive move carries on into the folder it already claimed"""
+        directory = tmp_path / "cam"
+        self.make_clips(directory, ["b.mp4", "cam.mp4"])
+        claimed = tmp_path / ARCHIVE_DIR_NAME / "cam split files"
+        claimed.mkdir(parents=True)
+        (claimed / "a.mp4").write_bytes(b"\0" * 10)
+        journal = RunJournal(tmp_path / "journal.jsonl")
+        journal.record(directory, "concat", "start", clips=[["a.mp4", 10, 0], ["b.mp4", 10, 0]])
+        for stage in ("fetch", "preflight", "concat", "verify"):
+            journal.record(directory, stage, "done")
+        journal.record(directory, "archive", "start")
+        journal.record(directory, "archive", "claimed", archive_dir=str(claimed))
+        journal.close()
+
+        journal = RunJournal(tmp_path / "journal.jsonl", resume=True)
+        set_journal(journal)
+        try:
+            job = prepare_job(tmp_path, directory, mock_args(resume=True))
+            main.archive_stage(job)
+        finally:
+            set_journal(None)
+            journal.close()
+
+        assert job.archive_dir == claimed
+        assert sorted(p.name for p in claimed.iterdir()) == ["a.mp4", "b.mp4"]
+        assert [p.name for p in (tmp_path / ARCHIVE_DIR_NAME).iterdir()] == ["cam split files"]
+
+    def test_fresh_run_keeps_unfinished_journal(self, tmp_path):
+        """Test that a run without --resume does not wipe what --resume still needs"""
+        path = tmp_path / "journal.jsonl"
+        journal = RunJournal(path)
+        journal.record(Path("/x"), "concat", "start", clips=[["a.mp4", 10, 0]])
+        journal.close()
+
+        RunJournal(path).close()
+        assert RunJournal.load(path)["/x"].in_progress == "concat"
+
+        journal = RunJournal(path)
+        for stage, _ in main.PIPELINE_STAGES:
+            journal.record(Path("/x"), stage, "done")
+        journal.close()
+        # once everything finished the next run starts a new journal
+        RunJournal(path).close()
+        assert path.read_text() == ""
+
+    def test_resume_restarts_interrupted_concat(self, tmp_path, mock_args, monkeypatch):
+        """Test that a half-written concatenation is deleted and redone"""
+        directory = tmp_path / "cam"
+        self.make_clips(directory, ["a.mp4", "b.mp4"])
+        journal = RunJournal(tmp_path / "journal.jsonl")
+        journal.record(directory, "concat", "start", clips=[["a.mp4", 10, 0], ["b.mp4", 10, 0]])
+        journal.close()
+        (directory / "cam.mp4").write_bytes(b"half")
+
+        journal = RunJournal(tmp_path / "journal.jsonl", resume=True)
+        set_journal(journal)
+        try:
+            job = prepare_job(tmp_path, directory, mock_args(resume=True))
+        finally:
+            set_journal(None)
+            journal.close()
+
+        assert not (directory / "cam.mp4").exists()
+        assert job.done_stages == set()
+        assert job.filelist == ["a.mp4", "b.mp4"]
+
+    def test_load_ignores_torn_last_line(self, tmp_path):
+        """Test that a record cut off by a crash does not break loading"""
+        path = tmp_path / "journal.jsonl"
+        path.write_text('{"directory": "/x", "stage": "concat", "status": "start", "clips": []}\n'
+                        '{"directory": "/x", "stage": "concat", "status": "do')
+
+        state = RunJournal.load(path)["/x"]
+        assert state.in_progress == "concat"
+        assert state.done == []
+
+
+# =============================================================================
+# Unit Tests - Append Mode
+# =============================================================================
+
+class TestAppend:
+    """Tests for --append onto an existing output"""
+
+    def test_scan_clips_skips_tool_outputs(self, tmp_path):
+        """Test that outputs of an earlier run are not picked up as new clips"""
+        directory = tmp_path / "cam"
+        directory.mkdir()
+        for name in ["cam.mp4", "cam(cp).mp4", "cam.tail.mp4", "new.mp4"]:
+            (directory / name).write_bytes(b"1234")
+
+        assert [clip.name for clip in scan_clips(directory)] == ["new.mp4"]
+
+    def test_check_append_compatible(self, tmp_path, media):
+        """Test that only clips with the same codec parameters can be appended"""
+        base = media(tmp_path / "cam.mp4")
+        check_append_compatible(base, [media(tmp_path / "a.mp4")])
+
+        with pytest.raises(RuntimeError, match="Cannot append b.mp4 to cam.mp4"):
+            check_append_compatible(base, [media(tmp_path / "a.mp4"),
+                                           media(tmp_path / "b.mp4", width=1280)])
+        with pytest.raises(RuntimeError, match="codec parameters differ"):
+            check_append_compatible(base, [media(tmp_path / "c.mp4", codec="hevc")])
+
+    def test_existing_output_requires_append(self, tmp_path, mock_args):
+        """Test that new clips are not concatenated over an existing output"""
+        directory = tmp_path / "cam"
+        TestRunJournal.make_clips(directory, ["cam.mp4", "a.mp4"])
+
+        with pytest.raises(RuntimeError, match="use --append"):
+            prepare_job(tmp_path, directory, mock_args())
+
+    def test_append_plans_tail_files(self, tmp_path, mock_args, media, monkeypatch):
+        """Test that --append routes the stages through the tail files"""
+        directory = tmp_path / "cam"
+        TestRunJournal.make_clips(directory, ["cam.mp4", "cam(cp).mp4", "a.mp4"])
+        monkeypatch.setattr(main, "probe_files", lambda paths, workers: [media(p) for p in paths])
+
+        job = prepare_job(tmp_path, directory, mock_args(c=True, append=True))
+
+        assert job.append and job.append_compressed
+        assert job.filelist == ["a.mp4"]
+        assert job.concat_output == directory / "cam.tail.mp4"
+        assert job.append_base == directory / "cam.mp4"
+        assert job.compress_input == directory / "cam.tail.mp4"
+        assert job.compress_output == directory / "cam.tail(cp).mp4"
+        assert job.compressed_base == directory / "cam(cp).mp4"
+
+    def test_append_with_delete_extends_compressed_output(self, tmp_path, mock_args, monkeypatch):
+        """Test that with -c and -d the existing output is treated as compressed"""
+        directory = tmp_path / "cam"
+        TestRunJournal.make_clips(directory, ["cam.mp4", "a.mp4"])
+        monkeypatch.setattr(main, "probe_files", lambda paths, workers: pytest.fail("nothing to probe"))
+
+        job = prepare_job(tmp_path, directory, mock_args(c=True, d=True, append=True))
+
+        assert job.append_base is None
+        assert job.compressed_base == directory / "cam.mp4"
+
+    def test_append_rejects_mismatched_clips(self, tmp_path, mock_args, media, monkeypatch):
+        """Test that clips that cannot be stream-copied fail before any work is done"""
+        directory = tmp_path / "cam"
+        TestRunJournal.make_clips(directory, ["cam.mp4", "a.mp4"])
+        monkeypatch.setattr(main, "probe_files", lambda paths, workers: [
+            media(p, width=1920 if p.name == "cam.mp4" else 1280) for p in paths])
+
+        with pytest.raises(RuntimeError, match="Cannot append a.mp4"):
+            prepare_job(tmp_path, directory, mock_args(append=True))
+
+    def test_resume_keeps_existing_output(self, tmp_path, mock_args, media, monkeypatch):
+        """Test that an interrupted append only discards the partial tail"""
+        directory = tmp_path / "cam"
+        TestRunJournal.make_clips(directory, ["cam.mp4", "cam.tail.mp4", "a.mp4"])
+        monkeypatch.setattr(main, "probe_files", lambda paths, workers: [media(p) for p in paths])
+        journal = RunJournal(tmp_path / "journal.jsonl")
+        journal.record(directory, "concat", "start", clips=[["a.mp4", 10, 0]], append=True,
+                       append_compressed=False)
+        journal.close()
+
+        journal = RunJournal(tmp_path / "journal.jsonl", resume=True)
+        set_journal(journal)
+        try:
+            job = prepare_job(tmp_path, directory, mock_args(resume=True, append=True))
+        finally:
+            set_journal(None)
+            journal.close()
+
+        assert job.append and job.done_stages == set()
+        assert (directory / "cam.mp4").exists()
+        assert not (directory / "cam.tail.mp4").exists()
+
+    def test_step_inside_stage_keeps_it_in_progress(self, tmp_path):
+        """Test that a recorded join does not mark its stage as finished"""
+        path = tmp_path / "journal.jsonl"
+        journal = RunJournal(path)
+        journal.record(Path("/x"), "concat", "start", clips=[], append=True)
+        journal.record(Path("/x"), "concat", "done")
+        journal.record(Path("/x"), "verify", "start")
+        journal.record(Path("/x"), "join", "done")
+        journal.close()
+
+        state = RunJournal.load(path)["/x"]
+        assert state.append
+        assert state.in_progress == "verify"
+        assert state.done == ["concat", "join"]
+
+
+# =============================================================================
+# Unit Tests - Watch Mode
+# =============================================================================
+
+class FakeInotify:
+    """Stands in for Inotify, handing out watch descriptors without a kernel"""
+
+    def __init__(self):
+        self.watches = {}
+        self.removed = []
+
+    def add_watch(self, path, mask):
+        return self.watches.setdefault(path, len(self.watches) + 1)
+
+    def rm_watch(self, wd):
+        self.removed.append(wd)
+
+    def close(self):
+        pass
+
+
+class TestFolderWatcher:
+    """Tests for the --watch event handling and debouncing"""
+
+    @staticmethod
+    def make_watcher(root, **kwargs):
+        inotify = FakeInotify()
+        return FolderWatcher(root, settle=10.0, inotify=inotify, **kwargs), inotify
+
+    def test_add_tree_watches_directories_and_finds_clips(self, tmp_path):
+        """Test that startup watches every directory but the archive and reports leaves with clips"""
+        TestRunJournal.make_clips(tmp_path / "a" / "cam1", ["x.mp4"])
+        TestRunJournal.make_clips(tmp_path / "a" / "cam2", ["cam2.mp4"])
+        (tmp_path / "b").mkdir()
+        (tmp_path / ARCHIVE_DIR_NAME / "old").mkdir(parents=True)
+
+        watcher, inotify = self.make_watcher(tmp_path)
+        found = watcher.add_tree(tmp_path)
+
+        assert found == [tmp_path / "a" / "cam1"]
+        assert set(inotify.watches) == {tmp_path, tmp_path / "a", tmp_path / "a" / "cam1",
+                                        tmp_path / "a" / "cam2", tmp_path / "b"}
+
+    def test_flat_root_with_archive_is_a_leaf(self, tmp_path):
+        """Test that clips directly in the root are found next to its archive and log folders"""
+        TestRunJournal.make_clips(tmp_path, ["x.mp4"])
+        (tmp_path / ARCHIVE_DIR_NAME).mkdir()
+        (tmp_path / main.LOG_DIR_NAME).mkdir()
+
+        watcher, inotify = self.make_watcher(tmp_path)
+
+        assert watcher.add_tree(tmp_path) == [tmp_path]
+        assert list(main.walk_leaf_dirs(tmp_path)) == [tmp_path]
+
+    def test_interrupt_kills_directory_in_progress(self, tmp_path, mock_args, monkeypatch):
+        """Test that Ctrl-C during --watch kills the running command and still returns the summary"""
+        monkeypatch.setattr(main, "_stopping", threading.Event())
+        TestRunJournal.make_clips(tmp_path / "cam", ["a.mp4"])
+        runner = CommandRunner()
+        main.set_command_runner(runner)
+
+        class InterruptedInotify(FakeInotify):
+            def read(self, timeout):
+                while not runner._processes:
+                    threading.Event().wait(0.01)
+                raise KeyboardInterrupt
+
+        def slow_concat(root, directory, args):
+            run_command([sys.executable, "-c", "import time; time.sleep(30)"], "FFmpeg concatenation failed")
+
+        monkeypatch.setattr(main, "Inotify", InterruptedInotify)
+        monkeypatch.setattr(main, "ffmpeg_concat", slow_concat)
+        began = time.monotonic()
+        try:
+            results = main.watch_directories(tmp_path, mock_args(settle=0.0))
+        finally:
+            main.set_command_runner(None)
+            runner.close()
+
+        assert time.monotonic() - began < 10
+        assert [(result.directory, result.ok) for result in results] == [(tmp_path / "cam", False)]
+
+    def test_clip_events_debounce_directory(self, tmp_path):
+        """Test that a directory is ready only once its clips stop changing"""
+        leaf = tmp_path / "cam"
+        leaf.mkdir()
+        watcher, inotify = self.make_watcher(tmp_path)
+        watcher.add_tree(tmp_path)
+        wd = inotify.watches[leaf]
+
+        watcher.handle(wd, main.IN_CREATE, "a.mp4", 0.0)
+        watcher.handle(wd, main.IN_MODIFY, "a.mp4", 5.0)
+        assert watcher.timeout(5.0) == 10.0
+        assert watcher.ready(14.0) == []
+        assert watcher.ready(15.0) == [leaf]
+        assert watcher.timeout(15.0) is None
+
+    def test_own_outputs_are_ignored(self, tmp_path):
+        """Test that files the tool writes do not retrigger a directory"""
+        leaf = tmp_path / "cam"
+        leaf.mkdir()
+        watcher, inotify = self.make_watcher(tmp_path)
+        watcher.add_tree(tmp_path)
+        wd = inotify.watches[leaf]
+
+        for name in ["cam.mp4", "cam(cp).mp4", "cam.tail.mp4", "files.txt"]:
+            watcher.handle(wd, main.IN_CLOSE_WRITE, name, 0.0)
+        watcher.handle(wd, main.IN_MOVED_FROM, "a.mp4", 0.0)
+        watcher.handle(inotify.watches[tmp_path], main.IN_CREATE | main.IN_ISDIR, ARCHIVE_DIR_NAME, 0.0)
+
+        assert watcher.timeout(0.0) is None
+        assert tmp_path / ARCHIVE_DIR_NAME not in inotify.watches
+
+    def test_new_directory_is_watched(self, tmp_path):
+        """Test that a directory created (or moved) into the tree is followed"""
+        watcher, inotify = self.make_watcher(tmp_path)
+        watcher.add_tree(tmp_path)
+        TestRunJournal.make_clips(tmp_path / "new" / "cam", ["a.mp4"])
+
+        watcher.handle(inotify.watches[tmp_path], main.IN_MOVED_TO | main.IN_ISDIR, "new", 0.0)
+
+        assert tmp_path / "new" / "cam" in inotify.watches
+        assert watcher.ready(10.0) == [tmp_path / "new" / "cam"]
+
+    def test_directory_that_gained_subdirectory_is_not_ready(self, tmp_path):
+        """Test that only leaf directories are processed"""
+        leaf = tmp_path / "cam"
+        leaf.mkdir()
+        watcher, inotify = self.make_watcher(tmp_path)
+        watcher.add_tree(tmp_path)
+        watcher.handle(inotify.watches[leaf], main.IN_CLOSE_WRITE, "a.mp4", 0.0)
+        (leaf / "day2").mkdir()
+
+        assert watcher.ready(10.0) == []
+
+    def test_moved_away_directory_is_forgotten(self, tmp_path):
+        """Test that watches below a directory moved out of the tree are dropped"""
+        (tmp_path / "a" / "cam").mkdir(parents=True)
+        watcher, inotify = self.make_watcher(tmp_path)
+        watcher.add_tree(tmp_path)
+        watcher.handle(inotify.watches[tmp_path / "a" / "cam"], main.IN_CLOSE_WRITE, "x.mp4", 0.0)
+
+        watcher.handle(inotify.watches[tmp_path], main.IN_MOVED_FROM | main.IN_ISDIR, "a", 1.0)
+
+        assert sorted(inotify.removed) == [inotify.watches[tmp_path / "a"], inotify.watches[tmp_path / "a" / "cam"]]
+        assert watcher.watch_count == 1
+        assert watcher.timeout(1.0) is None
+
+    @pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+    def test_inotify_reports_clip_writes(self, tmp_path):
+        """Test the ctypes inotify binding against the kernel"""
+        inotify = Inotify()
+        try:
+            wd = inotify.add_watch(tmp_path, main.WATCH_MASK)
+            (tmp_path / "a.mp4").write_bytes(b"data")
+            events = inotify.read(1.0)
+        finally:
+            inotify.close()
+
+        assert (wd, main.IN_CLOSE_WRITE, "a.mp4") in events
+
+
+# =============================================================================
+# Unit Tests - Disk Space Planning
+# =============================================================================
+
+class TestDiskPlanner:
+    """Tests for free-space admission control"""
+
+    @staticmethod
+    def planner_with_free(free):
+        planner = DiskPlanner()
+        planner.free_bytes = lambda path: free
+        return planner
+
+    def test_estimate_peak_bytes(self, mock_args, make_job):
+        """Test the peak for each combination of -c and -d"""
+        assert estimate_peak_bytes(make_job(mock_args(), "a")) == 1000
+        assert estimate_peak_bytes(make_job(mock_args(c=True), "b")) == 1500
+        # with -d the clips are only deleted after compression
+        assert estimate_peak_bytes(make_job(mock_args(c=True, d=True), "c")) == 1500
+
+    def test_estimate_peak_bytes_append(self, mock_args, make_job):
+        """Test that joining counts the copy written beside the existing output"""
+        job = make_job(mock_args(append=True))
+        (job.directory / "cam.mp4").write_bytes(b"\0" * 5000)
+        job.append = True
+
+        # tail + joined copy of the 5000 byte output and the tail
+        assert estimate_peak_bytes(job) == 1000 + 5000 + 1000
+
+    def test_admits_what_fits_and_releases(self, mock_args, make_job):
+        """Test that reservations add up and are given back"""
+        planner = self.planner_with_free(2500)
+        first = make_job(mock_args(), "a")
+        second = make_job(mock_args(), "b")
+
+        planner.admit(first)
+        planner.admit(second)
+        planner.release(first)
+        planner.release(second)
+        planner.admit(make_job(mock_args(), "c", size=2500))
+
+    def test_rejects_directory_that_never_fits(self, mock_args, make_job):
+        """Test that a directory larger than the free space fails immediately"""
+        planner = self.planner_with_free(999)
+        with pytest.raises(RuntimeError, match="Not enough free space: needs about 1000 bytes, 999 available"):
+            planner.admit(make_job(mock_args()))
+
+    def test_waits_for_running_directory(self, mock_args, make_job):
+        """Test that a directory that fits later waits for a reservation to be released"""
+        planner = self.planner_with_free(1500)
+        running = make_job(mock_args(), "a")
+        waiting = make_job(mock_args(), "b")
+        planner.admit(running)
+
+        admitted = threading.Event()
+        thread = threading.Thread(target=lambda: (planner.admit(waiting), admitted.set()))
+        thread.start()
+        assert not admitted.wait(timeout=0.2)
+        planner.release(running)
+        assert admitted.wait(timeout=5)
+        thread.join()
+
+    def test_pipeline_skips_directories_that_do_not_fit(self, tmp_path, mock_args, monkeypatch):
+        """Test that an oversized directory is reported and the rest still run"""
+        small, big = TestProcessDirectories.make_dirs(tmp_path, ["small", "big"])
+        (big / "clip.mp4").write_bytes(b"\0" * 100)
+        TestProcessDirectories.patch_stages(monkeypatch)
+        set_disk_planner(self.planner_with_free(50))
+        try:
+            results = process_directories(tmp_path, [small, big], mock_args())
+        finally:
+            set_disk_planner(None)
+
+        outcome = {result.directory.name: result for result in results}
+        assert outcome["small"].ok
+        assert not outcome["big"].ok
+        assert "Not enough free space" in outcome["big"].error
+
+    def test_pipeline_stops_when_first_directory_does_not_fit(self, tmp_path, mock_args, monkeypatch):
+        """Test that a batch whose first directory does not fit on an idle disk stops with one error"""
+        monkeypatch.setattr(main, "_stopping", threading.Event())
+        big, small = TestProcessDirectories.make_dirs(tmp_path, ["big", "small"])
+        (big / "clip.mp4").write_bytes(b"\0" * 100)
+        started = []
+        TestProcessDirectories.patch_stages(monkeypatch, concat=lambda job: started.append(job.title))
+        set_disk_planner(self.planner_with_free(50))
+        try:
+            with pytest.raises(RuntimeError, match="big does not fit even with nothing else running"):
+                process_directories(tmp_path, [big, small], mock_args())
+        finally:
+            set_disk_planner(None)
+        assert started == []
+
+
+# =============================================================================
+# Unit Tests - Preflight
+# =============================================================================
+
+class TestPreflight:
+    """Tests for the concat-compatibility pre-check, grouping and remux planning"""
+
+    @staticmethod
+    def make_job(tmp_path, args, widths, media, monkeypatch):
+        directory = tmp_path / "cam"
+        directory.mkdir()
+        clips = [Clip(f"c{i}.mp4", directory / f"c{i}.mp4", 100, 0) for i in range(len(widths))]
+        infos = [media(clip.path, width) for clip, width in zip(clips, widths)]
+        monkeypatch.setattr(main, "probe_files", lambda clips, workers: infos)
+        return DirectoryJob(tmp_path, directory, args, clips)
+
+    def test_group_compatible_keeps_runs_in_order(self, tmp_path, media):
+        """Test that groups are consecutive runs of matching clips"""
+        infos = [media(tmp_path / name, width) for name, width in
+                 [("a", 1920), ("b", 1920), ("c", 1280), ("d", 1920)]]
+        groups = group_compatible(infos)
+        assert [[info.path.name for info in group] for group in groups] == [["a", "b"], ["c"], ["d"]]
+
+    def test_plan_remux_container_and_timescale(self, tmp_path, media):
+        """Test that clips differing only in container or timescale are remuxed to the group's timescale"""
+        group = [
+            media(tmp_path / "a.mp4"),
+            media(tmp_path / "b.mp4", time_base="1/90000"),
+            media(tmp_path / "c.mp4", format_name="matroska,webm", time_base="1/1000"),
+            media(tmp_path / "d.mp4"),
+        ]
+        assert plan_remux(group) == {"b.mp4": 30000, "c.mp4": 30000}
+
+    def test_part_names_only_skipped_when_the_tool_writes_them(self, tmp_path, mock_args, caplog):
+        """Test that a camera clip named like the first part is kept and skipped outputs are reported"""
+        directory = tmp_path / "cam"
+        directory.mkdir()
+        for name in ["cam part 1.mp4", "cam part 2.mp4", "cam part 2(cp).mp4", "cam.remux.a.mp4"]:
+            (directory / name).write_bytes(name.encode())
+
+        with caplog.at_level("WARNING"):
+            job = prepare_job(tmp_path, directory, mock_args())
+
+        assert job.filelist == ["cam part 1.mp4"]
+        for name in ["cam part 2.mp4", "cam part 2(cp).mp4", "cam.remux.a.mp4"]:
+            assert f"Skipping {name} in {directory}, it is named like an output" in caplog.text
+
+    def test_refuses_mismatched_clips_by_default(self, tmp_path, mock_args, media, monkeypatch):
+        """Test that mixed clips fail before anything is written"""
+        job = self.make_job(tmp_path, mock_args(), [1920, 1280], media, monkeypatch)
+        with pytest.raises(RuntimeError, match="use --on-mismatch split"):
+            main.preflight_stage(job)
+
+    def test_split_writes_one_output_per_group(self, tmp_path, mock_args, media, monkeypatch):
+        """Test that --on-mismatch split gives every group its own output"""
+        job = self.make_job(tmp_path, mock_args(on_mismatch="split"), [1920, 1920, 1280], media, monkeypatch)
+        main.preflight_stage(job)
+
+        assert job.group_sizes == [2, 1]
+        assert [[clip.name for clip in group] for group in job.groups] == [["c0.mp4", "c1.mp4"], ["c2.mp4"]]
+        assert job.part_output(0) == job.directory / "cam.mp4"
+        assert job.part_output(1) == job.directory / "cam part 2.mp4"
+        assert job.part_compressed(1) == job.directory / "cam part 2(cp).mp4"
+        assert job.remux == {}
+
+    def test_append_never_splits(self, tmp_path, mock_args, media, monkeypatch):
+        """Test that appended clips must all fit the existing output"""
+        job = self.make_job(tmp_path, mock_args(on_mismatch="split"), [1920, 1280], media, monkeypatch)
+        job.append = True
+        with pytest.raises(RuntimeError, match="cannot be concatenated into one file"):
+            main.preflight_stage(job)
+
+    def test_outputs_are_not_clips(self):
+        """Test that part outputs and remux temporaries are recognised as the tool's own files"""
+        for name in ["cam.mp4", "CAM(cp).mp4", "cam part 2.mp4", "cam part 12(cp).mp4",
+                     "cam.remux.c1.mp4", "cam.tail(cp).mp4", "cam(cp).appending.mp4"]:
+            assert main.is_output_name("cam", name), name
+        for name in ["c1.mp4", "cam2.mp4", "cam part two.mp4", "other.mp4"]:
+            assert not main.is_output_name("cam", name), name
+
+    def test_finalize_replaces_every_part(self, tmp_path, mock_args):
+        """Test that with -c and -d each part is replaced by its compressed version"""
+        directory = tmp_path / "cam"
+        directory.mkdir()
+        job = DirectoryJob(tmp_path, directory, mock_args(c=True, d=True),
+                           [Clip("a.mp4", directory / "a.mp4", 1, 0), Clip("b.mp4", directory / "b.mp4", 1, 0)],
+                           group_sizes=[1, 1])
+        for name in ["cam.mp4", "cam(cp).mp4", "cam part 2.mp4", "cam part 2(cp).mp4"]:
+            (directory / name).write_text(name)
+
+        main.finalize_stage(job)
+
+        assert sorted(p.name for p in directory.iterdir()) == ["cam part 2.mp4", "cam.mp4"]
+        assert (directory / "cam part 2.mp4").read_text() == "cam part 2(cp).mp4"
+
+
+class TestSinglePassEncode:
+    """Tests for the ffmpeg encoder backend and single-pass concat+encode"""
+
+    def test_single_pass_needs_ffmpeg_encoder_compress_and_delete(self, mock_args, make_job):
+        """Test that only -c -d with an ffmpeg encoder skips the intermediate file"""
+        assert single_pass_encode(mock_args(c=True, d=True, encoder="x265"))
+        assert not single_pass_encode(mock_args(c=True, d=True))
+        assert not single_pass_encode(mock_args(c=True, encoder="x264"))
+
+        job = make_job(mock_args(c=True, d=True, encoder="x265"), count=2)
+        assert job.single_pass
+        job.append = True
+        assert not job.single_pass
+
+    def test_concat_encodes_straight_into_output(self, mock_args, make_job, monkeypatch):
+        """Test that the concat demuxer feeds the encoder and compression is skipped"""
+        job = make_job(mock_args(c=True, d=True, encoder="x264"), count=2)
+        commands = []
+
+        def fake_run_command(cmd, error_message, progress=None, cores=None, log_file=None):
+            commands.append(cmd)
+            progress.feed("out_time_us=20000000")
+            progress.feed("progress=end")
+
+        monkeypatch.setattr(main, "run_command", fake_run_command)
+        main.concat_stage(job)
+        main.compress_stage(job)
+
+        assert len(commands) == 1
+        cmd = commands[0]
+        assert cmd[:5] == ["ffmpeg", "-f", "concat", "-safe", "0"]
+        assert "copy" not in cmd
+        assert cmd[cmd.index("-c:v") + 1] == "libx264"
+        assert cmd[cmd.index("-crf") + 1] == "22"
+        assert cmd[-1] == str(job.output_file)
+        assert job.reported_durations == [20.0]
+        assert not (job.directory / "files.txt").exists()
+
+    def test_ffmpeg_compression_uses_reported_duration(self, mock_args, make_job, monkeypatch):
+        """Test that the two-pass ffmpeg backend trusts its progress output instead of probing"""
+        job = make_job(mock_args(c=True, encoder="x265"), count=2)
+        job.output_file.write_bytes(b"\0" * 10)
+
+        def fake_run_command(cmd, error_message, progress=None, cores=None, log_file=None):
+            assert cmd[:4] == ["ffmpeg", "-y", "-i", str(job.output_file)]
+            assert cmd[cmd.index("-c:v") + 1] == "libx265"
+            Path(cmd[-1]).write_bytes(b"\0" * 5)
+            progress.feed("out_time_us=12000000")
+            progress.feed("progress=end")
+
+        def fail_probe(file_path):
+            raise AssertionError(f"unexpected probe of {file_path}")
+
+        monkeypatch.setattr(main, "run_command", fake_run_command)
+        monkeypatch.setattr(main, "get_video_duration", fail_probe)
+        main.compress_file(job, job.output_file, job.compressed_file, 12.0)
+
+        assert job.compressed_file.exists()
+
+    def test_estimate_peak_bytes_single_pass(self, mock_args, make_job):
+        """Test that no uncompressed copy is planned for"""
+        job = make_job(mock_args(c=True, d=True, encoder="x265"), count=2)
+        assert estimate_peak_bytes(job) == 1000
+
+    def test_validate_tools_without_handbrake(self, mock_args, monkeypatch):
+        """Test that HandBrakeCLI is not required with an ffmpeg encoder"""
+        monkeypatch.setattr(main.shutil, "which", lambda tool: None if tool == "HandBrakeCLI" else tool)
+        validate_tools(mock_args(c=True, encoder="x265"))
+        with pytest.raises(RuntimeError, match="HandBrakeCLI"):
+            validate_tools(mock_args(c=True))
+
+
+class TestChunkedCompression:
+    """Tests for splitting long files into segments that are encoded in parallel"""
+
+    def test_chunk_count_keeps_segments_long(self, mock_args):
+        """Test that short files are not split into tiny segments"""
+        assert chunk_count(mock_args(chunks=4), 6 * 3600) == 4
+        assert chunk_count(mock_args(chunks=4), 2.5 * main.MIN_CHUNK_SECONDS) == 2
+        assert chunk_count(mock_args(chunks=4), 60) == 1
+        assert not single_pass_encode(mock_args(c=True, d=True, encoder="x265", chunks=4))
+
+    def test_chunk_files_are_outputs(self):
+        """Test that segments are never picked up as clips"""
+        for name in ["cam(cp).chunk000.mp4", "cam part 2(cp).chunk012.enc.mp4", "cam.tail(cp).chunk001.mp4"]:
+            assert main.is_output_name("cam", name), name
+
+    def test_splits_encodes_in_parallel_and_joins(self, tmp_path, mock_args, monkeypatch):
+        """Test the split, parallel encode and stream-copy join of a long file"""
+        directory = tmp_path / "cam"
+        directory.mkdir()
+        job = DirectoryJob(tmp_path, directory, mock_args(c=True, chunks=3, encoder="x265"),
+                           [Clip("a.mp4", directory / "a.mp4", 1, 0)])
+        job.output_file.write_bytes(b"\0" * 30)
+        running = 0
+        peak = 0
+        lock = threading.Lock()
+        both_running = threading.Barrier(3, timeout=5)
+        commands = []
+
+        def fake_run_command(cmd, error_message, progress=None, cores=None, log_file=None):
+            nonlocal running, peak
+            commands.append(cmd)
+            if "segment" in cmd:
+                split_points = cmd[cmd.index("-segment_times") + 1]
+                assert split_points == "1200.000,2400.000"
+                for n in range(3):
+                    (directory / f"cam(cp).chunk{n:03d}.mp4").write_bytes(b"\0" * 10)
+            elif "concat" in cmd:
+                entries = Path(cmd[cmd.index("-i") + 1]).read_text()
+                assert entries.splitlines() == [f"file 'cam(cp).chunk{n:03d}.enc.mp4'" for n in range(3)]
+                Path(cmd[-1]).write_bytes(b"\0" * 15)
+                progress.feed("out_time_us=3600000000")
+                progress.feed("progress=end")
+            else:
+                with lock:
+                    running += 1
+                    peak = max(peak, running)
+                both_running.wait()
+                Path(cmd[-1]).write_bytes(b"\0" * 5)
+                with lock:
+                    running -= 1
+
+        monkeypatch.setattr(main, "run_command", fake_run_command)
+        main.compress_file(job, job.output_file, job.compressed_file, 3600.0)
+
+        assert peak == 3
+        assert len(commands) == 5
+        assert sorted(p.name for p in directory.iterdir()) == ["cam(cp).mp4", "cam.mp4"]
+
+    def test_estimate_peak_bytes_counts_segments(self, tmp_path, mock_args):
+        """Test that the segment copy of the input is planned for"""
+        directory = tmp_path / "cam"
+        directory.mkdir()
+        job = DirectoryJob(tmp_path, directory, mock_args(c=True, chunks=4),
+                           [Clip("a.mp4", directory / "a.mp4", 1000, 0)])
+        assert estimate_peak_bytes(job) == 1000 + 500 + 1000
+
+
+class TestCorePool:
+    """Tests for splitting CPUs between concurrent encoder processes"""
+
+    def test_partition_cpus(self):
+        """Test contiguous, nearly equal shares, and sharing once CPUs run out"""
+        assert partition_cpus([0, 1, 2, 3, 4, 5, 6], 3) == [[0, 1, 2], [3, 4], [5, 6]]
+        assert partition_cpus([0, 1], 1) == [[0, 1]]
+        assert partition_cpus([0, 1], 3) == [[0], [1], [0]]
+
+    def test_available_cpus_respects_cgroup_quota(self, monkeypatch):
+        """Test that a CPU quota limits how many CPUs are handed out"""
+        monkeypatch.setattr(main.os, "sched_getaffinity", lambda pid: {0, 1, 2, 3, 4, 5, 6, 7}, raising=False)
+        monkeypatch.setattr(main, "cgroup_cpu_limit", lambda: 2.5)
+        assert main.available_cpus() == [0, 1]
+        monkeypatch.setattr(main, "cgroup_cpu_limit", lambda: None)
+        assert main.available_cpus() == list(range(8))
+
+    def test_finished_encoders_hand_cores_back(self, monkeypatch):
+        """Test that running encoders are re-pinned when others start and finish"""
+        pinned = {}
+        monkeypatch.setattr(main, "pin_process", lambda pid, cpus: pinned.__setitem__(pid, cpus))
+        pool = CorePool([0, 1, 2, 3])
+
+        with pool.lease() as first:
+            first.attach(100)
+            assert pinned[100] == [0, 1, 2, 3]
+            with pool.lease() as second:
+                second.attach(200)
+                assert second.threads == 2
+                assert pinned == {100: [0, 1], 200: [2, 3]}
+                second.attach(None)
+            # the second encoder's cores go back to the first
+            assert pinned[100] == [0, 1, 2, 3]
+            assert first.threads == 4
+
+    def test_encoder_threads_follow_lease(self, tmp_path, mock_args, monkeypatch):
+        """Test that encoder commands ask for as many threads as their share of CPUs"""
+        monkeypatch.setattr(main, "pin_process", lambda pid, cpus: None)
+        set_core_pool(CorePool([0, 1, 2, 3, 4, 5]))
+        try:
+            with main.core_lease() as cores:
+                x265 = main.ffmpeg_encode_options("x265", cores)
+                assert x265[x265.index("-threads") + 1] == "6"
+                assert x265[x265.index("-x265-params") + 1] == "pools=6"
+                with main.core_lease() as other:
+                    handbrake = main.handbrake_command(tmp_path / "in.mp4", tmp_path / "out.mp4", mock_args(), other)
+                    if "--encopts" in handbrake:
+                        assert handbrake[handbrake.index("--encopts") + 1] == "pools=3"
+        finally:
+            set_core_pool(None)
+        assert "-threads" not in main.ffmpeg_encode_options("x264")
+
+    def test_run_command_attaches_process(self):
+        """Test that run_command pins the started process and forgets it once it exited"""
+        attached = []
+
+        class FakeLease:
+            cpus = [0]
+
+            def attach(self, pid):
+                attached.append(pid)
+
+        run_command([sys.executable, "-c", "pass"], "failed", cores=FakeLease())
+        assert len(attached) == 2
+        assert isinstance(attached[0], int) and attached[1] is None
+
+
+class TestCommandRunner:
+    """Tests for the asyncio command runner and per-directory logs"""
+
+    def test_logs_are_kept_outside_the_clip_folders(self, tmp_path, mock_args):
+        """Test that each directory logs under the root, apart from same-named leaves elsewhere"""
+        job = DirectoryJob(tmp_path, tmp_path / "2024" / "cam", mock_args(), [])
+        assert job.log_file == tmp_path / main.LOG_DIR_NAME / "2024 - cam.log"
+        assert main.directory_log(tmp_path, tmp_path / "2023" / "cam") != job.log_file
+
+        run_command([sys.executable, "-c", "print('hello')"], "failed", log_file=job.log_file)
+        assert "hello" in job.log_file.read_text()
+
+    def test_error_ends_with_last_stderr_lines(self, tmp_path):
+        """Test that a failure quotes the tool's last lines and the full output goes to the log"""
+        script = ("import sys\n"
+                  "for n in range(50): print(f'line {n}', file=sys.stderr)\n"
+                  "print('Invalid data found when processing input', file=sys.stderr)\n"
+                  "sys.exit(1)")
+        log_file = tmp_path / "cam.log"
+        with pytest.raises(RuntimeError) as excinfo:
+            run_command([sys.executable, "-c", script], "FFmpeg concatenation failed", log_file=log_file)
+
+        message = str(excinfo.value)
+        assert message.startswith("FFmpeg concatenation failed (exit status 1):")
+        assert message.rstrip().endswith("Invalid data found when processing input")
+        assert "line 41" in message and "line 40" not in message
+        log = log_file.read_text()
+        assert log.startswith("$ ")
+        assert "line 0\n" in log and "line 49\n" in log
+
+    def test_many_commands_run_at_once(self):
+        """Test that concurrent callers each get their own process and output"""
+        runner = CommandRunner()
+        try:
+            results = {}
+
+            def call(n):
+                progress = FFmpegProgress()
+                runner.run([sys.executable, "-c", f"import time; time.sleep(0.5); print('out_time_us={n}000000'); "
+                            f"print('progress=end')"], "failed", progress)
+                results[n] = progress.duration
+
+            threads = [threading.Thread(target=call, args=(n,)) for n in range(1, 9)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(timeout=10)
+            assert results == {n: float(n) for n in range(1, 9)}
+        finally:
+            runner.close()
+
+    def test_timeout_kills_command(self):
+        """Test that a command running past the timeout is killed and reported"""
+        runner = CommandRunner(timeout=0.5)
+        try:
+            with pytest.raises(RuntimeError, match="timed out after 0.5s"):
+                runner.run([sys.executable, "-c", "import time; time.sleep(30)"], "HandBrake compression failed")
+        finally:
+            runner.close()
+
+    def test_cancel_all_stops_running_commands(self):
+        """Test that cancelling unblocks the threads waiting on commands"""
+        runner = CommandRunner()
+        errors = []
+
+        def call():
+            try:
+                runner.run([sys.executable, "-c", "import time; time.sleep(30)"], "FFmpeg remux failed")
+            except RuntimeError as e:
+                errors.append(str(e))
+
+        thread = threading.Thread(target=call)
+        thread.start()
+        try:
+            time_waited = 0.0
+            while not runner._futures and time_waited < 5:
+                threading.Event().wait(0.05)
+                time_waited += 0.05
+            runner.cancel_all()
+            thread.join(timeout=5)
+            assert errors == ["FFmpeg remux failed: cancelled"]
+        finally:
+            runner.close()
+
+
+class TestProgressReporter:
+    """Tests for live progress, throughput and ETA reporting"""
+
+    def test_format_eta(self):
+        """Test the compact duration format"""
+        assert main.format_eta(45.9) == "45s"
+        assert main.format_eta(330) == "5m30s"
+        assert main.format_eta(3720) == "1h02m"
+
+    def test_task_fraction_from_ffmpeg_and_handbrake(self):
+        """Test that both progress streams turn into a fraction and fps"""
+        ffmpeg = FFmpegProgress()
+        task = main.ProgressTask("cam", "concat", ffmpeg, 1000, 20.0)
+        for line in ["fps=87.5", "out_time_us=5000000", "progress=continue"]:
+            ffmpeg.feed(line)
+        assert task.fraction == 0.25
+        assert task.fps == 87.5
+        assert task.describe().startswith("cam concat 25% 87.5 fps")
+
+        handbrake = HandBrakeProgress()
+        task = main.ProgressTask("cam", "compress", handbrake, 1000, None)
+        for line in TestProgressParsing.HANDBRAKE_LINES[:11]:
+            handbrake.feed(line)
+        assert task.fraction == 0.25
+        assert task.fps == 120.5
+
+    def test_batch_progress_and_eta(self, mock_args, make_job, monkeypatch):
+        """Test that finished directories and running commands add up to the batch progress"""
+        reporter = main.ProgressReporter()
+        now = [100.0]
+        monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+        reporter.started = 100.0
+        first = make_job(mock_args(c=True), "first", 1000)
+        second = make_job(mock_args(c=True), "second", 1000)
+        reporter.add_job(first)
+        reporter.add_job(second)
+        reporter.finish_job(first)
+
+        progress = FFmpegProgress()
+        with reporter.task(second, "concat", progress, 1000, 10.0):
+            progress.feed("out_time_us=5000000")
+            now[0] = 110.0
+            # 2000 bytes of the first directory and half of the second's 1000 byte concat
+            assert reporter.summary() == "1/2 directories, 62% of 0.0 GB, 0.0 MB/s, ETA 6s"
+            assert reporter.running()[0].startswith("second concat 50%")
+        assert reporter.running() == []
+
+    def test_discovery_covers_whole_batch(self, tmp_path, mock_args, make_job, monkeypatch):
+        """Test that the walk adds every directory before it is admitted, and says so while counting"""
+        reporter = main.ProgressReporter()
+        monkeypatch.setattr(main, "_progress", reporter)
+        args = mock_args()
+        jobs = [make_job(args, name, 1000) for name in ["a", "b", "c"]]
+        gate = threading.Event()
+
+        def walk():
+            yield jobs[0].directory
+            gate.wait(5)
+            yield jobs[1].directory
+            yield jobs[2].directory
+
+        found = main.discover_directories(walk(), args)
+        assert next(found) == jobs[0].directory
+        assert reporter.summary().startswith("0/1 directories (still counting), 0% of 0.0 GB")
+
+        gate.set()
+        assert list(found) == [jobs[1].directory, jobs[2].directory]
+        assert reporter.summary().startswith("0/3 directories, 0% of 0.0 GB")
+
+        # the exact size replaces the estimate on admission, an empty directory leaves the batch
+        jobs[0].clips = jobs[0].clips * 2
+        reporter.add_job(jobs[0])
+        reporter.finish_job(jobs[0])
+        reporter.skip(jobs[2].directory)
+        assert reporter.summary().startswith("1/2 directories, 67% of 0.0 GB")
+
+    def test_logs_progress_when_not_on_a_terminal(self, mock_args, caplog, make_job):
+        """Test the periodic log line fallback"""
+        reporter = main.ProgressReporter(interactive=False)
+        reporter.add_job(make_job(mock_args(), "cam", 1000))
+        with caplog.at_level("INFO"):
+            reporter.render()
+        assert "Progress: 0/1 directories" in caplog.text
+
+    def test_status_line_on_a_terminal(self, mock_args, make_job):
+        """Test that the status line is redrawn in place and cleared again"""
+        import io
+        stream = io.StringIO()
+        reporter = main.ProgressReporter(interactive=True, stream=stream)
+        job = make_job(mock_args(), "cam", 1000)
+        reporter.add_job(job)
+        with reporter.task(job, "concat", FFmpegProgress(), 1000, 10.0):
+            reporter.render()
+        reporter.clear()
+        assert stream.getvalue().startswith("\r\x1b[K0/1 directories")
+        assert " | cam concat 0%" in stream.getvalue()
+        assert stream.getvalue().endswith("\r\x1b[K")
+
+
+class TestPlan:
+    """Tests for the --plan dry run"""
+
+    def test_plan_directory_reports_clips_dropped_and_costs(self, tmp_path, mock_args, media, monkeypatch):
+        """Test that a directory's plan lists chosen and dropped clips, sizes, time and headroom"""
+        directory = tmp_path / "cam"
+        directory.mkdir()
+        (directory / "a.mp4").write_bytes(b"a" * 100)
+        (directory / "b.mp4").write_bytes(b"b" * 100)
+        (directory / "huge.mp4").write_bytes(b"\0" * 500)
+        monkeypatch.setattr(main, "DEFAULT_SIZE_LIMIT", 400)
+        monkeypatch.setattr(main, "probe_files",
+                            lambda clips, workers: [media(clip.path) for clip in clips])
+        planner = DiskPlanner()
+        planner.free_bytes = lambda path: 10000
+        scans = []
+        scan_clips = main.scan_clips
+        monkeypatch.setattr(main, "scan_clips", lambda *args: scans.append(args[0]) or scan_clips(*args))
+
+        entry = main.plan_directory(tmp_path, directory, mock_args(c=True), planner)
+
+        assert scans == [directory]
+        assert entry["action"] == "concat"
+        assert [clip["name"] for clip in entry["clips"]] == ["a.mp4", "b.mp4"]
+        assert entry["dropped"] == [{"name": "huge.mp4", "bytes": 500}]
+        assert entry["clip_bytes"] == 200
+        assert entry["duration"] == 20.0
+        assert entry["outputs"] == ["cam.mp4"]
+        assert entry["compressed_bytes"] == 100
+        assert entry["peak_bytes"] == 300
+        assert entry["headroom_bytes"] == 10000 - 300
+        assert entry["estimated_seconds"] == pytest.approx(200 / main.DEFAULT_COPY_BYTES_PER_SECOND
+                                                           + 20.0 / main.DEFAULT_ENCODE_SPEED)
+        assert "error" not in entry
+        # nothing was written
+        assert sorted(p.name for p in directory.iterdir()) == ["a.mp4", "b.mp4", "huge.mp4"]
+
+    def test_build_plan_totals_and_errors(self, tmp_path, mock_args, media, monkeypatch):
+        """Test batch totals and that a refused directory is reported rather than raised"""
+        for name in ["a", "b"]:
+            (tmp_path / name).mkdir()
+            (tmp_path / name / "clip.mp4").write_bytes(b"\0" * 100)
+        (tmp_path / "b" / "b.mp4").write_bytes(b"\0" * 10)
+        monkeypatch.setattr(main, "probe_files",
+                            lambda clips, workers: [media(clip.path) for clip in clips])
+
+        plan = main.build_plan(tmp_path, [tmp_path / "a", tmp_path / "b"], mock_args())
+
+        assert [entry.get("error") for entry in plan["directories"]] == [None, "b.mp4 already exists, "
+                                                                         "use --append to add the new clips to it"]
+        assert plan["totals"]["directories"] == 1
+        assert plan["totals"]["failed"] == 1
+        assert plan["totals"]["clip_bytes"] == 100
+
+        out = tmp_path / "plan.json"
+        main.write_plan(plan, str(out))
+        assert json.loads(out.read_text())["totals"] == plan["totals"]
+
+
+class TestThroughputModel:
+    """Tests for the historical throughput model and runtime predictions"""
+
+    def test_record_averages_and_persists(self, tmp_path):
+        """Test the moving average, sample count and that estimates survive reopening"""
+        path = tmp_path / "throughput.sqlite"
+        model = main.ThroughputModel(path, weight=0.5)
+        model.record("copy", main.COPY_THROUGHPUT_KEY, 100.0)
+        model.record("copy", main.COPY_THROUGHPUT_KEY, 200.0)
+        model.record("copy", main.COPY_THROUGHPUT_KEY, 0.0)
+        model.close()
+
+        model = main.ThroughputModel(path)
+        assert model.rate("copy", main.COPY_THROUGHPUT_KEY) == 150.0
+        assert model.rate("encode_fps", "anything") is None
+        assert [row[:4] for row in model.rows()] == [("copy", "stream copy", 150.0, 2)]
+        assert "stream copy" in main.format_throughput(model.rows())
+        assert main.format_throughput([]) == "No throughput measured yet"
+        model.close()
+
+    def test_show_throughput_only_reads(self, tmp_path):
+        """Test that --show-throughput neither creates the cache folder nor changes the database"""
+        path = tmp_path / "cache" / "throughput.sqlite"
+        assert main.read_throughput(path) == []
+        assert not (tmp_path / "cache").exists()
+
+        model = main.ThroughputModel(path)
+        model.record("copy", main.COPY_THROUGHPUT_KEY, 100.0)
+        model.close()
+        before = path.read_bytes()
+        assert [row[:4] for row in main.read_throughput(path)] == [("copy", "stream copy", 100.0, 1)]
+        assert path.read_bytes() == before
+
+    def test_predictions_use_measured_rates(self, tmp_path, mock_args, media, monkeypatch):
+        """Test that measured rates replace the defaults, down to the source resolution"""
+        model = main.ThroughputModel(tmp_path / "throughput.sqlite")
+        monkeypatch.setattr(main, "_throughput", model)
+        args = mock_args(c=True)
+        info = media(tmp_path / "a.mp4")
+
+        # nothing measured yet: default rates, and no guess without probe results
+        assert main.predict_seconds(args, 200, [info]) == pytest.approx(
+            200 / main.DEFAULT_COPY_BYTES_PER_SECOND + 20.0 / main.DEFAULT_ENCODE_SPEED)
+        assert main.predict_seconds(args, 200) is None
+
+        model.record("copy", main.COPY_THROUGHPUT_KEY, 100.0)
+        model.record("encode_bytes", main.encoder_preset(args), 50.0)
+        assert main.predict_seconds(args, 200) == 2.0 + 4.0
+        # 300 frames in the sampled 100 bytes, scaled to 200 bytes, at 60 fps
+        model.record("encode_fps", main.encode_throughput_key(info, args), 60.0)
+        assert main.predict_seconds(args, 200, [info]) == 2.0 + 10.0
+        assert main.predict_seconds(mock_args(), 200, [info]) == 2.0
+        model.close()
+
+    def test_stages_record_measured_throughput(self, tmp_path, mock_args, media, monkeypatch):
+        """Test that a directory's copy and encode passes are folded into the model"""
+        model = main.ThroughputModel(tmp_path / "throughput.sqlite")
+        monkeypatch.setattr(main, "_throughput", model)
+        args = mock_args(c=True, j=str(tmp_path / "custom.json"))
+        directory = tmp_path / "cam"
+        directory.mkdir()
+        job = DirectoryJob(tmp_path, directory, args, [Clip("a.mp4", directory / "a.mp4", 1000, 0)])
+        job.clip_infos = [media(directory / "a.mp4", size=1000)]
+
+        main.record_throughput(job, False, 2.0)
+        main.record_throughput(job, True, 10.0)
+
+        assert model.rate("copy", main.COPY_THROUGHPUT_KEY) == 500.0
+        assert model.rate("encode_bytes", "HandBrake custom.json") == 100.0
+        assert model.rate("encode_fps", "h264 1920x1080 | HandBrake custom.json") == 30.0
+        model.close()
+
+    def test_compress_time_excludes_verification(self, tmp_path, mock_args, monkeypatch):
+        """Test that only the encode itself is timed, not the probe and decode checks after it"""
+        args = mock_args(c=True, encoder="x265", verify="deep")
+        directory = tmp_path / "cam"
+        directory.mkdir()
+        job = DirectoryJob(tmp_path, directory, args, [Clip("a.mp4", directory / "a.mp4", 1000, 0)])
+        job.output_file.write_bytes(b"\0" * 10)
+        job.output_duration = 12.0
+
+        def fake_run_command(cmd, error_message, progress=None, cores=None, log_file=None):
+            Path(cmd[-1]).write_bytes(b"\0" * 5)
+            progress.feed("out_time_us=12000000")
+            progress.feed("progress=end")
+
+        def slow_sample_decode(file, duration, operation, log_file=None):
+            time.sleep(0.3)
+
+        recorded = []
+        monkeypatch.setattr(main, "run_command", fake_run_command)
+        monkeypatch.setattr(main, "sample_decode", slow_sample_decode)
+        monkeypatch.setattr(main, "measured_duration", lambda file, reported, level, full_probe: 12.0)
+        monkeypatch.setattr(main, "record_throughput", lambda job, encoded, seconds: recorded.append(seconds))
+        main.compress_stage(job)
+
+        assert job.verify_seconds >= 0.3
+        [seconds] = recorded
+        assert seconds < 0.3
+
+    def test_schedule_by_predicted_runtime(self, tmp_path, mock_args, media, monkeypatch):
+        """Test that a smaller directory that encodes slowly is started before a larger fast one"""
+        model = main.ThroughputModel(tmp_path / "throughput.sqlite")
+        monkeypatch.setattr(main, "_throughput", model)
+        args = mock_args(c=True, jobs=2)
+        dirs = []
+        for name, size in [("fast", 300), ("slow", 100)]:
+            directory = tmp_path / name
+            directory.mkdir()
+            (directory / "clip.mp4").write_bytes(b"\0" * size)
+            dirs.append(directory)
+        monkeypatch.setattr(main, "probe_media", lambda path, size=None, mtime_ns=None: media(
+            path, 3840 if path.parent.name == "slow" else 1920, size=size))
+        model.record("encode_fps", main.encode_throughput_key(media(tmp_path, 1920), args), 300.0)
+        model.record("encode_fps", main.encode_throughput_key(media(tmp_path, 3840), args), 10.0)
+
+        assert [d.name for d in schedule_directories(iter(dirs), args)] == ["slow", "fast"]
+        model.close()
+
+
+class TestDuplicates:
+    """Tests for leaving duplicate copies of clips out of the concatenation"""
+
+    @staticmethod
+    def write(directory, contents):
+        directory.mkdir(exist_ok=True)
+        for name, data in contents.items():
+            (directory / name).write_bytes(data)
+        return scan_clips(directory)
+
+    def test_split_duplicates_by_edges_and_full_hash(self, tmp_path, monkeypatch):
+        """Test that only byte-identical clips are duplicates, even when their edges match"""
+        monkeypatch.setattr(main, "DEDUP_EDGE_BYTES", 4)
+        clips = self.write(tmp_path / "cam", {
+            "GX010123.MP4": b"head-AAAA-tail",
+            "GX010123 (1).MP4": b"head-AAAA-tail",
+            "GX010124.MP4": b"head-BBBB-tail",
+            "GX010125.MP4": b"other size",
+        })
+
+        kept, duplicates = main.split_duplicates(clips)
+
+        assert sorted(clip.name for clip in kept) == ["GX010123.MP4", "GX010124.MP4", "GX010125.MP4"]
+        assert [(dup.name, orig.name) for dup, orig in duplicates] == [("GX010123 (1).MP4", "GX010123.MP4")]
+
+    def test_duplicates_are_archived_not_concatenated(self, tmp_path, mock_args):
+        """Test that prepare_job drops duplicates from the filelist and the archive stage takes them along"""
+        self.write(tmp_path / "cam", {"a.mp4": b"1" * 100, "a (1).mp4": b"1" * 100, "b.mp4": b"2" * 100})
+
+        job = prepare_job(tmp_path, tmp_path / "cam", mock_args())
+        assert job.filelist == ["a.mp4", "b.mp4"]
+        assert [clip.name for clip in job.duplicates] == ["a (1).mp4"]
+        assert len(prepare_job(tmp_path, tmp_path / "cam", mock_args(keep_duplicates=True)).filelist) == 3
+
+        main.archive_stage(job)
+        archived = tmp_path / ARCHIVE_DIR_NAME / "cam split files"
+        assert sorted(p.name for p in archived.iterdir()) == ["a (1).mp4", "a.mp4", "b.mp4"]
+
+
+class TestVerifyLevels:
+    """Tests for the --verify levels"""
+
+    def test_measured_duration_by_level(self, tmp_path, monkeypatch):
+        """Test which levels trust the reported duration and which probe"""
+        monkeypatch.setattr(main, "get_video_duration", lambda path: 99.0)
+        output = tmp_path / "cam.mp4"
+        assert main.measured_duration(output, 10.0, "none") == 10.0
+        assert main.measured_duration(output, None, "fast") is None
+        assert main.measured_duration(output, 10.0, "standard") == 10.0
+        assert main.measured_duration(output, None, "standard") == 99.0
+        assert main.measured_duration(output, 10.0, "standard", full_probe=True) == 99.0
+        assert main.measured_duration(output, 10.0, "deep") == 99.0
+
+    def test_check_durations(self):
+        """Test that mismatches fail unless the level or a missing duration skips the check"""
+        main.check_durations(10.0, 50.0, "Concatenation", "none")
+        main.check_durations(10.0, None, "Concatenation", "fast")
+        main.check_durations(10.0, 10.5, "Concatenation", "standard")
+        with pytest.raises(RuntimeError, match="Concatenation verification failed"):
+            main.check_durations(10.0, 50.0, "Concatenation", "fast")
+
+    def test_sample_decode_windows(self, tmp_path, monkeypatch):
+        """Test that random windows are decoded in parallel and a decoding error fails the check"""
+        commands = []
+
+        def fake_run_command(cmd, error_message, progress=None, cores=None, log_file=None):
+            commands.append(cmd)
+            if cmd[cmd.index("-ss") + 1] == "8.000":
+                raise RuntimeError(error_message)
+
+        monkeypatch.setattr(main, "run_command", fake_run_command)
+        monkeypatch.setattr(main.random, "uniform", lambda low, high: high)
+        output = tmp_path / "cam.mp4"
+
+        # a 5 second file only has room for two 2 second windows
+        main.sample_decode(output, 5.0, "Concatenation")
+        assert len(commands) == 2
+        assert commands[0][-3:] == ["-f", "null", "-"]
+        assert "-xerror" in commands[0] and commands[0][commands[0].index("-t") + 1] == "2"
+
+        with pytest.raises(RuntimeError, match="does not decode at 8.0s"):
+            main.sample_decode(output, 10.0, "Concatenation")
+
+    def test_summary_reports_verification_cost(self, tmp_path, caplog):
+        """Test that the run summary shows the time spent verifying"""
+        results = [main.DirectoryResult(tmp_path / "a", True, 8.0, verify_seconds=1.0),
+                   main.DirectoryResult(tmp_path / "b", True, 12.0, verify_seconds=1.0)]
+        with caplog.at_level("INFO"):
+            main.log_summary(results, "deep")
+        assert "Verification (--verify deep): 2.0s, 10% of processing time" in caplog.text
+
+
+class TestScratchStaging:
+    """Tests for --scratch staging on local disk"""
+
+    def test_stage_copies_clips_and_release_removes_them(self, tmp_path, mock_args, make_job):
+        """Test that clips are copied into a scratch folder the outputs are then written to"""
+        scratch = tmp_path / "scratch"
+        scratch.mkdir()
+        stager = main.ScratchStager(scratch, 10000)
+        job = make_job(mock_args(), size=100, count=2, root=tmp_path / "share")
+
+        stager.stage(job)
+
+        assert job.work_dir.parent == scratch
+        assert sorted(p.name for p in job.work_dir.iterdir()) == ["a.mp4", "b.mp4"]
+        assert job.output_file == job.work_dir / "cam.mp4"
+        assert job.log_file.parent == job.root / main.LOG_DIR_NAME
+        # clip bytes plus the concatenated output
+        assert stager.used == 400
+
+        stager.release(job)
+        assert list(scratch.iterdir()) == []
+        assert stager.used == 0
+
+    def test_preflight_and_dedup_read_the_staged_copies(self, tmp_path, mock_args, media, monkeypatch):
+        """Test that with --scratch clips are probed and hashed in scratch, not on the share"""
+        share = tmp_path / "share" / "cam"
+        share.mkdir(parents=True)
+        for name, data in {"a.mp4": b"1" * 100, "a (1).mp4": b"1" * 100, "b.mp4": b"2" * 100}.items():
+            (share / name).write_bytes(data)
+        scratch = tmp_path / "scratch"
+        scratch.mkdir()
+        stager = main.ScratchStager(scratch, 10000)
+        probed = []
+        monkeypatch.setattr(main, "probe_media", lambda path, *stat: probed.append(path) or media(path))
+
+        main.set_scratch_stager(stager)
+        try:
+            job = prepare_job(tmp_path / "share", share, mock_args())
+            assert job.duplicates == []
+            main.fetch_stage(job)
+            main.preflight_stage(job)
+        finally:
+            main.set_scratch_stager(None)
+
+        assert [clip.name for clip in job.duplicates] == ["a (1).mp4"]
+        assert job.filelist == ["a.mp4", "b.mp4"]
+        assert probed == [job.work_dir / "a.mp4", job.work_dir / "b.mp4"]
+
+        main.archive_stage(job)
+        assert list(job.work_dir.iterdir()) == []
+        stager.release(job)
+
+    def test_capacity_waits_and_rejects(self, tmp_path, mock_args, make_job):
+        """Test that staging waits for space held by other directories and refuses what never fits"""
+        scratch = tmp_path / "scratch"
+        scratch.mkdir()
+        stager = main.ScratchStager(scratch, 500)
+        first = make_job(mock_args(), "first", size=100, count=2, root=tmp_path / "share")
+        second = make_job(mock_args(), "second", size=100, count=2, root=tmp_path / "share")
+        stager.stage(first)
+
+        thread = threading.Thread(target=stager.stage, args=(second,))
+        thread.start()
+        thread.join(0.2)
+        assert thread.is_alive()
+        stager.release(first)
+        thread.join(5)
+        assert not thread.is_alive()
+        assert second.work_dir is not None
+
+        with pytest.raises(RuntimeError, match="Not enough scratch space"):
+            stager.stage(make_job(mock_args(), "huge", size=1000, count=2, root=tmp_path / "share"))
+        stager.release(second)
+
+    def test_pipeline_moves_only_outputs_back(self, tmp_path, mock_args, make_job, monkeypatch):
+        """Test that the share ends up with the output and archived clips, and scratch is emptied"""
+        scratch = tmp_path / "scratch"
+        scratch.mkdir()
+        job = make_job(mock_args(), size=100, count=2, root=tmp_path / "share")
+
+        def concat(job):
+            assert (job.work_dir / "a.mp4").exists()
+            job.output_file.write_bytes(b"output")
+            # anything else left in the scratch folder stays out of the directory
+            (job.work_dir / "cam.remux.a.mp4").write_bytes(b"leftover")
+
+        stages = dict(main.PIPELINE_STAGES)
+        monkeypatch.setattr(main, "PIPELINE_STAGES", [
+            ("fetch", stages["fetch"]), ("preflight", lambda job: None), ("concat", concat),
+            ("verify", lambda job: None), ("archive", stages["archive"]),
+            ("compress", lambda job: None), ("finalize", stages["finalize"]),
+        ])
+        main.set_scratch_stager(main.ScratchStager(scratch, 10000))
+        try:
+            results = process_directories(job.root, [job.directory], mock_args())
+        finally:
+            main.set_scratch_stager(None)
+
+        assert [result.ok for result in results] == [True]
+        assert [p.name for p in job.directory.iterdir()] == ["cam.mp4"]
+        assert (job.directory / "cam.mp4").read_bytes() == b"output"
+        assert sorted(p.name for p in (job.root / ARCHIVE_DIR_NAME / "cam split files").iterdir()) == [
+            "a.mp4", "b.mp4"]
+        assert list(scratch.iterdir()) == []
+
+    def test_failed_compress_keeps_clips_and_scratch_output(self, tmp_path, mock_args, make_job, monkeypatch):
+        """Test that with -d a failure after the archive stage loses neither the clips nor the output"""
+        scratch = tmp_path / "scratch"
+        scratch.mkdir()
+        job = make_job(mock_args(), size=100, count=2, root=tmp_path / "share")
+
+        def concat(job):
+            job.output_file.write_bytes(b"output")
+
+        def compress(job):
+            raise RuntimeError("HandBrake crashed")
+
+        stages = dict(main.PIPELINE_STAGES)
+        monkeypatch.setattr(main, "PIPELINE_STAGES", [
+            ("fetch", stages["fetch"]), ("preflight", lambda job: None), ("concat", concat),
+            ("verify", lambda job: None), ("archive", stages["archive"]),
+            ("compress", compress), ("finalize", stages["finalize"]),
+        ])
+        main.set_scratch_stager(main.ScratchStager(scratch, 10000))
+        try:
+            results = process_directories(job.root, [job.directory], mock_args(d=True, c=True))
+        finally:
+            main.set_scratch_stager(None)
+
+        assert [result.ok for result in results] == [False]
+        # the clips are only deleted once the outputs are back on the share
+        assert sorted(p.name for p in job.directory.iterdir()) == ["a.mp4", "b.mp4"]
+        [work_dir] = scratch.iterdir()
+        assert [p.name for p in work_dir.iterdir()] == ["cam.mp4"]
+
+
+class TestLimits:
+    """Tests for the politeness limits on child processes"""
+
+    def test_limits_file_values_are_validated(self):
+        """Test that a control file overrides command line limits and bad values are refused"""
+        base = main.Limits(nice=5, cpu_limit=2)
+        limits = base.updated({"ionice": "idle", "cpu_limit": 1.5})
+        assert limits == main.Limits(nice=5, ionice="idle", cpu_limit=1.5)
+        with pytest.raises(ValueError, match="unknown limits: speed"):
+            base.updated({"speed": 1})
+        with pytest.raises(ValueError, match="unknown ionice class"):
+            base.updated({"ionice": "lazy"})
+        with pytest.raises(ValueError, match="nice must be a number"):
+            base.updated({"nice": "low"})
+
+    def test_cpu_cap_and_read_rate(self, monkeypatch):
+        """Test the CPU cap and the read limit expressed as an ffmpeg -readrate"""
+        assert main.cap_cpus([0, 1, 2, 3], None) == [0, 1, 2, 3]
+        # fractions round down, to at least one CPU
+        assert main.cap_cpus([0, 1, 2, 3], 2.6) == [0, 1]
+        assert main.cap_cpus([0, 1, 2, 3], 1.6) == [0]
+        assert main.cap_cpus([0, 1, 2, 3], 0.2) == [0]
+
+        monkeypatch.setattr(main, "_limits", main.Limits(read_limit=10))
+        # 100 MB of clips lasting 50 s are read at 2 MB/s in real time
+        assert main.read_rate_options(100_000_000, 50.0) == ["-readrate", "5.000"]
+        assert main.read_rate_options(100_000_000, None) == []
+
+    @pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs /proc")
+    def test_limits_file_changes_running_commands(self, tmp_path, monkeypatch):
+        """Test that new limits from the control file reach a command that is already running"""
+        monkeypatch.setattr(main, "_limits", main.Limits())
+        runner = CommandRunner()
+        main.set_command_runner(runner)
+        log_file = tmp_path / "cam.log"
+        script = "import os, time; time.sleep(1); print('nice', os.nice(0), flush=True)"
+        thread = threading.Thread(target=runner.run, args=([sys.executable, "-c", script], "failed"),
+                                  kwargs={"log_file": log_file})
+        try:
+            thread.start()
+            for _ in range(100):
+                if runner._processes:
+                    break
+                threading.Event().wait(0.01)
+
+            limits_file = tmp_path / "limits.json"
+            limits_file.write_text(json.dumps({"nice": 19}))
+            control = main.LimitsControl(limits_file, main.Limits())
+            control.reload()
+            thread.join(10)
+        finally:
+            main.set_command_runner(None)
+            runner.close()
+
+        assert main._limits.nice == 19
+        assert "nice 19" in log_file.read_text()
+
+    @pytest.mark.skipif(not hasattr(main.os, "sched_setaffinity"), reason="needs sched_setaffinity")
+    def test_commands_start_with_limits_applied(self, tmp_path, monkeypatch):
+        """Test that the child sets its limits itself, before its first instruction runs"""
+        monkeypatch.setattr(main, "_limits", main.Limits(nice=19, cpu_limit=1))
+        monkeypatch.setattr(main, "apply_process_limits", lambda *args: None)
+        runner = CommandRunner()
+        log_file = tmp_path / "cam.log"
+        script = "import os; print('nice', os.nice(0), 'cpus', len(os.sched_getaffinity(0)))"
+        try:
+            runner.run([sys.executable, "-c", script], "failed", log_file=log_file)
+        finally:
+            runner.close()
+
+        assert "nice 19 cpus 1" in log_file.read_text()